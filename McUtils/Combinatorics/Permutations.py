@@ -2,11 +2,12 @@
 Utilities for working with permutations and permutation indexing
 """
 
-import numpy as np, time, typing, gc, itertools
+import numpy as np, time, typing, gc, itertools, os, atexit
 # import collections, functools as ft
 from ..Misc import jit, objmode, prange
-from ..Numputils import flatten_dtype, unflatten_dtype, difference as set_difference, unique, contained, group_by, split_by_regions, find, infer_int_dtype
+from ..Numputils import flatten_dtype, unflatten_dtype, difference as set_difference, unique, contained, group_by, split_by_regions, find, infer_int_dtype, infer_inds_dtype, BitPacking
 from ..Scaffolding import NullLogger
+from ..Parallelizers import Parallelizer, SerialNonParallelizer
 
 __all__ = [
     "IntegerPartitioner",
@@ -14,6 +15,7 @@ __all__ = [
     "IntegerPartitionPermutations",
     "SymmetricGroupGenerator",
     "CompleteSymmetricGroupSpace",
+    "PermutationHashIndex",
     "LatticePathGenerator",
     "PermutationRelationGraph"
 ]
@@ -49,9 +51,130 @@ class IntegerPartitioner:
         ))
 
     _partition_counts = None
+
+    # opt-in persistent storage for the count table and the partition lists
+    table_cache_env_var = 'MCUTILS_PARTITION_CACHE'
+    _table_cache_dir = None
+    _counts_cache_checked = False
+    _counts_known = 0
+    _atexit_registered = False
+    @classmethod
+    def default_table_cache_dir(cls):
+        """
+        The per-user directory the tables are stored in by default
+
+        :return:
+        :rtype: str
+        """
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+        return os.path.join(base, 'McUtils', cls.__name__)
+    @classmethod
+    def table_cache_dir(cls):
+        """
+        Returns the directory the tables are cached in, or `None` if caching is off.
+        Caching is off unless turned on through `enable_table_cache` or the
+        `MCUTILS_PARTITION_CACHE` environment variable (either a path or `1`/`true` for the default location)
+
+        :return:
+        :rtype: str | None
+        """
+        if cls._table_cache_dir is None:
+            env = os.environ.get(cls.table_cache_env_var, '')
+            if env.lower() in {'', '0', 'false', 'no'}:
+                return None
+            cls._table_cache_dir = cls.default_table_cache_dir() if env.lower() in {'1', 'true', 'yes'} else env
+        if not cls._atexit_registered:
+            cls._atexit_registered = True
+            atexit.register(cls.save_table_cache)
+        return cls._table_cache_dir
+    @classmethod
+    def enable_table_cache(cls, cache_dir=None):
+        """
+        Turns on the persistent table cache.
+        The location is also exported through the environment so that worker processes pick it up.
+
+        :param cache_dir: the directory to store the tables in (defaults to `default_table_cache_dir()`)
+        :type cache_dir: str | None
+        :return:
+        :rtype: str
+        """
+        if cache_dir is None:
+            cache_dir = cls.default_table_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        cls._table_cache_dir = cache_dir
+        cls._counts_cache_checked = False
+        os.environ[cls.table_cache_env_var] = cache_dir
+        return cls.table_cache_dir()
+    @classmethod
+    def disable_table_cache(cls):
+        """
+        Turns off the persistent table cache (after saving anything new)
+        """
+        cls.save_table_cache()
+        cls._table_cache_dir = None
+        os.environ.pop(cls.table_cache_env_var, None)
+
+    @classmethod
+    def _counts_cache_file(cls, dtype):
+        return os.path.join(cls.table_cache_dir(), 'partition_counts_{}.npy'.format(np.dtype(dtype).name))
+    @classmethod
+    def _merge_counts(cls, base, new):
+        shape = tuple(max(a, b) for a, b in zip(base.shape, new.shape))
+        if shape != base.shape:
+            merged = np.full(shape, -1, dtype=base.dtype)
+            merged[tuple(slice(0, x) for x in base.shape)] = base
+            base = merged
+        block = base[tuple(slice(0, x) for x in new.shape)]
+        known = new >= 0
+        block[known] = new[known]
+        return base
+    @classmethod
+    def _load_cached_counts(cls):
+        cls._counts_cache_checked = True
+        cache_dir = cls.table_cache_dir()
+        if cache_dir is None:
+            return
+        fn = cls._counts_cache_file(int)
+        if not os.path.isfile(fn):
+            return
+        try:
+            disk = np.load(fn, mmap_mode='r')
+        except (OSError, ValueError): # corrupt or partially written files just get rebuilt
+            return
+        if cls._partition_counts is None:
+            cls._partition_counts = np.array(disk)
+        else:
+            cls._partition_counts = cls._merge_counts(np.array(disk), cls._partition_counts)
+        cls._counts_known = np.count_nonzero(cls._partition_counts >= 0)
+    @classmethod
+    def save_table_cache(cls):
+        """
+        Writes the count table out to the cache directory, merging it with whatever is already stored there
+        """
+        cache_dir = cls.table_cache_dir()
+        if cache_dir is None or cls._partition_counts is None:
+            return
+        known = np.count_nonzero(cls._partition_counts >= 0)
+        if known <= cls._counts_known:
+            return
+        fn = cls._counts_cache_file(cls._partition_counts.dtype)
+        table = cls._partition_counts
+        if os.path.isfile(fn):
+            try:
+                table = cls._merge_counts(np.array(np.load(fn, mmap_mode='r')), table)
+            except (OSError, ValueError):
+                pass
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = '{}.{}.tmp.npy'.format(fn[:-4], os.getpid())
+        np.save(tmp, table)
+        os.replace(tmp, fn) # atomic so concurrent workers never see a partial file
+        cls._counts_known = known
+
     @classmethod
     def _manage_counts_array(cls, n, M, l):
         grew = False
+        if not cls._counts_cache_checked:
+            cls._load_cached_counts()
         if cls._partition_counts is None:
             grew = True
             # we just initialize this 3D array to be the size we need
@@ -278,31 +401,43 @@ class IntegerPartitioner:
     #                                                                                  counts)
 
     @classmethod
-    def partitions(cls, n, pad=False, return_lens = False, max_len=None, dtype=None):
-        """
-        Returns partitions in descending lexicographic order
-        Adapted from Kelleher to return terms ordered by length and then second in descending
-        lex order which while a computationally suboptimal is very natural for a mapping onto
-        physical phenomena (and also it's easier for storage)
-
-        :param n: integer to partition
-        :type n: int
-        :param return_len: whether to return the length or not
-        :type return_len:
-        :return:
-        :rtype:
-        """
-
-        if max_len is None or max_len > n:
-            max_len = n
-        l = max_len
-
-        if dtype is None:
-            dtype = _infer_dtype(n)
+    def _partitions_cache_file(cls, n, l, dtype):
+        return os.path.join(cls.table_cache_dir(), 'partitions_{}_{}_{}.npy'.format(n, l, np.dtype(dtype).name))
+    @classmethod
+    def _cached_partitions(cls, n, l, dtype, counts, count_totals):
+        # any stored table with at least `l` columns works, since the partitions are ordered by length
+        cache_dir = cls.table_cache_dir()
+        dtype_name = np.dtype(dtype).name
+        prefix = 'partitions_{}_'.format(n)
+        best = None
+        if os.path.isdir(cache_dir):
+            for fn in os.listdir(cache_dir):
+                if not (fn.startswith(prefix) and fn.endswith('_{}.npy'.format(dtype_name))):
+                    continue
+                try:
+                    k = int(fn[len(prefix):-len('_{}.npy'.format(dtype_name))])
+                except ValueError:
+                    continue
+                if k >= l and (best is None or k < best):
+                    best = k
+        if best is not None:
+            try:
+                table = np.load(cls._partitions_cache_file(n, best, dtype), mmap_mode='c')
+            except (OSError, ValueError):
+                table = None
+            if table is not None and table.shape[0] >= count_totals[-1]:
+                return table[:count_totals[-1], :l]
+
+        table = cls._generate_partitions(n, l, True, dtype, counts, count_totals)
+        os.makedirs(cache_dir, exist_ok=True)
+        fn = cls._partitions_cache_file(n, l, dtype)
+        tmp = '{}.{}.tmp.npy'.format(fn[:-4], os.getpid())
+        np.save(tmp, table)
+        os.replace(tmp, fn)
+        return table
 
-        # total_partitions = cls.count_partitions(n)
-        count_totals = np.array([cls.count_partitions(n, l=i+1) for i in range(l)])
-        counts = np.concatenate([count_totals[:1], np.diff(count_totals)], axis=0)
+    @classmethod
+    def _generate_partitions(cls, n, l, pad, dtype, counts, count_totals):
         # count_totals = np.flip(count_totals)
         if pad:
             storage = np.zeros((count_totals[-1], l), dtype=dtype)
@@ -365,6 +500,42 @@ class IntegerPartitioner:
                 if increments[k] == counts[k]:
                     break
 
+        return storage
+
+    @classmethod
+    def partitions(cls, n, pad=False, return_lens = False, max_len=None, dtype=None):
+        """
+        Returns partitions in descending lexicographic order
+        Adapted from Kelleher to return terms ordered by length and then second in descending
+        lex order which while a computationally suboptimal is very natural for a mapping onto
+        physical phenomena (and also it's easier for storage)
+
+        :param n: integer to partition
+        :type n: int
+        :param return_len: whether to return the length or not
+        :type return_len:
+        :return:
+        :rtype:
+        """
+
+        if max_len is None or max_len > n:
+            max_len = n
+        l = max_len
+
+        if dtype is None:
+            dtype = _infer_dtype(n)
+
+        # total_partitions = cls.count_partitions(n)
+        count_totals = np.array([cls.count_partitions(n, l=i+1) for i in range(l)])
+        counts = np.concatenate([count_totals[:1], np.diff(count_totals)], axis=0)
+        if cls.table_cache_dir() is not None:
+            storage = cls._cached_partitions(n, l, dtype, counts, count_totals)
+            if not pad:
+                starts = np.concatenate([[0], count_totals[:-1]])
+                storage = [storage[a:b, :i+1] for i, (a, b) in enumerate(zip(starts, count_totals))]
+        else:
+            storage = cls._generate_partitions(n, l, pad, dtype, counts, count_totals)
+
         if return_lens:
             if pad:
                 lens = np.ones(count_totals[-1], dtype=dtype)
@@ -1388,6 +1559,48 @@ class UniquePermutations:
             else:
                 on_visit(idx, perm, pos_map, counts, depth, tree_data)
 
+    @classmethod
+    def walk_permutation_block(cls, classes, counts, storage, start, stop, num_permutations=None):
+        """
+        Fills `storage` with the permutations `start`...`stop` of the partition
+        defined by `classes` and `counts` by walking the permutation tree,
+        so that only a single block of permutations ever needs to be held in memory
+
+        :param classes: the unique values in the partition
+        :type classes: np.ndarray
+        :param counts: the number of times each value appears
+        :type counts: np.ndarray
+        :param storage: the array to write the permutations into
+        :type storage: np.ndarray
+        :param start: the index of the first permutation to write
+        :type start: int
+        :param stop: the index after the last permutation to write
+        :type stop: int
+        :param num_permutations: the total number of permutations (if already known)
+        :type num_permutations: int
+        :return:
+        :rtype: np.ndarray
+        """
+
+        classes = np.asanyarray(classes)
+        if len(counts) == 1:
+            # the tree walk needs at least one branch point
+            storage[:stop - start] = classes[0]
+            return storage[:stop - start]
+
+        # we only walk the tree down to the first permutation in the block
+        # and then let the compiled permutation filler generate the rest
+        initial_permutation = np.empty(int(np.sum(counts)), dtype=classes.dtype)
+        def fill(idx, perm, pos_map, cts, depth, tree_data):
+            initial_permutation[:] = classes[perm]
+        cls.walk_permutation_tree(counts, fill, indices=[start], num_permutations=num_permutations)
+        storage[:stop - start] = cls.get_subsequent_permutations(initial_permutation,
+                                                                 classes=classes, counts=counts,
+                                                                 num_perms=stop - start
+                                                                 )
+
+        return storage[:stop - start]
+
     @classmethod
     def descend_permutation_tree_indices(cls, perms, on_visit, classes=None, counts=None, dim=None, assume_sorted=False, num_permutations=None):
         """
@@ -1868,6 +2081,128 @@ class EmptyIntegerPartitionPermutations(IntegerPartitionPermutations):
 
         return (uinds, groups), sorting, inds
 
+def _direct_sum_block(task, generator, build_opts):
+    input_classes, counts, classes, exc = task
+    return generator._build_direct_sums(input_classes, counts, classes, excluded_permutations=exc, **build_opts)
+def _parallel_direct_sum_blocks(tasks=None, generator=None, build_opts=None, parallelizer=None):
+    # `map` hands back results in task order, which is what keeps the merge deterministic
+    return parallelizer.map(_direct_sum_block, tasks, extra_args=(generator, build_opts))
+
+class PermutationHashIndex:
+    """
+    A static lookup table from the rows of a fixed array of non-negative integers
+    (permutations or packed permutations) to their positions.
+    Every row is reduced to a `uint64` key which is sorted once, so lookups are
+    vectorized binary searches over the keys rather than descents of the permutation tree.
+    When the rows are short enough that a mixed-radix encoding fits into 63 bits the keys
+    are exact and the rows themselves don't need to be kept around, otherwise
+    the keys are FNV-1a hashes and hits are verified against the stored rows.
+    """
+    fnv_offset = np.uint64(14695981039346656037)
+    fnv_prime = np.uint64(1099511628211)
+    def __init__(self, rows, indices=None):
+        """
+        :param rows: the rows to index
+        :type rows: np.ndarray
+        :param indices: the indices to return for each row (defaults to the row positions)
+        :type indices: np.ndarray
+        """
+        rows = np.asanyarray(rows)
+        if rows.ndim != 2:
+            raise ValueError("can only index 2D arrays of rows (got shape {})".format(rows.shape))
+        self.num_rows, self.row_length = rows.shape
+        self.base = 1 + (0 if len(rows) == 0 else max(int(np.max(rows)), 0))
+        self.exact = self.row_length * np.log2(self.base) < 63
+        if self.exact:
+            self._radices = np.array([self.base ** i for i in range(self.row_length - 1, -1, -1)], dtype=np.uint64)
+            self.rows = None
+        else:
+            self._radices = None
+            self.rows = rows
+        self.indices = indices
+
+        keys = self.hash(rows)
+        self._sorting = np.argsort(keys, kind='stable').astype(infer_inds_dtype(max(self.num_rows, 1)))
+        self._keys = keys[self._sorting]
+        self.has_collisions = len(keys) > 1 and bool(np.any(self._keys[1:] == self._keys[:-1]))
+
+    def __repr__(self):
+        return "{}({}, exact={})".format(type(self).__name__, self.num_rows, self.exact)
+
+    @property
+    def nbytes(self):
+        return self._keys.nbytes + self._sorting.nbytes
+
+    def hash(self, rows):
+        """
+        Computes the keys for the supplied rows
+
+        :param rows:
+        :type rows: np.ndarray
+        :return:
+        :rtype: np.ndarray
+        """
+        rows = np.asanyarray(rows)
+        if self.exact:
+            keys = np.zeros(len(rows), dtype=np.uint64)
+            for i, r in enumerate(self._radices):
+                keys += rows[:, i].astype(np.uint64) * r
+        else:
+            keys = np.full(len(rows), self.fnv_offset, dtype=np.uint64)
+            for i in range(self.row_length):
+                keys ^= rows[:, i].astype(np.uint64)
+                keys *= self.fnv_prime
+        return keys
+
+    def find(self, rows, missing_val=-1):
+        """
+        Finds the positions (or `indices`) of the supplied rows
+
+        :param rows: the rows to look up
+        :type rows: np.ndarray
+        :param missing_val: the value to use for rows that aren't in the index
+        :type missing_val: int
+        :return:
+        :rtype: np.ndarray
+        """
+        rows = np.asanyarray(rows)
+        if len(rows) == 0 or self.num_rows == 0:
+            return np.full(len(rows), missing_val, dtype=int)
+        if rows.shape[1] != self.row_length:
+            raise ValueError("can't look up rows of length {} in index over rows of length {}".format(
+                rows.shape[1], self.row_length
+            ))
+
+        keys = self.hash(rows)
+        pos = np.searchsorted(self._keys, keys)
+        pos[pos == self.num_rows] = 0
+        key_hits = self._keys[pos] == keys
+        found = self._sorting[pos].astype(int)
+        if self.exact:
+            # the encoding is only unique for rows inside the radix
+            hits = np.logical_and(
+                key_hits,
+                np.all(np.logical_and(rows >= 0, rows < self.base), axis=1)
+            )
+        else:
+            hits = np.logical_and(key_hits, np.all(self.rows[found] == rows, axis=1))
+            if self.has_collisions:
+                # walk the (very short) runs of colliding keys for anything we missed
+                for i in np.where(np.logical_and(key_hits, np.logical_not(hits)))[0]:
+                    p = pos[i] + 1
+                    while p < self.num_rows and self._keys[p] == keys[i]:
+                        j = self._sorting[p]
+                        if np.all(self.rows[j] == rows[i]):
+                            found[i] = j
+                            hits[i] = True
+                            break
+                        p += 1
+
+        if self.indices is not None:
+            found = self.indices[found]
+        found[np.logical_not(hits)] = missing_val
+        return found
+
 class SymmetricGroupGenerator:
     """
     I don't know what to call this.
@@ -1886,6 +2221,9 @@ class SymmetricGroupGenerator:
         self._partition_permutations = [EmptyIntegerPartitionPermutations(0, dim=self.dim)] #type: list[IntegerPartitionPermutations]
         self._counts = [1] #type: list[int]
         self._cumtotals = np.array([0])
+        self._index = None #type: PermutationHashIndex
+        self._index_packing = None #type: BitPacking
+        self._index_max_sum = -1
 
     def __repr__(self):
         return "{}({})".format(type(self).__name__, self.dim)
@@ -1929,15 +2267,20 @@ class SymmetricGroupGenerator:
             # fills stuff up until we have everything covered
             self._get_partition_perms([1+len(self._partition_permutations)*2])
 
-    def get_terms(self, n, flatten=True):
+    def get_terms(self, n, flatten=True, block_size=None):
         """
         Returns permutations of partitions
         :param n:
         :type n:
+        :param block_size: if supplied, an iterator over blocks of terms is returned (see `iter_terms`)
+        :type block_size: int
         :return:
         :rtype:
         """
 
+        if block_size is not None:
+            return self.iter_terms(n, block_size=block_size)
+
         if isinstance(n, (int, np.integer)):
             n = [n]
 
@@ -1946,6 +2289,78 @@ class SymmetricGroupGenerator:
         if flatten:
             perms = np.concatenate([np.concatenate(x, axis=0) for x in perms], axis=0)
         return perms
+    def iter_terms(self, n, block_size=10000, dtype=None):
+        """
+        Iterates over the permutations of partitions in blocks of (at most) `block_size` terms,
+        yielding each block along with the global indices of its terms.
+        Terms come out in the same canonical order as `get_terms` but only a single
+        block is ever held in memory.
+
+        :param n: the integers (or integer) to generate terms for
+        :type n: int | Iterable[int]
+        :param block_size: the number of terms per block
+        :type block_size: int
+        :param dtype: the dtype of the yielded terms
+        :type dtype: str | np.dtype
+        :return:
+        :rtype: Iterator[Tuple[np.ndarray, np.ndarray]]
+        """
+
+        if isinstance(n, (int, np.integer)):
+            n = [n]
+        n = list(n)
+        if len(n) == 0:
+            return
+
+        partitioners, offsets = self._get_partition_perms(n)
+        if dtype is None:
+            dtype = _infer_dtype(max(max(n), 1))
+
+        block = np.zeros((block_size, self.dim), dtype=dtype)
+        inds = np.zeros(block_size, dtype=int)
+        fill = 0
+        for p, offset in zip(partitioners, offsets):
+            for (classes, counts), part_offset in zip(p._class_counts, p._cumtotals):
+                num_perms = UniquePermutations.count_permutations(counts)
+                start = 0
+                while start < num_perms:
+                    stop = min(num_perms, start + block_size - fill)
+                    UniquePermutations.walk_permutation_block(classes, counts, block[fill:], start, stop,
+                                                              num_permutations=num_perms)
+                    inds[fill:fill + stop - start] = offset + part_offset + np.arange(start, stop)
+                    fill += stop - start
+                    start = stop
+                    if fill == block_size:
+                        yield block, inds
+                        block = np.zeros((block_size, self.dim), dtype=dtype)
+                        inds = np.zeros(block_size, dtype=int)
+                        fill = 0
+        if fill > 0:
+            yield block[:fill], inds[:fill]
+    def load_index(self, max_sum, block_size=10000):
+        """
+        Precomputes a static hash index over every term with at most `max_sum` quanta
+        so that `to_indices` can look those terms up directly instead of walking the
+        permutation tree.
+        The terms are streamed in blocks and stored bit-packed.
+
+        :param max_sum: the largest number of quanta to index
+        :type max_sum: int
+        :param block_size: the number of terms to generate at once
+        :type block_size: int
+        :return:
+        :rtype: PermutationHashIndex
+        """
+        if max_sum > self._index_max_sum:
+            packing = BitPacking.from_max_value(self.dim, max_sum, min_bits=2)
+            rows = np.concatenate(
+                [packing.pack(block) for block, _ in self.iter_terms(range(max_sum + 1), block_size=block_size)],
+                axis=0
+            )
+            self._index = PermutationHashIndex(rows)
+            self._index_packing = packing
+            self._index_max_sum = max_sum
+        return self._index
     def num_terms(self, n):
         if isinstance(n, (int, np.integer)):
             n = [n]
@@ -1981,6 +2396,19 @@ class SymmetricGroupGenerator:
         if sums is None:
             sums = np.sum(perms, axis=1)
 
+        if (
+                self._index is not None
+                and np.max(sums) <= self._index_max_sum
+                and np.min(perms) >= 0
+        ):
+            indices = self._index.find(self._index_packing.pack(perms))
+            if dtype is None:
+                dtype = _infer_dtype(np.max(indices))
+            indices = indices.astype(dtype)
+            if len(big_shp) > 1:
+                indices = np.reshape(indices, big_shp)
+            return indices
+
         if not assume_sorted and len(perms) > 1:
             sorting = np.argsort(sums)
             sums = sums[sorting]
@@ -2654,6 +3082,29 @@ class SymmetricGroupGenerator:
 
         return sum_sorting, perm_sorting, usums, perm_classes, perm_subsortings
 
+    def _parallel_direct_sums(self, parallelizer, perm_classes, rule_counts, rule_classes, excluded_permutations,
+                              **build_opts):
+        """
+        Evaluates `_build_direct_sums` for every (input class, rule class) pair on `parallelizer`,
+        returning an iterator over the results in the order the serial loop consumes them
+        (or `None` if the work should just be done serially)
+        """
+        if parallelizer is None:
+            return None
+        par = parallelizer if isinstance(parallelizer, Parallelizer) else Parallelizer.lookup(parallelizer)
+        if isinstance(par, SerialNonParallelizer):
+            return None
+        tasks = [
+            (input_classes, counts, classes, exc)
+            for input_classes in perm_classes
+            for counts, classes, exc in zip(rule_counts, rule_classes, excluded_permutations)
+        ]
+        if len(tasks) < 2:
+            return None
+        with par:
+            res = par.run(_parallel_direct_sum_blocks, main_kwargs={'tasks': tasks, 'generator': self, 'build_opts': build_opts})
+        return iter(res)
+
     def take_permutation_rule_direct_sum(self,
                                          perms, rules,
                                          sums=None,
@@ -2667,7 +3118,8 @@ class SymmetricGroupGenerator:
                                          return_filter=False,
                                          preserve_ordering=True,
                                          indexing_method='direct',
-                                         logger=None
+                                         logger=None,
+                                         parallelizer=None
                                          ):
         """
         Applies `rules` to perms.
@@ -2682,6 +3134,9 @@ class SymmetricGroupGenerator:
         :type perms:
         :param rules:
         :type rules:
+        :param parallelizer: if supplied, the direct sums for each (input class, rule class) pair
+        are computed on the parallelizer's processes and then merged in the serial order
+        :type parallelizer: Parallelizer | str | None
         :return:
         :rtype:
         """
@@ -2845,6 +3300,13 @@ class SymmetricGroupGenerator:
         else:
             input_classes_fmt=[]
             rule_class_fmt=[]
+        direct_sums = self._parallel_direct_sums(
+            parallelizer, perm_classes, rule_counts, rule_classes, excluded_permutations,
+            return_indices=return_indices,
+            return_excitations=return_excitations,
+            filter=filter, inds_dtype=inds_dtype,
+            full_basis=full_basis
+        )
         with logger.block(tag="taking direct product", log_level=logger.LogLevel.Debug):
             with logger.block(tag="selection rules:", log_level=logger.LogLevel.Debug):
                 logger.log_print(rule_class_fmt, log_level=logger.LogLevel.Debug)
@@ -2862,13 +3324,16 @@ class SymmetricGroupGenerator:
                         ind_block = []
 
                     for counts, classes, exc in zip(rule_counts, rule_classes, excluded_permutations):
-                        res = self._build_direct_sums(input_classes, counts, classes,
-                                                      return_indices=return_indices,
-                                                      return_excitations=return_excitations,
-                                                      filter=filter, inds_dtype=inds_dtype,
-                                                      excluded_permutations=exc,
-                                                      full_basis=full_basis
-                                                      )
+                        if direct_sums is not None:
+                            res = next(direct_sums)
+                        else:
+                            res = self._build_direct_sums(input_classes, counts, classes,
+                                                          return_indices=return_indices,
+                                                          return_excitations=return_excitations,
+                                                          filter=filter, inds_dtype=inds_dtype,
+                                                          excluded_permutations=exc,
+                                                          full_basis=full_basis
+                                                          )
                         # gc.collect()
                         if split_results or preserve_ordering:
                             split_blocks = np.cumsum(res[1][:-1])
@@ -3044,22 +3509,38 @@ class CompleteSymmetricGroupSpace:
     """
 
     permutation_dtype = 'int8' # if we need to go up beyond dim 256 we're fucked anyway
-    def __init__(self, dim, memory_constrained=False):
+    packing_block_size = 10000
+    def __init__(self, dim, memory_constrained=False, packed=False):
+        """
+        :param dim: the number of modes
+        :type dim: int
+        :param memory_constrained: whether to skip storing the basis and always go through the generator
+        :type memory_constrained: bool
+        :param packed: whether to store the basis bit-packed, with as few bits per mode as the loaded quanta need
+        :type packed: bool
+        """
         self.generator = SymmetricGroupGenerator(dim)
         self._basis = None
-        self._basis_sorting = None
+        self._index = None #type: PermutationHashIndex
         _, self._contracted_dtype, _, self._og_dtype = flatten_dtype(np.zeros((1, dim), dtype=self.permutation_dtype))
         self.memory_constrained = memory_constrained
+        self.packed = packed
+        self.packing = None #type: BitPacking
 
     @property
     def dim(self):
         return self.generator.dim
 
     def __getstate__(self):
-        return {'dim':self.dim}
+        return {'dim':self.dim, 'memory_constrained':self.memory_constrained, 'packed':self.packed}
     def __setstate__(self, state):
-        self.__init__(state['dim'])
+        self.__init__(state['dim'],
+                      memory_constrained=state.get('memory_constrained', False),
+                      packed=state.get('packed', False)
+                      )
     def _contract_dtype(self, perms):
+        if self.packed:
+            return self.packing.flatten(self.packing.pack(perms))
         if self._contracted_dtype is not None and perms.dtype == self._contracted_dtype:
             return perms
         else:
@@ -3079,6 +3560,9 @@ class CompleteSymmetricGroupSpace:
             if len(need_to_load) > 0:
                 if not isinstance(need_to_load[0], (int, np.integer)):
                     need_to_load = need_to_load[0]
+                if self.packed:
+                    self._load_packed(need_to_load)
+                    return
                 partitioners = self.generator._get_partition_perms(need_to_load)[0] #type: list[IntegerPartitionPermutations]
                 new_bases = [
                     c for p in partitioners for c in
@@ -3096,7 +3580,60 @@ class CompleteSymmetricGroupSpace:
         _, offset = self.generator._get_partition_perms([max_sum + 1])
         self.load_to_size(offset[0])
 
-    def take(self, item, uncoerce=False, max_size=None):
+    def _load_packed(self, sums):
+        """
+        Streams the terms for `sums` into the packed basis, repacking
+        the existing basis if the new terms need more bits per mode
+
+        :param sums:
+        :type sums: Iterable[int]
+        """
+        sums = [int(n) for n in sums]
+        if len(sums) == 0:
+            return
+        max_val = max(sums)
+        if self.packing is None or max_val > self.packing.max_value:
+            packing = BitPacking.from_max_value(self.dim, max_val, dtype=self.permutation_dtype, min_bits=2)
+            if self._basis is not None:
+                self._basis = packing.pack(self.packing.unpack(self._basis))
+                self._index = None
+            self.packing = packing
+        new_bases = [
+            self.packing.pack(block)
+            for block, _ in self.generator.iter_terms(sums,
+                                                      block_size=self.packing_block_size,
+                                                      dtype=self.permutation_dtype
+                                                      )
+        ]
+        if self._basis is not None:
+            new_bases = [self._basis] + new_bases
+        self._basis = np.concatenate(new_bases, axis=0)
+        self._contracted_basis = self.packing.flatten(self._basis)
+
+    @property
+    def basis_nbytes(self):
+        """
+        The number of bytes used to store the loaded basis
+        """
+        return 0 if self._basis is None else self._basis.nbytes
+
+    def iter_basis(self, max_sum, min_sum=0, block_size=10000):
+        """
+        Iterates over the basis up through `max_sum` quanta in blocks of `block_size` states
+        without loading the full basis, yielding each block with the global indices of its states
+
+        :param max_sum: the largest number of quanta to include
+        :type max_sum: int
+        :param min_sum: the smallest number of quanta to include
+        :type min_sum: int
+        :param block_size: the number of states per block
+        :type block_size: int
+        :return:
+        :rtype: Iterator[Tuple[np.ndarray, np.ndarray]]
+        """
+        return self.generator.iter_terms(range(min_sum, max_sum + 1), block_size=block_size, dtype=self.permutation_dtype)
+
+    def take(self, item, uncoerce=False, max_size=None, return_packed=False):
         if self.memory_constrained:
             return self.generator.from_indices(item)
         if isinstance(item, (int, np.integer)):
@@ -3111,7 +3648,11 @@ class CompleteSymmetricGroupSpace:
             self.load_to_size(max_size)
             res = self._basis[item]
 
-        if uncoerce:
+        if self.packed:
+            # only the selected rows ever get unpacked
+            if not return_packed:
+                res = self.packing.unpack(res)
+        elif uncoerce:
             # orig_shape, orig_dtype, axis
             if len(res) == 0:
                 res = np.empty((0, self.dim), dtype=self.permutation_dtype)
@@ -3130,6 +3671,20 @@ class CompleteSymmetricGroupSpace:
              max_sum=None,
              search_space_sorting=None
              ):
+        """
+        Finds the indices of `perms` in the basis through a hash index over the loaded basis
+
+        :param perms: the permutations to find
+        :type perms: np.ndarray
+        :param check_sums: whether to make sure the basis is loaded far enough to contain `perms`
+        :type check_sums: bool
+        :param max_sum: the largest number of quanta in `perms` (if already known)
+        :type max_sum: int
+        :param search_space_sorting: unused, hash lookups don't need the queries sorted
+        :type search_space_sorting: None
+        :return:
+        :rtype: np.ndarray
+        """
         if self.memory_constrained:
             return self.generator.to_indices(perms)
 
@@ -3144,17 +3699,30 @@ class CompleteSymmetricGroupSpace:
                 max_sum = np.max(sums)
             self.load_to_sum(max_sum + 1)
 
-        if self._basis_sorting is not None and len(self._basis_sorting) == len(self._basis):
-            inds, self._basis_sorting = find(self._contracted_basis, self._contract_dtype(p), sorting=self._basis_sorting,
-                                             search_space_sorting=search_space_sorting
-                                             )
-        else:
-            inds, self._basis_sorting = find(self._contracted_basis, self._contract_dtype(p),
-                                             search_space_sorting=search_space_sorting
-                                             )
+        if self.packed:
+            if not np.all(self.packing.in_range(p)):
+                raise IndexError("{} not in array".format(p[np.logical_not(self.packing.in_range(p))]))
+            p = self.packing.pack(p)
+
+        inds = self.load_index().find(p)
+        missing = inds < 0
+        if missing.any():
+            raise IndexError("{} not in array".format(np.asanyarray(perms)[missing] if not smol else perms))
 
         return inds
 
+    def load_index(self):
+        """
+        Returns a static hash index over the currently loaded basis,
+        rebuilding it if the basis has grown since it was last built
+
+        :return:
+        :rtype: PermutationHashIndex
+        """
+        if self._index is None or self._index.num_rows != len(self._basis):
+            self._index = PermutationHashIndex(self._basis)
+        return self._index
+
 class LatticePathGenerator:
     """
     An object to take direct products of lattice paths and
@@ -1,6 +1,6 @@
 from .CoordinateSystemConverter import CoordinateSystemConverter
 from .CommonCoordinateSystems import CartesianCoordinates3D, ZMatrixCoordinates
-from ...Numputils import vec_norms, vec_angles, pts_dihedrals, dist_deriv, angle_deriv, dihed_deriv
+from ...Numputils import vec_norms, vec_angles, pts_dihedrals, internal_coordinates, dist_deriv, angle_deriv, dihed_deriv
 import numpy as np
 # this import gets bound at load time, so unfortunately PyCharm can't know just yet
 # what properties its class will have and will try to claim that the files don't exist
@@ -103,7 +103,7 @@ class CartesianToZMatrixConverter(CoordinateSystemConverter):
         if not multiconfig:
             ix = ol[1:, 0]
             jx = ol[1:, 1]
-            dists = self.get_dists(coords[ix], coords[jx])
+            dists = internal_coordinates(coords, np.array([ix, jx]).T)
             if return_derivs:
                 _dists, dist_derivs, dist_derivs_2 = dist_deriv(coords, ix, jx, order=2)
                 drang = np.arange(len(ix))
@@ -123,7 +123,7 @@ class CartesianToZMatrixConverter(CoordinateSystemConverter):
                 jx = ol[2:, 1]
                 kx = ol[2:, 2]
                 angles = np.concatenate( (
-                    [0], self.get_angles(coords[ix], coords[jx], coords[kx])
+                    [0], internal_coordinates(coords, np.array([ix, jx, kx]).T)
                 ) )
                 if not use_rad:
                     angles = np.rad2deg(angles)
@@ -164,7 +164,7 @@ class CartesianToZMatrixConverter(CoordinateSystemConverter):
 
                 diheds = np.concatenate( (
                     [0, 0],
-                    self.get_diheds(coords[ix], coords[jx], coords[kx], coords[lx])
+                    internal_coordinates(coords, np.array([ix, jx, kx, lx]).T)
                 ) )
                 if not use_rad:
                     diheds = np.rad2deg(diheds)
@@ -190,7 +190,7 @@ class CartesianToZMatrixConverter(CoordinateSystemConverter):
             mask[np.arange(0, ncoords, nol)] = False
             ix = ol[mask, 0]
             jx = ol[mask, 1]
-            dists = self.get_dists(coords[ix], coords[jx])
+            dists = internal_coordinates(coords, np.array([ix, jx]).T)
             if return_derivs:
                 _, dist_derivs, dist_derivs_2 = dist_deriv(coords, ix, jx, order=2)
                 drang = np.arange(nol-1)
@@ -209,7 +209,7 @@ class CartesianToZMatrixConverter(CoordinateSystemConverter):
                 ix = ol[mask, 0]
                 jx = ol[mask, 1]
                 kx = ol[mask, 2]
-                angles = self.get_angles(coords[ix], coords[jx], coords[kx])
+                angles = internal_coordinates(coords, np.array([ix, jx, kx]).T)
                 angles = np.append(angles, np.zeros(steps))
                 insert_pos = np.arange(0, ncoords-1*steps-1, nol-2)
                 angles = np.insert(angles, insert_pos, 0)
@@ -257,7 +257,7 @@ class CartesianToZMatrixConverter(CoordinateSystemConverter):
                     lx[swap_pos] = swap_k
                 # print(ol)
 
-                diheds = self.get_diheds(coords[ix], coords[jx], coords[kx], coords[lx])
+                diheds = internal_coordinates(coords, np.array([ix, jx, kx, lx]).T)
                 # pad diheds to be the size of ncoords
                 diheds = np.append(diheds, np.zeros(2*steps))
 
@@ -119,6 +119,9 @@ class ZMatrixToCartesianConverter(CoordinateSystemConverter):
         x_pts = origins + vec_normalize(axes[:, 0])
         y_pts = origins + vec_normalize(axes[:, 1])
 
+        # scratch buffers shared by every step of the build-up
+        workspace = VectorWorkspace()
+
         dists = coordlist[:, 0, 0]
         if return_derivs:
             der_stuff = cartesian_from_rad_derivatives(origins,
@@ -138,8 +141,8 @@ class ZMatrixToCartesianConverter(CoordinateSystemConverter):
                 derivs[2][np.arange(sysnum), :1, :, :1, :, 1, :] = der_stuff[2]
 
         else:
-            ref_points_1, _ = cartesian_from_rad(origins, x_pts, y_pts, dists, None, None)
-            total_points[:, 1] = ref_points_1
+            cartesian_from_rad(origins, x_pts, y_pts, dists, None, None,
+                               out=total_points[:, 1], workspace=workspace)
 
         # print(">> z2c >> ordering", ordering[0])
 
@@ -196,8 +199,8 @@ class ZMatrixToCartesianConverter(CoordinateSystemConverter):
                 if return_deriv_order > 1:
                     derivs[2][np.arange(sysnum), :i+1, :, :i+1, :, i+1, :] = der_stuff[2]
             else:
-                ref_points_1, _ = cartesian_from_rad(refs1, refs2, refs3, dists, angle, dihed, psi=psi_flag)
-                total_points[:, i+1] = ref_points_1
+                cartesian_from_rad(refs1, refs2, refs3, dists, angle, dihed, psi=psi_flag,
+                                   out=total_points[:, i+1], workspace=workspace)
 
         if atom_ordering is not None:
             rev_ord = atom_ordering#np.argsort(atom_ordering, axis=1)
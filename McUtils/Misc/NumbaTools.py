@@ -22,7 +22,7 @@ class without_numba:
         self._numba_state = None
     def __enter__(self):
         self._numba_state = NumbaState.numba_disabled
-        _numba_disabled = True
+        NumbaState.numba_disabled = True
     def __exit__(self, exc_type, exc_val, exc_tb):
         NumbaState.numba_disabled = self._numba_state
         self._numba_state = None
@@ -3,6 +3,8 @@ Provides analytic derivatives for some common base terms with the hope that we c
 """
 import numpy as np
 from .VectorOps import *
+from .VectorOps import _prep_internal_specs
+from .Sparse import SparseArray
 from .Options import Options
 
 __all__ = [
@@ -13,6 +15,7 @@ __all__ = [
     'dist_deriv',
     'angle_deriv',
     'dihed_deriv',
+    'internal_coordinate_tensors',
     'vec_norm_derivs',
     'vec_sin_cos_derivs',
     'vec_angle_derivs'
@@ -73,7 +76,7 @@ def normalized_vec_deriv(v, dv):
     """
     norms = vec_norms(v)[..., np.newaxis]
     vh = v / norms
-    i3 = np.broadcast_to(np.eye(3), dv.shape[:-1] + (3, 3))
+    i3 = np.broadcast_to(np.eye(3, dtype=vh.dtype), dv.shape[:-1] + (3, 3))
     vXv = vec_outer(vh, vh)
     wat = np.matmul(i3 - vXv, dv[..., np.newaxis])[..., 0] # gotta add a 1 for matmul
     return wat / norms
@@ -87,7 +90,7 @@ def normalized_vec_deriv2(v, dv1, dv2, d2v):
     vds2 = vec_dots(dv2, v)[..., np.newaxis]
     dnorminv = -1/(norms**3) * vds2
     vh = v / norms
-    i3 = np.broadcast_to(np.eye(3), dv1.shape[:-1] + (3, 3))
+    i3 = np.broadcast_to(np.eye(3, dtype=vh.dtype), dv1.shape[:-1] + (3, 3))
     vXv = vec_outer(vh, vh)
     dvh2 = normalized_vec_deriv(v, dv2)
     dvXv2 = _prod_deriv(vec_outer, vh, vh, dvh2, dvh2)
@@ -118,8 +121,8 @@ def rot_deriv(angle, axis, dAngle, dAxis):
     vdOdv = vec_outer(dAxis, axis) + vec_outer(axis, dAxis)
     c = np.cos(angle)[..., np.newaxis]
     s = np.sin(angle)[..., np.newaxis]
-    i3 = np.broadcast_to(np.eye(3), axis.shape[:-1] + (3, 3))
-    e3 = np.broadcast_to(levi_cevita3, axis.shape[:-1] + (3, 3, 3))
+    i3 = np.broadcast_to(np.eye(3, dtype=axis.dtype), axis.shape[:-1] + (3, 3))
+    e3 = np.broadcast_to(levi_cevita3.astype(axis.dtype), axis.shape[:-1] + (3, 3, 3))
     # e3 = levi_cevita3
     # i3 = np.eye(3)
     ct = vdOdv*(1-c[..., np.newaxis])
@@ -153,8 +156,8 @@ def rot_deriv2(angle, axis, dAngle1, dAxis1, dAngle2, dAxis2, d2Angle, d2Axis):
     dvXv2 = _prod_deriv(vec_outer, axis, axis, dAxis2, dAxis2)
     d2vXv = _prod_deriv_2(vec_outer, axis, axis, dAxis1, dAxis2, dAxis1, dAxis2, d2Axis, d2Axis)
 
-    i3 = np.broadcast_to(np.eye(3), axis.shape[:-1] + (3, 3))
-    e3 = np.broadcast_to(levi_cevita3, axis.shape[:-1] + (3, 3, 3))
+    i3 = np.broadcast_to(np.eye(3, dtype=axis.dtype), axis.shape[:-1] + (3, 3))
+    e3 = np.broadcast_to(levi_cevita3.astype(axis.dtype), axis.shape[:-1] + (3, 3, 3))
 
     c = np.cos(angle)
     s = np.sin(angle)
@@ -317,7 +320,7 @@ def cartesian_from_rad_derivatives(
         if derivs[1].ndim != 5:
             raise ValueError("as implemented, derivative blocks have to look like (nconfigs, nzlines, 3, natoms, 3)")
         config_shape = derivs[1].shape[:-4]
-        d1 = np.zeros(config_shape + (i+1, 3, 3)) # the next block in the derivative tensor
+        d1 = np.zeros(config_shape + (i+1, 3, 3), dtype=derivs[1].dtype) # the next block in the derivative tensor
         d1_comps = np.full((i+1, 3), None) # the components used to build the derivatives
         for z in range(i + 1):  # Lower-triangle is 0 so we do nothing with it
             for m in range(3):
@@ -335,7 +338,7 @@ def cartesian_from_rad_derivatives(
         new_derivs.append(d1)
         new_comps.append(d1_comps)
         if order > 1:
-            d2 = np.zeros(config_shape + (i+1, 3, i+1, 3, 3)) # the next block in the 2nd derivative tensor
+            d2 = np.zeros(config_shape + (i+1, 3, i+1, 3, 3), dtype=derivs[2].dtype) # the next block in the 2nd derivative tensor
             d2_comps = np.full((i+1, 3, i+1, 3), None) # the components used to build the derivatives
             for z1 in range(i + 1):
                 for m1 in range(3):
@@ -381,6 +384,7 @@ def vec_norm_derivs(a, order=1, zero_thresh=None):
     if order > 2:
         raise NotImplementedError("derivatives currently only up to order {}".format(2))
 
+    a = Options.cast(a)
     derivs = []
 
     na = vec_norms(a)
@@ -400,9 +404,9 @@ def vec_norm_derivs(a, order=1, zero_thresh=None):
     if order >= 2:
         extra_shape = a.ndim - 1
         if extra_shape > 0:
-            i3 = np.broadcast_to(np.eye(3), (1,)*extra_shape + (3, 3))
+            i3 = np.broadcast_to(np.eye(3, dtype=d1.dtype), (1,)*extra_shape + (3, 3))
         else:
-            i3 = np.eye(3)
+            i3 = np.eye(3, dtype=d1.dtype)
         v = vec_outer(d1, d1)
         # na shold have most of the extra_shape needed
         d2 = (i3 - v) / na[..., np.newaxis]
@@ -429,6 +433,7 @@ def vec_sin_cos_derivs(a, b, order=1, check_derivatives=False, zero_thresh=None)
     if order > 2:
         raise NotImplementedError("derivatives currently only up to order {}".format(2))
 
+    a, b = Options.cast(a), Options.cast(b)
     extra_dims = a.ndim - 1
 
     sin_derivs = []
@@ -511,12 +516,12 @@ def vec_sin_cos_derivs(a, b, order=1, check_derivatives=False, zero_thresh=None)
                     ))
 
         if extra_dims > 0:
-            e3 = np.broadcast_to(levi_cevita3,  extra_shape + (3, 3, 3))
+            e3 = np.broadcast_to(levi_cevita3.astype(a.dtype),  extra_shape + (3, 3, 3))
             td = np.tensordot
             outer = vec_outer
             vec_td = lambda a, b, **kw: vec_tensordot(a, b, shared=extra_dims, **kw)
         else:
-            e3 = levi_cevita3
+            e3 = levi_cevita3.astype(a.dtype)
             td = np.tensordot
             vec_td = lambda a, b, **kw: vec_tensordot(a, b, shared=0, **kw)
             outer = np.outer
@@ -622,6 +627,7 @@ def vec_angle_derivs(a, b, order=1, up_vectors=None, zero_thresh=None):
     if order > 2:
         raise NotImplementedError("derivatives currently only up to order {}".format(2))
 
+    a, b = Options.cast(a), Options.cast(b)
     derivs = []
 
     sin_derivs, cos_derivs = vec_sin_cos_derivs(a, b, order=order, zero_thresh=zero_thresh)
@@ -641,9 +647,9 @@ def vec_angle_derivs(a, b, order=1, up_vectors=None, zero_thresh=None):
         # up[np.abs(up) < zero_thresh] = 0.
         sign = np.sign(up)
     else:
-        sign = np.ones(a.shape[:-1])
+        sign = np.ones(a.shape[:-1], dtype=q.dtype)
 
-    derivs.append(sign*q)
+    derivs.append(sign[..., np.newaxis]*q)
 
     if order >= 1:
         # d = sin_derivs[1]
@@ -742,7 +748,8 @@ def dist_deriv(coords, i, j, order=1, zero_thresh=None):
     if order > 2:
         raise NotImplementedError("derivatives currently only up to order {}".format(2))
 
-    a = coords[j] - coords[i]
+    coords = Options.cast(coords)
+    a = coords[..., j, :] - coords[..., i, :]
     d = vec_norm_derivs(a, order=order, zero_thresh=zero_thresh)
 
     derivs = []
@@ -783,6 +790,7 @@ def angle_deriv(coords, i, j, k, order=1, zero_thresh=None):
     if order > 2:
         raise NotImplementedError("derivatives currently only up to order {}".format(2))
 
+    coords = Options.cast(coords)
     a = coords[..., j, :] - coords[..., i, :]
     b = coords[..., k, :] - coords[..., i, :]
     d = vec_angle_derivs(a, b, order=order, zero_thresh=zero_thresh)
@@ -832,6 +840,7 @@ def dihed_deriv(coords, i, j, k, l, order=1, zero_thresh=None, zero_point_step_s
     if order > 2:
         raise NotImplementedError("derivatives currently only up to order {}".format(2))
 
+    coords = Options.cast(coords)
     a = coords[..., j, :] - coords[..., i, :]
     b = coords[..., k, :] - coords[..., j, :]
     c = coords[..., l, :] - coords[..., k, :]
@@ -930,9 +939,9 @@ def dihed_deriv(coords, i, j, k, l, order=1, zero_thresh=None, zero_point_step_s
         extra_shape = a.shape[:-1]
         dot = lambda x, y, axes=(-1, -2) : vec_tensordot(x, y, axes=axes, shared=extra_dims)
         if extra_dims > 0:
-            e3 = np.broadcast_to(levi_cevita3,  extra_shape + levi_cevita3.shape)
+            e3 = np.broadcast_to(levi_cevita3.astype(a.dtype),  extra_shape + levi_cevita3.shape)
         else:
-            e3 = levi_cevita3
+            e3 = levi_cevita3.astype(a.dtype)
 
         Ca = dot(e3, a, axes=[-1, -1])
         Cb = dot(e3, b, axes=[-1, -1])
@@ -978,6 +987,92 @@ def dihed_deriv(coords, i, j, k, l, order=1, zero_thresh=None, zero_point_step_s
 
     return derivs
 
+def internal_coordinate_tensors(coords, specs, order=2, zero_thresh=None):
+    """
+    Evaluates bond lengths (`(i, j)`), angles (`(i, j, k)`, centered on `j`),
+    and dihedrals (`(i, j, k, l)`, with the sign convention of `pts_dihedrals`)
+    along with their Cartesian derivatives for many specs and configurations at once.
+    The derivatives are returned as `SparseArray`s with shapes `coords.shape[:-2] + (3N, len(specs))`
+    and `coords.shape[:-2] + (3N, 3N, len(specs))`, i.e. the first one is the transpose of the Wilson B-matrix
+
+    :param coords: the coordinates, with the atoms and xyz components along the last two axes
+    :type coords: np.ndarray
+    :param specs: the index tuples for each coordinate
+    :type specs: Iterable[Iterable[int]] | np.ndarray
+    :param order: the highest derivative order to compute
+    :type order: int
+    :return: the values and derivative tensors
+    :rtype: list[np.ndarray | SparseArray]
+    """
+
+    if order > 2:
+        raise NotImplementedError("derivatives currently only up to order {}".format(2))
+
+    coords = np.asanyarray(Options.cast(coords))
+    base_shape = coords.shape[:-2]
+    natoms = coords.shape[-2]
+    coords = coords.reshape((-1, natoms, 3))
+    nconf = coords.shape[0]
+    values = internal_coordinates(coords, specs, zero_thresh=zero_thresh)
+    specs, sizes = _prep_internal_specs(specs)
+    nspec = len(specs)
+    ncart = 3 * natoms
+
+    derivs = [values.reshape(base_shape + (nspec,))]
+    if order == 0:
+        return derivs
+
+    confs = np.arange(nconf)
+    xyz = np.arange(3)
+    terms = [[] for _ in range(order)]
+    for n, deriv in [(2, dist_deriv), (3, angle_deriv), (4, dihed_deriv)]:
+        pos = np.where(sizes == n)[0]
+        if len(pos) == 0:
+            continue
+        atoms = specs[pos, :n]
+        if n == 3: # `angle_deriv` takes the central atom first
+            atoms = atoms[:, (1, 0, 2)]
+        d = deriv(coords, *atoms.T, order=order, zero_thresh=zero_thresh)
+        sign = -1 if n == 4 else 1 # `dihed_deriv` gives the derivatives of `-pts_dihedrals`
+
+        # d[1] has shape (n, nconf, m, 3)
+        carts = 3 * atoms.T[:, np.newaxis, :, np.newaxis] + xyz
+        d1 = d[1].reshape((n, nconf, len(pos), 3))
+        terms[0].append([
+            np.broadcast_to(x, d1.shape).flatten() for x in (
+                confs[np.newaxis, :, np.newaxis, np.newaxis],
+                carts,
+                pos[np.newaxis, np.newaxis, :, np.newaxis],
+                sign * d1
+            )
+        ])
+
+        if order > 1:
+            # d[2] has shape (n, n, nconf, m, 3, 3)
+            d2 = d[2].reshape((n, n, nconf, len(pos), 3, 3))
+            terms[1].append([
+                np.broadcast_to(x, d2.shape).flatten() for x in (
+                    confs[np.newaxis, np.newaxis, :, np.newaxis, np.newaxis, np.newaxis],
+                    carts[:, np.newaxis, :, :, :, np.newaxis],
+                    carts[np.newaxis, :, :, :, np.newaxis, :],
+                    pos[np.newaxis, np.newaxis, np.newaxis, :, np.newaxis, np.newaxis],
+                    sign * d2
+                )
+            ])
+
+    for o, blocks in enumerate(terms):
+        shape = base_shape + (ncart,) * (o + 1) + (nspec,)
+        if len(blocks) > 0:
+            *inds, vals = [np.concatenate(x) for x in zip(*blocks)]
+        if len(blocks) == 0 or len(vals) == 0: # no specs or no configurations
+            derivs.append(SparseArray.empty(shape, dtype=values.dtype))
+            continue
+        conf_inds = np.unravel_index(inds[0], base_shape) if len(base_shape) > 0 else ()
+        inds = np.array(tuple(conf_inds) + tuple(inds[1:]))
+        derivs.append(SparseArray.from_data((vals, inds), shape=shape))
+
+    return derivs
+
 # debug implementations
 # def dist_deriv(coords, i, j, order=1):
 #     """
@@ -3,10 +3,13 @@
 """
 
 import numpy as np
+from .TransformationMatrices import quaternion_multiply, quaternion_matrix, quaternion_from_matrix
 
 __all__ = [
     "euler_angles",
-    "euler_matrix"
+    "euler_matrix",
+    "euler_quaternion",
+    "quaternion_euler_angles"
 ]
 
 # I pulled a bunch of Euler matrices for diferent conventions out of Mathematica with the
@@ -94,7 +97,9 @@ def euler_matrix(angles, ordering="xyz"):
     if ordering in euler_mat_map:
         mat_gen = euler_mat_map[ordering]
     else:
-        raise KeyError("Euler matrix for ordering '{}' not yet supported".format(ordering))
+        # every other ordering goes through the quaternions, laid out like the hard coded matrices
+        mats = quaternion_matrix(euler_quaternion(np.moveaxis(np.asanyarray(angles), 0, -1), ordering))
+        return np.moveaxis(mats, (-2, -1), (0, 1))
     c = np.cos(angles)
     s = np.sin(angles)
     return mat_gen(c, s)
@@ -102,11 +107,102 @@ def euler_matrix(angles, ordering="xyz"):
 def euler_angles(basis, ordering="xyz"):
     """Calculates the Euler angles for the basis
 
-    :param basis: the basis to get the Euler angles for
+    :param basis: the basis (or stack of bases) to get the Euler angles for
     :type basis: np.ndarray
+    :return: the angles, stacked along the last axis
+    :rtype: np.ndarray
     """
-    if ordering in euler_mat_map:
-        ang_gen = euler_mat_map[ordering]
+    return quaternion_euler_angles(quaternion_from_matrix(basis), ordering)
+
+# Everything else is handled generically through quaternions, which lets us work with
+# whole stacks of frames at once and with any of the twelve axis orderings
+
+_euler_axes = {"x": 0, "y": 1, "z": 2}
+def _euler_ordering(ordering):
+    ordering = ordering.lower()
+    if (
+            len(ordering) != 3
+            or any(a not in _euler_axes for a in ordering)
+            or ordering[0] == ordering[1]
+            or ordering[1] == ordering[2]
+    ):
+        raise KeyError("Euler ordering '{}' not valid".format(ordering))
+    return tuple(_euler_axes[a] for a in ordering)
+
+def euler_quaternion(angles, ordering="xyz"):
+    """Returns the unit quaternions for the Euler angles (stacked along the last axis),
+    using the same convention as `euler_matrix`, i.e. the matrix for `ordering="xyz"` is
+    `R_x(angles[..., 0]) @ R_y(angles[..., 1]) @ R_z(angles[..., 2])`
+
+    :param angles:
+    :type angles: np.ndarray
+    :param ordering: the order in which the rotations should be performed
+    :type ordering: str
+    :return:
+    :rtype: np.ndarray
+    """
+    axes = _euler_ordering(ordering)
+    angles = np.asanyarray(angles)
+    dtype = np.result_type(angles.dtype, np.float16)
+    half = angles.astype(dtype, copy=False) / 2
+    c = np.cos(half)
+    s = np.sin(half)
+
+    quat = None
+    for n, ax in enumerate(axes):
+        q = np.zeros(angles.shape[:-1] + (4,), dtype=dtype)
+        q[..., 0] = c[..., n]
+        q[..., 1 + ax] = s[..., n]
+        quat = q if quat is None else quaternion_multiply(quat, q)
+    return quat
+
+def quaternion_euler_angles(quats, ordering="xyz", zero_thresh=1e-7):
+    """Calculates the Euler angles (in the `euler_matrix` convention) for a stack of unit quaternions,
+    following the direct method of Bernardes and Viollet (PLoS ONE 17, e0276302).
+    In gimbal lock the first angle is set to zero.
+
+    :param quats:
+    :type quats: np.ndarray
+    :param ordering: the order in which the rotations are performed
+    :type ordering: str
+    :param zero_thresh: the tolerance for detecting gimbal lock
+    :type zero_thresh: float
+    :return: the angles, stacked along the last axis, each in `[-pi, pi]`
+    :rtype: np.ndarray
+    """
+    # the method is formulated for extrinsic rotations, so we reverse the ordering
+    k, j, i = _euler_ordering(ordering)
+    proper = i == k
+    if proper:
+        k = 3 - i - j
+    sign = (i - j) * (j - k) * (k - i) // 2
+
+    quats = np.asanyarray(quats)
+    dtype = np.result_type(quats.dtype, np.float16)
+    quats = quats.astype(dtype, copy=False)
+    w = quats[..., 0]
+    qi, qj, qk = quats[..., 1 + i], quats[..., 1 + j], quats[..., 1 + k]
+    if proper:
+        a, b, c, d = w, qi, qj, qk * sign
     else:
-        raise KeyError("Euler matrix for orientation '{}' not yet supported".format(ordering))
-    return ang_gen(basis)
\ No newline at end of file
+        a, b, c, d = w - qj, qi + qk * sign, qj + w, qk * sign - qi
+
+    angles = np.empty(quats.shape[:-1] + (3,), dtype=dtype)
+    angles[..., 1] = 2 * np.arctan2(np.hypot(c, d), np.hypot(a, b))
+    half_sum = np.arctan2(b, a)
+    half_diff = np.arctan2(d, c)
+    locked_0 = np.abs(angles[..., 1]) <= zero_thresh
+    locked_pi = np.abs(angles[..., 1] - np.pi) <= zero_thresh
+    locked = np.logical_or(locked_0, locked_pi)
+    angles[..., 0] = np.where(locked_0, 2 * half_sum,
+                              np.where(locked_pi, -2 * half_diff, half_sum - half_diff))
+    angles[..., 2] = np.where(locked, 0, half_sum + half_diff)
+    if not proper:
+        angles[..., 2] *= sign
+        angles[..., 1] -= np.pi / 2
+
+    # back to the intrinsic ordering
+    angles = angles[..., ::-1]
+    angles[angles < -np.pi] += 2 * np.pi
+    angles[angles > np.pi] -= 2 * np.pi
+    return angles
\ No newline at end of file
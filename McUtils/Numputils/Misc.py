@@ -6,6 +6,8 @@ __all__ = [
     'infer_int_dtype',
     'flatten_dtype',
     'unflatten_dtype',
+    'RowPacking',
+    'BitPacking',
     'recast_permutation',
     'recast_indices',
     'downcast_index_array',
@@ -91,6 +93,225 @@ def flatten_dtype(ar, dtype=None):
 
     return consolidated, dtype, orig_shape, orig_dtype
 
+class RowPacking:
+    """
+    Packs rows of small-range integers into single `uint64` keys by
+    bit-shifting each (offset) column into its own field, with the first
+    column in the most significant bits so that the keys sort like the rows.
+    Rows that fall outside the detected ranges are all mapped to a single
+    sentinel key that can't match any in-range row.
+    """
+    enabled = True
+    max_bits = 63 # leaves room for the sentinel
+
+    def __init__(self, mins, bits, dtype):
+        self.mins = np.asanyarray(mins, dtype=np.int64)
+        self.maxs = self.mins + ((np.ones(len(bits), dtype=np.int64) << bits) - 1)
+        self.bits = np.asanyarray(bits, dtype=np.uint64)
+        self.shifts = np.flip(np.concatenate([[0], np.cumsum(np.flip(self.bits))[:-1]])).astype(np.uint64)
+        self.total_bits = int(np.sum(self.bits))
+        self.sentinel = np.uint64(1) << np.uint64(self.total_bits)
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def from_array(cls, ar, *others):
+        """
+        Detects the column ranges of `ar` (and any `others` that will be compared with it)
+        and returns a packing if the rows fit into a single key (and `None` otherwise)
+
+        :param ar:
+        :type ar: np.ndarray
+        :return:
+        :rtype: RowPacking | None
+        """
+        arrays = [np.asanyarray(a) for a in (ar,) + others]
+        ar = arrays[0]
+        if not cls.enabled or ar.dtype.kind not in 'iub' or ar.ndim < 2:
+            return None
+        arrays = [a.reshape(a.shape[0], int(np.prod(a.shape[1:], dtype=int))) for a in arrays]
+        if arrays[0].shape[1] == 0 or any(a.shape[1] != arrays[0].shape[1] for a in arrays):
+            return None
+        arrays = [a for a in arrays if len(a) > 0]
+        if len(arrays) == 0 or any(a.dtype.kind not in 'iub' for a in arrays):
+            return None
+        mins = np.min([np.min(a, axis=0) for a in arrays], axis=0).astype(np.int64)
+        maxs = np.max([np.max(a, axis=0) for a in arrays], axis=0)
+        if np.any(maxs > np.iinfo(np.int64).max):
+            return None
+        bits = np.array([int(r).bit_length() for r in maxs.astype(np.int64) - mins], dtype=np.int64)
+        if np.sum(bits) > cls.max_bits:
+            return None
+        return cls(mins, bits, ar.dtype)
+
+    def pack(self, ar):
+        """
+        Packs the rows of `ar` into keys
+
+        :param ar:
+        :type ar: np.ndarray
+        :return:
+        :rtype: np.ndarray
+        """
+        ar = np.asanyarray(ar)
+        ar = ar.reshape(ar.shape[0], int(np.prod(ar.shape[1:], dtype=int))).astype(np.int64)
+        if ar.shape[1] != len(self.bits):
+            raise ValueError("can't pack rows of length {} with packing for rows of length {}".format(
+                ar.shape[1], len(self.bits)
+            ))
+        ar = ar - self.mins[np.newaxis]
+        keys = np.zeros(len(ar), dtype=np.uint64)
+        for i, s in enumerate(self.shifts):
+            keys |= ar[:, i].astype(np.uint64) << s
+        bad = np.any(np.logical_or(ar < 0, ar > (self.maxs - self.mins)[np.newaxis]), axis=1)
+        if bad.any():
+            keys[bad] = self.sentinel
+        return keys
+
+    def unpack(self, keys):
+        """
+        Converts packed keys back into rows
+
+        :param keys:
+        :type keys: np.ndarray
+        :return:
+        :rtype: np.ndarray
+        """
+        keys = np.asanyarray(keys, dtype=np.uint64)
+        rows = np.empty((len(keys), len(self.bits)), dtype=np.int64)
+        for i, (b, s) in enumerate(zip(self.bits, self.shifts)):
+            mask = (np.uint64(1) << b) - np.uint64(1)
+            rows[:, i] = ((keys >> s) & mask).astype(np.int64)
+        rows += self.mins[np.newaxis]
+        return rows.astype(self.dtype)
+
+class BitPacking:
+    """
+    Packs rows of small non-negative integers into rows of bytes using
+    a fixed number of bits per column.
+    Unlike `RowPacking` rows can be arbitrarily long, since each row
+    takes up as many bytes as it needs.
+    Columns are written most significant bit first, so packed rows
+    (viewed through `flatten`) sort like the original rows.
+    """
+    block_size = 2**16 # rows packed at once, bounds the size of the bit temporaries
+
+    def __init__(self, row_length, bits, dtype='int8'):
+        self.row_length = row_length
+        self.bits = int(bits)
+        self.dtype = np.dtype(dtype)
+        self.row_bits = self.row_length * self.bits
+        self.row_bytes = (self.row_bits + 7) // 8
+        self.max_value = (1 << self.bits) - 1
+        self._pack_dtype = np.min_scalar_type(self.max_value)
+        self._bit_shifts = np.arange(self.bits - 1, -1, -1, dtype=np.uint8)
+        self._flat_dtype = [('f{i}'.format(i=i), np.uint8) for i in range(self.row_bytes)]
+
+    def __repr__(self):
+        return "{}({}, bits={})".format(type(self).__name__, self.row_length, self.bits)
+
+    @classmethod
+    def from_max_value(cls, row_length, max_value, dtype='int8', min_bits=1):
+        """
+        Returns a packing with enough bits to hold values up through `max_value`,
+        rounded up to a power of two number of bits
+
+        :param row_length:
+        :type row_length: int
+        :param max_value:
+        :type max_value: int
+        :param min_bits:
+        :type min_bits: int
+        :return:
+        :rtype: BitPacking
+        """
+        bits = max(min_bits, int(max_value).bit_length())
+        bits = 1 << (bits - 1).bit_length()
+        return cls(row_length, bits, dtype=dtype)
+
+    def in_range(self, ar):
+        """
+        Returns a mask of the rows of `ar` that can be packed
+
+        :param ar:
+        :type ar: np.ndarray
+        :return:
+        :rtype: np.ndarray
+        """
+        ar = np.asanyarray(ar)
+        return np.all(np.logical_and(ar >= 0, ar <= self.max_value), axis=1)
+
+    def pack(self, ar):
+        """
+        Packs the rows of `ar` into rows of `row_bytes` bytes
+
+        :param ar:
+        :type ar: np.ndarray
+        :return:
+        :rtype: np.ndarray
+        """
+        ar = np.asanyarray(ar)
+        if ar.ndim != 2 or ar.shape[1] != self.row_length:
+            raise ValueError("can't pack array of shape {} with packing for rows of length {}".format(
+                ar.shape, self.row_length
+            ))
+        if len(ar) > 0 and (np.min(ar) < 0 or np.max(ar) > self.max_value):
+            raise ValueError("can't pack values outside the range [0, {}] into {} bits".format(
+                self.max_value, self.bits
+            ))
+        packed = np.empty((len(ar), self.row_bytes), dtype=np.uint8)
+        for start in range(0, len(ar), self.block_size):
+            block = ar[start:start + self.block_size].astype(self._pack_dtype)
+            bits = (block[:, :, np.newaxis] >> self._bit_shifts) & 1
+            packed[start:start + self.block_size] = np.packbits(bits.reshape(len(block), self.row_bits), axis=1)
+        return packed
+
+    def unpack(self, packed):
+        """
+        Converts packed rows back into rows of integers
+
+        :param packed:
+        :type packed: np.ndarray
+        :return:
+        :rtype: np.ndarray
+        """
+        packed = np.asanyarray(packed)
+        if packed.dtype.names is not None:
+            packed = self.unflatten(packed)
+        smol = packed.ndim == 1
+        if smol:
+            packed = packed[np.newaxis]
+        rows = np.zeros((len(packed), self.row_length), dtype=self.dtype)
+        for start in range(0, len(packed), self.block_size):
+            bits = np.unpackbits(packed[start:start + self.block_size], axis=1, count=self.row_bits)
+            bits = bits.reshape(len(bits), self.row_length, self.bits)
+            rows[start:start + self.block_size] = np.dot(bits, (1 << self._bit_shifts.astype(int)))
+        if smol:
+            rows = rows[0]
+        return rows
+
+    def flatten(self, packed):
+        """
+        Views packed rows as a 1D array of compound elements for set operations
+
+        :param packed:
+        :type packed: np.ndarray
+        :return:
+        :rtype: np.ndarray
+        """
+        return flatten_dtype(packed, dtype=self._flat_dtype)[0]
+
+    def unflatten(self, flat):
+        """
+        Converts flattened packed rows back to a 2D byte array
+
+        :param flat:
+        :type flat: np.ndarray
+        :return:
+        :rtype: np.ndarray
+        """
+        flat = np.asanyarray(flat)
+        return unflatten_dtype(flat, (len(flat), self.row_bytes), np.uint8)
+
 def unflatten_dtype(consolidated, orig_shape, orig_dtype, axis=None):
     """
     Converts a coerced array back to a full array
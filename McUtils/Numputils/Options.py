@@ -8,6 +8,23 @@ __all__ = [
 
 import numpy as np
 
+class PrecisionPolicy:
+    """
+    A context manager that temporarily sets the working and accumulation dtypes on `Options`
+    """
+    def __init__(self, opts, dtype, accumulation_dtype=None):
+        self.opts = opts
+        self.dtype = dtype
+        self.accumulation_dtype = accumulation_dtype
+        self._prev = None
+    def __enter__(self):
+        self._prev = (self.opts.DTYPE, self.opts.ACCUMULATION_DTYPE)
+        self.opts.dtype = self.dtype
+        self.opts.accumulation_dtype = self.accumulation_dtype
+        return self.opts
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.opts.DTYPE, self.opts.ACCUMULATION_DTYPE = self._prev
+
 class OptionsContainer:
     """
     A singleton Options object that can be used to configure options for numerical stuff
@@ -16,6 +33,8 @@ class OptionsContainer:
     NORM_ZERO_THRESH = None
     ZERO_THRESHOLD = 1.0e-17
     ZERO_PLACEHOLDER = None
+    DTYPE = None
+    ACCUMULATION_DTYPE = None
 
     @property
     def zero_threshold(self):
@@ -45,6 +64,77 @@ class OptionsContainer:
     def zero_placeholder(self, v):
         self.ZERO_PLACEHOLDER = v
 
+    @property
+    def dtype(self):
+        """
+        The working dtype the geometry kernels (vector ops, transformation matrices, analytic derivatives)
+        cast their inputs to, or `None` to just let numpy promote as usual
+        """
+        return self.DTYPE
+    @dtype.setter
+    def dtype(self, v):
+        self.DTYPE = None if v is None else np.dtype(v)
+
+    @property
+    def accumulation_dtype(self):
+        """
+        The dtype that dot products and norms are accumulated in before being cast back to the working dtype
+        """
+        if self.ACCUMULATION_DTYPE is None:
+            return self.dtype
+        else:
+            return self.ACCUMULATION_DTYPE
+    @accumulation_dtype.setter
+    def accumulation_dtype(self, v):
+        self.ACCUMULATION_DTYPE = None if v is None else np.dtype(v)
+
+    def precision(self, dtype, accumulation_dtype=np.float64):
+        """
+        Returns a context manager that runs the geometry kernels in `dtype`, accumulating
+        sums of products in `accumulation_dtype`, e.g.
+
+            with Options.precision('float32'):
+                angs = pts_angles(a, b, c)
+
+        For `float32` (unit roundoff `u = 2**-24 ~ 6e-8`) with `float64` accumulation the differences
+        from a pure `float64` evaluation (including the rounding of the inputs) are roughly bounded by
+
+        * dot products `a.b` and norms `|a|`: `2u |a||b|` and `2u |a|`, independent of the vector length
+        * normalized vectors, cross products, rotation matrices: `4u` relative to their norms
+        * angles: `4u/sin(theta)` absolute, i.e. `~1e-6` rad away from (anti)collinear configurations
+        * dihedrals: `10u/(sin(theta_1) sin(theta_2))` absolute, with `theta_i` the two bond angles involved
+        * analytic derivative tensors: `10u` relative (in norm) at first order and `1e-5` relative at second order
+          for well-conditioned geometries, degrading like the inverse square of those sines for the dihedrals
+
+        The dtype policy only changes how inputs are cast and how reductions are accumulated;
+        when no policy is set the kernels follow numpy's usual promotion rules and `float32` inputs
+        stay in `float32` with `float32` accumulation.
+
+        :param dtype: the working dtype
+        :type dtype: str | np.dtype
+        :param accumulation_dtype: the dtype to accumulate reductions in (`None` to use the working dtype)
+        :type accumulation_dtype: str | np.dtype | None
+        :return:
+        :rtype: PrecisionPolicy
+        """
+        return PrecisionPolicy(self, dtype, accumulation_dtype)
+
+    def cast(self, array):
+        """
+        Casts a numeric array to the working dtype, if one has been set
+
+        :param array:
+        :type array: np.ndarray
+        :return:
+        :rtype: np.ndarray
+        """
+        if self.DTYPE is None or array is None:
+            return array
+        array = np.asanyarray(array)
+        if array.dtype.kind in 'iuf' and array.dtype != self.DTYPE:
+            array = array.astype(self.DTYPE)
+        return array
+
 Options = OptionsContainer()
 Options.__name__ = "Options"
 Options.__doc__ = OptionsContainer.__doc__
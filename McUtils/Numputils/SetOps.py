@@ -3,8 +3,9 @@ Provides customized set operations based off of the NumPy builtins
 to minimize things like excess sorts
 """
 
-import numpy as np
-from .Misc import flatten_dtype, unflatten_dtype, recast_permutation, recast_indices, downcast_index_array
+import numpy as np, os, shutil, tempfile as tf
+from ..Misc import jit, import_from_numba
+from .Misc import flatten_dtype, unflatten_dtype, recast_permutation, recast_indices, downcast_index_array, RowPacking
 
 __all__ = [
     'unique',
@@ -14,11 +15,51 @@ __all__ = [
     'find',
     'argsort',
     'group_by',
-    'split_by_regions'
+    'split_by_regions',
+    'group_by_chunked',
+    'split_by_regions_chunked',
+    'merge_sorted_runs',
+    'SortedIndex'
 ]
 
-coerce_dtype = flatten_dtype
-uncoerce_dtype = unflatten_dtype
+def coerce_dtype(ar, dtype=None):
+    """
+    Coerces `ar` into a 1D array of row keys, packing small-range integer rows
+    into `uint64`s where possible and falling back to a compound dtype otherwise
+    """
+    if dtype is None:
+        packing = RowPacking.from_array(ar)
+        if packing is not None:
+            return packing.pack(ar), packing, ar.shape, ar.dtype
+    elif isinstance(dtype, RowPacking):
+        return dtype.pack(ar), dtype, ar.shape, ar.dtype
+    return flatten_dtype(ar, dtype=dtype)
+
+def coerce_dtypes(ar1, ar2):
+    """
+    Coerces a pair of arrays into comparable row keys
+    """
+    packing = RowPacking.from_array(ar1, ar2)
+    if packing is None:
+        ar1, dtype, orig_shape1, orig_dtype1 = flatten_dtype(ar1)
+        ar2, dtype, orig_shape2, orig_dtype2 = flatten_dtype(ar2, dtype=dtype)
+    else:
+        dtype = packing
+        ar1, orig_shape1, orig_dtype1 = packing.pack(ar1), ar1.shape, ar1.dtype
+        ar2, orig_shape2, orig_dtype2 = packing.pack(ar2), ar2.shape, ar2.dtype
+    return (ar1, ar2), dtype, (orig_shape1, orig_shape2), (orig_dtype1, orig_dtype2)
+
+def uncoerce_dtype(consolidated, orig_shape, orig_dtype, axis=None, dtype=None):
+    """
+    Converts coerced row keys back to a full array
+    """
+    if isinstance(dtype, RowPacking):
+        uniq = dtype.unpack(consolidated).astype(orig_dtype)
+        uniq = uniq.reshape(len(consolidated), *orig_shape[1:])
+        if axis is not None:
+            uniq = np.moveaxis(uniq, 0, axis)
+        return uniq
+    return unflatten_dtype(consolidated, orig_shape, orig_dtype, axis)
 
 def argsort(ar):
     ar = np.asanyarray(ar)
@@ -26,13 +67,184 @@ def argsort(ar):
         ar, _, _, _ = coerce_dtype(ar)
     return recast_permutation(np.argsort(ar, kind='mergesort'))
 
+#region Hash Tables
+
+def hash_available():
+    """
+    Whether or not the compiled hash-table set operations can be used
+    (i.e. if Numba is installed and hasn't been turned off)
+    """
+    return import_from_numba('njit', None) is not None
+
+def _hash_keys(ar):
+    """
+    Converts an integer array (or an array of integer rows that fit into a single machine word)
+    into a 1D `int64` array of keys, returning `None` if that can't be done
+    """
+    ar = np.asanyarray(ar)
+    if ar.dtype.kind not in 'iub':
+        return None
+    if ar.ndim == 1:
+        keys = ar
+    else:
+        ar = np.ascontiguousarray(ar.reshape(ar.shape[0], -1))
+        width = ar.dtype.itemsize * ar.shape[1]
+        if width not in (1, 2, 4, 8):
+            return None
+        keys = ar.view('u{}'.format(width)).reshape(-1)
+    if keys.dtype.itemsize == 8:
+        return keys.view(np.int64)
+    else:
+        return keys.astype(np.int64)
+
+def _hash_bits(n):
+    return max(3, int(2*n - 1).bit_length())
+
+@jit(nopython=True, cache=True)
+def _hash_insert(keys, bits):
+    """
+    Builds an open-addressing (linear probing) table over `keys`
+    using Fibonacci hashing. The table holds positions in the list of unique keys.
+    """
+    n = len(keys)
+    size = 1 << bits
+    table = np.full(size, -1, dtype=np.int64)
+    shift = np.uint64(64 - bits)
+    mult = np.uint64(11400714819323198485)
+    first = np.empty(n, dtype=np.int64)
+    inverse = np.empty(n, dtype=np.int64)
+    counts = np.zeros(n, dtype=np.int64)
+    m = 0
+    for i in range(n):
+        k = keys[i]
+        slot = np.int64((np.uint64(k) * mult) >> shift)
+        while True:
+            j = table[slot]
+            if j == -1:
+                table[slot] = m
+                first[m] = i
+                inverse[i] = m
+                counts[m] = 1
+                m += 1
+                break
+            elif keys[first[j]] == k:
+                inverse[i] = j
+                counts[j] += 1
+                break
+            slot = (slot + 1) & (size - 1)
+    return table, first[:m], inverse, counts[:m]
+
+@jit(nopython=True, cache=True)
+def _hash_lookup(table, keys, first, bits, queries):
+    """
+    Finds the position of each query in the list of unique keys in `table` (or -1)
+    """
+    size = 1 << bits
+    shift = np.uint64(64 - bits)
+    mult = np.uint64(11400714819323198485)
+    res = np.full(len(queries), -1, dtype=np.int64)
+    for i in range(len(queries)):
+        q = queries[i]
+        slot = np.int64((np.uint64(q) * mult) >> shift)
+        while True:
+            j = table[slot]
+            if j == -1:
+                break
+            elif keys[first[j]] == q:
+                res[i] = j
+                break
+            slot = (slot + 1) & (size - 1)
+    return res
+
+class HashIndex:
+    """
+    A hash table over the rows of an integer array
+    """
+    def __init__(self, ar, keys=None):
+        self.ar = None if ar is None else np.asanyarray(ar)
+        self.keys = _hash_keys(self.ar) if keys is None else keys
+        if self.keys is None:
+            raise ValueError("can't hash array with dtype {} and shape {}".format(self.ar.dtype, self.ar.shape))
+        self.bits = _hash_bits(len(self.keys))
+        self.table, self.first, self.inverse, self.counts = _hash_insert(self.keys, self.bits)
+    def lookup(self, keys):
+        """
+        Returns the positions of `keys` in the list of unique rows (or -1)
+        """
+        return _hash_lookup(self.table, self.keys, self.first, self.bits, keys)
+
+def _lex_order(ar):
+    if ar.ndim == 1:
+        return np.argsort(ar, kind='mergesort')
+    else:
+        ar = ar.reshape(ar.shape[0], -1)
+        return np.lexsort(ar.T[::-1])
+
+def _hash_unique(ar, keys, return_index=False, return_inverse=False, return_counts=False):
+    idx = HashIndex(ar, keys=keys)
+    order = _lex_order(ar[idx.first,])
+    first = idx.first[order]
+    ret = (ar[first,], None)
+    if return_index:
+        ret += (first,)
+    if return_inverse:
+        rank = np.empty(len(order), dtype=np.intp)
+        rank[order] = np.arange(len(order))
+        ret += (rank[idx.inverse],)
+    if return_counts:
+        ret += (idx.counts[order],)
+    return ret
+
+def _hash_contained(keys1, keys2, invert=False):
+    pos = HashIndex(None, keys=keys2).lookup(keys1)
+    if invert:
+        return pos < 0
+    else:
+        return pos >= 0
+
+def _hash_intersection(ar1, keys1, keys2, return_indices=False):
+    idx1 = HashIndex(ar1, keys=keys1)
+    idx2 = HashIndex(None, keys=keys2)
+    pos = idx2.lookup(keys1[idx1.first])
+    common = pos >= 0
+    inds1 = idx1.first[common]
+    inds2 = idx2.first[pos[common]]
+    order = _lex_order(ar1[inds1,])
+    inds1 = inds1[order]
+    ret = (ar1[inds1,], None, None)
+    if return_indices:
+        ret += (inds1, inds2[order])
+    return ret
+
+def _prep_hash_keys(*arrays):
+    if not hash_available():
+        return None
+    keys = [_hash_keys(a) for a in arrays]
+    if any(k is None for k in keys):
+        # rows too wide for a single word may still pack into one
+        packing = RowPacking.from_array(*arrays)
+        if packing is None:
+            return None
+        keys = [packing.pack(a).view(np.int64) for a in arrays]
+    return keys
+
+#endregion
+
 def unique(ar, return_index=False, return_inverse=False,
-           return_counts=False, axis=0, sorting=None, minimal_dtype=False):
+           return_counts=False, axis=0, sorting=None, minimal_dtype=False, method=None):
     """
-    A variant on np.unique with default support for `axis=0` and sorting
+    A variant on np.unique with default support for `axis=0` and sorting.
+    With `method='hash'` integer arrays (and integer rows that fit into a single word)
+    are deduplicated with a hash table, which doesn't provide a `sorting`
     """
 
     ar = np.asanyarray(ar)
+    if method == 'hash' and axis == 0 and sorting is None:
+        keys = _prep_hash_keys(ar)
+        if keys is not None:
+            return _hash_unique(ar, keys[0],
+                                return_index=return_index, return_inverse=return_inverse, return_counts=return_counts
+                                )
     if ar.ndim == 1:
         ret = unique1d(ar, return_index=return_index, return_inverse=return_inverse,
                        return_counts=return_counts, sorting=sorting, minimal_dtype=minimal_dtype)
@@ -51,7 +263,7 @@ def unique(ar, return_index=False, return_inverse=False,
     output = unique1d(consolidated,
                                 return_index=return_index, return_inverse=return_inverse,
                                 return_counts=return_counts, sorting=sorting, minimal_dtype=minimal_dtype)
-    output = (uncoerce_dtype(output[0], orig_shape, orig_dtype, axis),) + output[1:]
+    output = (uncoerce_dtype(output[0], orig_shape, orig_dtype, axis, dtype=dtype),) + output[1:]
     return output
 
 def unique1d(ar, return_index=False, return_inverse=False,
@@ -87,7 +299,7 @@ def unique1d(ar, return_index=False, return_inverse=False,
 
 def intersection(ar1, ar2,
                 assume_unique=False, return_indices=False,
-                sortings=None, union_sorting=None, minimal_dtype=False
+                sortings=None, union_sorting=None, minimal_dtype=False, method=None
                 ):
 
     ar1 = np.asanyarray(ar1)
@@ -98,16 +310,20 @@ def intersection(ar1, ar2,
     elif ar1.dtype < ar2.dtype:
         ar2 = ar2.astype(ar1.dtype)
 
+    if method == 'hash' and sortings is None:
+        keys = _prep_hash_keys(ar1, ar2)
+        if keys is not None:
+            return _hash_intersection(ar1, keys[0], keys[1], return_indices=return_indices)
+
     if ar1.ndim == 1:
         ret = intersect1d(ar1, ar2, assume_unique=assume_unique, return_indices=return_indices,
                           sortings=sortings, union_sorting=union_sorting, minimal_dtype=minimal_dtype)
         return ret
 
-    ar1, dtype, orig_shape1, orig_dtype1 = coerce_dtype(ar1)
-    ar2, dtype, orig_shape2, orig_dtype2 = coerce_dtype(ar2, dtype=dtype)
+    (ar1, ar2), dtype, (orig_shape1, orig_shape2), (orig_dtype1, orig_dtype2) = coerce_dtypes(ar1, ar2)
     output = intersect1d(ar1, ar2, assume_unique=assume_unique, return_indices=return_indices,
                           sortings=sortings, union_sorting=union_sorting)
-    output = (uncoerce_dtype(output[0], orig_shape1, orig_dtype1, None),) + output[1:]
+    output = (uncoerce_dtype(output[0], orig_shape1, orig_dtype1, None, dtype=dtype),) + output[1:]
     return output
 
 def intersect1d(ar1, ar2,
@@ -165,6 +381,8 @@ def contained(ar1, ar2, assume_unique=False, invert=False,
                 sortings=None, union_sorting=None, method=None):
     """
     Test whether each element of `ar1` is also present in `ar2`.
+    `method='hash'` builds a hash table over `ar2` instead of sorting, in which case
+    no sortings are returned
     """
 
     # Ravel both arrays, behavior for the first array could be different
@@ -176,9 +394,14 @@ def contained(ar1, ar2, assume_unique=False, invert=False,
     elif ar2.dtype < ar1.dtype:
         ar2 = ar2.astype(ar1.dtype)
 
+    if method == 'hash':
+        keys = _prep_hash_keys(ar1, ar2)
+        if keys is not None:
+            return _hash_contained(keys[0], keys[1], invert=invert), None, None
+        method = None
+
     if ar1.ndim > 1:
-        ar1, dtype, orig_shape1, orig_dtype1 = coerce_dtype(ar1)
-        ar2, dtype, orig_shape2, orig_dtype2 = coerce_dtype(ar2, dtype=dtype)
+        (ar1, ar2), dtype, (orig_shape1, orig_shape2), (orig_dtype1, orig_dtype2) = coerce_dtypes(ar1, ar2)
 
     # Check if one of the arrays may contain arbitrary objects
     contains_object = ar1.dtype.hasobject or ar2.dtype.hasobject
@@ -269,16 +492,26 @@ def difference(ar1, ar2, assume_unique=False, sortings=None, method=None, union_
     elif ar2.dtype < ar1.dtype:
         ar2 = ar2.astype(ar1.dtype)
 
+    if method == 'hash' and sortings is None:
+        keys = _prep_hash_keys(ar1, ar2)
+        if keys is not None:
+            if not assume_unique:
+                ar1, _, first = _hash_unique(ar1, keys[0], return_index=True)
+                keys1 = keys[0][first]
+            else:
+                keys1 = keys[0]
+            return ar1[_hash_contained(keys1, keys[1], invert=True),], None, None
+        method = None
+
     if ar1.ndim == 1:
         ret = difference1d(ar1, ar2, assume_unique=assume_unique, method=method,
                           sortings=sortings, union_sorting=union_sorting)
         return ret
 
-    ar1, dtype, orig_shape1, orig_dtype1 = coerce_dtype(ar1)
-    ar2, dtype, orig_shape2, orig_dtype2 = coerce_dtype(ar2, dtype=dtype)
+    (ar1, ar2), dtype, (orig_shape1, orig_shape2), (orig_dtype1, orig_dtype2) = coerce_dtypes(ar1, ar2)
     output = difference1d(ar1, ar2, assume_unique=assume_unique, method=method,
                           sortings=sortings, union_sorting=union_sorting)
-    output = (uncoerce_dtype(output[0], orig_shape1, orig_dtype1, None),) + output[1:]
+    output = (uncoerce_dtype(output[0], orig_shape1, orig_dtype1, None, dtype=dtype),) + output[1:]
     return output
 
 def difference1d(ar1, ar2, assume_unique=False, sortings=None, method=None, union_sorting=None):
@@ -392,8 +625,7 @@ def find(ar, to_find, sorting=None,
                      )
         return ret
 
-    ar, dtype, orig_shape1, orig_dtype1 = coerce_dtype(ar)
-    to_find, dtype, orig_shape2, orig_dtype2 = coerce_dtype(to_find, dtype=dtype)
+    (ar, to_find), dtype, (orig_shape1, orig_shape2), (orig_dtype1, orig_dtype2) = coerce_dtypes(ar, to_find)
     output = find1d(ar, to_find, sorting=sorting, check=check,
                      search_space_sorting=search_space_sorting,
                      return_search_space_sorting=return_search_space_sorting,
@@ -447,7 +679,7 @@ def group_by(ar, keys, sorting=None, return_indices=False):
     keys, dtype, orig_shape, orig_dtype = coerce_dtype(keys)
     output = group_by1d(ar, keys, sorting=sorting, return_indices=return_indices)
     ukeys, groups = output[0]
-    ukeys = uncoerce_dtype(ukeys, orig_shape, orig_dtype, None)
+    ukeys = uncoerce_dtype(ukeys, orig_shape, orig_dtype, None, dtype=dtype)
     output = ((ukeys, groups),) + output[1:]
     return output
 
@@ -507,7 +739,429 @@ def split_by_regions(ar, regions, sortings=None, return_indices=False):
     regions, dtype, orig_shape1, orig_dtype1 = coerce_dtype(ar, dtype=dtype)
     output = split_by_regions1d(regions, ar, sortings=sortings, return_indices=return_indices)
     uinds, groups = output[0]
-    groups = uncoerce_dtype(groups, orig_shape, orig_dtype, None)
+    groups = uncoerce_dtype(groups, orig_shape, orig_dtype, None, dtype=dtype)
     output = ((uinds, groups),) + output[1:]
 
     return output
+
+def _external_sort(keys, values, chunk_size=2**20, spill_dir=None):
+    """
+    Sorts `keys` (and `values` along with them) a chunk at a time, spilling the sorted
+    runs to memmaps and then merging them, yielding sorted `(keys, values)` blocks.
+    The sort is stable, so equal keys stay in their original order.
+    """
+
+    n = len(keys)
+    if n <= chunk_size:
+        keys = np.asarray(keys[:]) # slicing so lazily coerced keys are coerced as a block
+        values = np.asarray(values)
+        sorting = np.argsort(keys, kind='mergesort')
+        yield keys[sorting], values[sorting]
+        return
+
+    run_dir = tf.mkdtemp(dir=spill_dir)
+    try:
+        runs = []
+        for i, start in enumerate(range(0, n, chunk_size)):
+            k = np.asarray(keys[start:start + chunk_size])
+            v = np.asarray(values[start:start + chunk_size])
+            sorting = np.argsort(k, kind='mergesort')
+            run_keys = np.lib.format.open_memmap(os.path.join(run_dir, 'keys_{}.npy'.format(i)),
+                                                 mode='w+', dtype=k.dtype, shape=k.shape)
+            run_vals = np.lib.format.open_memmap(os.path.join(run_dir, 'vals_{}.npy'.format(i)),
+                                                 mode='w+', dtype=v.dtype, shape=v.shape)
+            run_keys[:] = k[sorting]
+            run_vals[:] = v[sorting]
+            runs.append((run_keys, run_vals))
+        del k, v, sorting
+
+        block_size = max(chunk_size // len(runs), 1)
+        pos = [0] * len(runs)
+        while True:
+            live = [i for i in range(len(runs)) if pos[i] < len(runs[i][0])]
+            if len(live) == 0:
+                break
+
+            # everything below the smallest "last loaded key" can be safely merged
+            # (keys equal to it might continue past the loaded blocks)
+            blocks = {i: np.asarray(runs[i][0][pos[i]:pos[i] + block_size]) for i in live}
+            partial = [blocks[i][-1:] for i in live if pos[i] + block_size < len(runs[i][0])]
+            cut = np.sort(np.concatenate(partial))[0] if len(partial) > 0 else None
+
+            merged_keys = []
+            merged_vals = []
+            for i in live:
+                b = blocks[i]
+                m = len(b) if cut is None else np.searchsorted(b, cut, side='left')
+                if m > 0:
+                    merged_keys.append(b[:m])
+                    merged_vals.append(np.asarray(runs[i][1][pos[i]:pos[i] + m]))
+                pos[i] += m
+
+            if len(merged_keys) == 0:
+                # every block starts at the cut, so we drain that key run by run to stay stable
+                for i in live:
+                    while pos[i] < len(runs[i][0]):
+                        b = np.asarray(runs[i][0][pos[i]:pos[i] + block_size])
+                        m = np.searchsorted(b, cut, side='right')
+                        if m > 0:
+                            merged_keys.append(b[:m])
+                            merged_vals.append(np.asarray(runs[i][1][pos[i]:pos[i] + m]))
+                        pos[i] += m
+                        if m < len(b):
+                            break
+                yield np.concatenate(merged_keys), np.concatenate(merged_vals)
+                continue
+
+            merged_keys = np.concatenate(merged_keys)
+            sorting = np.argsort(merged_keys, kind='mergesort')
+            yield merged_keys[sorting], np.concatenate(merged_vals)[sorting]
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+def _stream_groups(blocks, labeler):
+    """
+    Splits sorted `(keys, values)` blocks into runs of equal labels, holding back the
+    last run of each block since it can continue into the next
+    """
+    carry = None
+    for keys, vals in blocks:
+        labels = labeler(keys)
+        if carry is not None:
+            labels = np.concatenate([carry[0], labels])
+            vals = np.concatenate([carry[1], vals])
+        if len(labels) == 0:
+            continue
+        starts = np.concatenate([[0], np.nonzero(labels[1:] != labels[:-1])[0] + 1])
+        for s, e in zip(starts[:-1], starts[1:]):
+            yield labels[s], vals[s:e]
+        carry = (labels[starts[-1]:], vals[starts[-1]:])
+    if carry is not None:
+        yield carry[0][0], carry[1]
+
+def group_by_chunked(ar, keys, chunk_size=2**20, spill_dir=None):
+    """
+    An out-of-core variant of `group_by` that works on (possibly memory mapped) arrays
+    too large to sort in memory, externally sorting the keys a chunk at a time
+    and streaming out the groups in sorted key order
+
+    :param ar: the values to group
+    :type ar: np.ndarray
+    :param keys: the keys to group by (rows of keys are compared lexicographically)
+    :type keys: np.ndarray
+    :param chunk_size: the number of elements to sort in memory at once
+    :type chunk_size: int
+    :param spill_dir: where to write the sorted runs
+    :type spill_dir: str | None
+    :return: generator of `(key, group)` pairs
+    :rtype: Iterator[tuple[Any, np.ndarray]]
+    """
+
+    ar = np.asanyarray(ar)
+    keys = np.asanyarray(keys)
+    if len(ar) != len(keys):
+        raise ValueError("need one key per element ({}); got {}".format(len(ar), len(keys)))
+
+    row_keys = None
+    if keys.ndim > 1:
+        chunks = [keys[s:s + chunk_size] for s in range(0, len(keys), chunk_size)]
+        packing = RowPacking.from_array(*chunks)
+        if packing is None:
+            packing = flatten_dtype(keys[:1])[1]
+        row_keys = _CoercedKeys(keys, packing)
+        keys = row_keys
+
+    blocks = _external_sort(keys, ar, chunk_size=chunk_size, spill_dir=spill_dir)
+    for key, group in _stream_groups(blocks, lambda k: k):
+        if row_keys is not None:
+            key = row_keys.uncoerce(key)
+        yield key, group
+
+def split_by_regions_chunked(regions, ar, chunk_size=2**20, spill_dir=None):
+    """
+    An out-of-core variant of `split_by_regions` for 1D arrays that externally
+    sorts `ar` a chunk at a time and streams out the sorted elements
+    falling in each region.
+    Like `split_by_regions` this takes the region edges first.
+
+    :param regions: the region edges
+    :type regions: np.ndarray
+    :param ar: the values to split
+    :type ar: np.ndarray
+    :param chunk_size: the number of elements to sort in memory at once
+    :type chunk_size: int
+    :param spill_dir: where to write the sorted runs
+    :type spill_dir: str | None
+    :return: generator of `(region index, group)` pairs
+    :rtype: Iterator[tuple[int, np.ndarray]]
+    """
+
+    ar = np.asanyarray(ar)
+    if ar.ndim > 1:
+        raise ValueError("chunked region splits are only supported for 1D arrays")
+    regions = np.sort(np.asanyarray(regions))
+    blocks = _external_sort(ar, ar, chunk_size=chunk_size, spill_dir=spill_dir)
+    for idx, group in _stream_groups(blocks, lambda k: np.searchsorted(regions, k)):
+        yield idx, group
+
+class _CoercedKeys:
+    """
+    Lazily coerces slices of a (memory mapped) array of key rows
+    """
+    def __init__(self, keys, dtype):
+        self.keys = keys
+        self.dtype = dtype
+    def __len__(self):
+        return len(self.keys)
+    def __getitem__(self, item):
+        keys = self.keys[item]
+        if isinstance(self.dtype, RowPacking):
+            return self.dtype.pack(keys)
+        else:
+            return flatten_dtype(np.asarray(keys), dtype=self.dtype)[0]
+    def uncoerce(self, key):
+        return uncoerce_dtype(np.array([key]), (1,) + self.keys.shape[1:], self.keys.dtype, dtype=self.dtype)[0]
+
+def merge_sorted_runs(runs, values=None, chunk_size=2**20, reduction=np.add):
+    """
+    Performs a k-way merge of sorted, individually unique 1D runs (which can be memory mapped),
+    yielding the merged keys a block at a time so that the full merge never
+    has to be held in memory.
+    Keys that show up in multiple runs are combined (along with their values)
+    by `reduction` and a key never spans more than one block.
+
+    :param runs: the sorted key arrays
+    :type runs: Iterable[np.ndarray]
+    :param values: the values associated with each run
+    :type values: Iterable[np.ndarray] | None
+    :param chunk_size: the number of elements to pull from each run at a time
+    :type chunk_size: int
+    :param reduction: the ufunc used to combine values for duplicate keys
+    :type reduction: np.ufunc
+    :return: generator of unique key blocks (or key/value blocks)
+    :rtype: Iterator[np.ndarray | tuple[np.ndarray, np.ndarray]]
+    """
+
+    runs = list(runs)
+    if values is not None:
+        values = list(values)
+        if len(values) != len(runs):
+            raise ValueError("need one set of values per run ({}); got {}".format(len(runs), len(values)))
+    pos = [0] * len(runs)
+    lens = [len(r) for r in runs]
+
+    while True:
+        live = [i for i in range(len(runs)) if pos[i] < lens[i]]
+        if len(live) == 0:
+            break
+
+        # everything up to the smallest "last loaded key" can be safely merged
+        blocks = {i: np.asarray(runs[i][pos[i]:pos[i] + chunk_size]) for i in live}
+        partial = [blocks[i][-1] for i in live if pos[i] + chunk_size < lens[i]]
+        cut = min(partial) if len(partial) > 0 else None
+
+        keys = []
+        vals = []
+        for i in live:
+            b = blocks[i]
+            n = len(b) if cut is None else np.searchsorted(b, cut, side='right')
+            if n > 0:
+                keys.append(b[:n])
+                if values is not None:
+                    vals.append(np.asarray(values[i][pos[i]:pos[i] + n]))
+            pos[i] += n
+
+        keys = np.concatenate(keys)
+        sorting = np.argsort(keys, kind='mergesort')
+        keys = keys[sorting]
+        mask = np.empty(keys.shape, dtype=np.bool_)
+        mask[:1] = True
+        mask[1:] = keys[1:] != keys[:-1]
+        if values is not None:
+            vals = np.concatenate(vals)[sorting]
+            if not mask.all():
+                vals = reduction.reduceat(vals, np.nonzero(mask)[0])
+            yield keys[mask], vals
+        else:
+            yield keys[mask]
+
+class SortedIndex:
+    """
+    Wraps an array (or array of rows) with its sorting so that repeated
+    `find`/`contains`/`intersection`/`difference` queries against it
+    only need a `searchsorted` rather than a fresh sort
+    """
+
+    def __init__(self, ar, sorting=None):
+        """
+        :param ar: the array to index, with rows along the first axis
+        :type ar: np.ndarray
+        :param sorting: a precomputed (stable) sorting for `ar`
+        :type sorting: np.ndarray | None
+        """
+        ar = np.asanyarray(ar)
+        self._orig_dtype = ar.dtype
+        self._orig_shape = ar.shape
+        self._keys, self._dtype = self._coerce(ar)
+        if sorting is None:
+            sorting = np.argsort(self._keys, kind='mergesort')
+        self.sorting = sorting
+        self._sorted = self._keys[sorting]
+
+    def _coerce(self, ar, dtype=None):
+        # packed keys can't grow to fit inserted rows, so we stick to compound dtypes
+        if ar.ndim > 1:
+            ar, dtype, _, _ = flatten_dtype(ar, dtype=dtype)
+        return ar, dtype
+    def _prep(self, ar):
+        ar = np.asanyarray(ar)
+        if ar.dtype != self._orig_dtype:
+            if np.can_cast(ar.dtype, self._orig_dtype):
+                ar = ar.astype(self._orig_dtype)
+            else:
+                self._promote(np.promote_types(ar.dtype, self._orig_dtype))
+                ar = ar.astype(self._orig_dtype)
+        if ar.ndim == 0 or ar.shape[1:] != self._orig_shape[1:]:
+            if ar.shape == self._orig_shape[1:]: # a single element or row
+                ar = ar[np.newaxis]
+            else:
+                raise ValueError("can't query {} with array of shape {}".format(self, ar.shape))
+        ar, _ = self._coerce(ar, dtype=self._dtype)
+        return ar
+    def _promote(self, dtype):
+        # upcasting preserves the ordering, so the sorting can be reused as is
+        self._keys, self._dtype = self._coerce(self.array.astype(dtype))
+        self._orig_dtype = np.dtype(dtype)
+        self._sorted = self._keys[self.sorting]
+    def _uncoerce(self, keys):
+        if self._dtype is not None:
+            keys = unflatten_dtype(keys, (len(keys),) + self._orig_shape[1:], self._orig_dtype)
+        return keys
+
+    def __len__(self):
+        return len(self._keys)
+    def __repr__(self):
+        return "{}(<{}>, dtype={})".format(type(self).__name__, len(self), self._orig_dtype)
+
+    @property
+    def array(self):
+        """
+        The indexed array in its original order
+        """
+        return self._uncoerce(self._keys)
+    @property
+    def unique(self):
+        """
+        The sorted, unique elements of the index
+        """
+        mask = np.empty(len(self._sorted), dtype=bool)
+        mask[:1] = True
+        mask[1:] = self._sorted[1:] != self._sorted[:-1]
+        return self._uncoerce(self._sorted[mask])
+
+    def _search(self, keys):
+        pos = np.searchsorted(self._sorted, keys)
+        found = pos < len(self._sorted)
+        found[found] = self._sorted[pos[found]] == keys[found]
+        return pos, found
+
+    def find(self, to_find, missing_val='raise'):
+        """
+        Finds the positions of `to_find` in the original array (the first ones, for repeated elements)
+
+        :param to_find: the elements to look up
+        :type to_find: np.ndarray | int
+        :param missing_val: the value to use for elements that aren't found or `'raise'`
+        :type missing_val: int | str
+        :return: the positions of the elements (a single position for a scalar query)
+        :rtype: np.ndarray | int
+        """
+        keys = self._prep(to_find)
+        pos, found = self._search(keys)
+        vals = np.full(len(keys), -1, dtype=self.sorting.dtype)
+        vals[found] = self.sorting[pos[found]]
+        if not found.all():
+            if isinstance(missing_val, str) and missing_val == 'raise':
+                raise IndexError("{} not in index".format(np.atleast_1d(to_find)[~found,]))
+            vals[~found] = missing_val
+        if np.ndim(to_find) == 0:
+            vals = vals[0]
+        return vals
+
+    def contains(self, to_find, invert=False):
+        """
+        Tests whether each element of `to_find` is in the index
+
+        :param to_find: the elements to test
+        :type to_find: np.ndarray | int
+        :param invert: whether to test for absence instead
+        :type invert: bool
+        :return: the membership mask (a single flag for a scalar query)
+        :rtype: np.ndarray | bool
+        """
+        keys = self._prep(to_find)
+        _, found = self._search(keys)
+        if invert:
+            found = np.logical_not(found)
+        if np.ndim(to_find) == 0:
+            found = found[0]
+        return found
+
+    def intersection(self, other, return_indices=False):
+        """
+        Finds the sorted, unique elements common to the index and `other`
+
+        :param other: the elements to intersect with
+        :type other: np.ndarray
+        :param return_indices: whether to return the positions of the common elements in the index and `other`
+        :type return_indices: bool
+        :return: the intersection and optionally the indices
+        :rtype: np.ndarray | tuple[np.ndarray, np.ndarray, np.ndarray]
+        """
+        keys = self._prep(other)
+        uniq, first = np.unique(keys, return_index=True)
+        pos, found = self._search(uniq)
+        common = uniq[found]
+        res = self._uncoerce(common)
+        if return_indices:
+            res = (res, self.sorting[pos[found]], first[found])
+        return res
+
+    def difference(self, other):
+        """
+        Finds the sorted, unique elements of the index that aren't in `other`
+
+        :param other: the elements to remove
+        :type other: np.ndarray
+        :return: the difference
+        :rtype: np.ndarray
+        """
+        keys = np.unique(self._prep(other))
+        uniq = self.unique
+        uniq_keys, _ = self._coerce(uniq, dtype=self._dtype)
+        pos = np.searchsorted(keys, uniq_keys)
+        found = pos < len(keys)
+        found[found] = keys[pos[found]] == uniq_keys[found]
+        return uniq[np.logical_not(found),]
+
+    def insert(self, values):
+        """
+        Adds `values` to the index, merging them into the existing sorted
+        view rather than resorting everything
+
+        :param values: the elements to add
+        :type values: np.ndarray
+        :return: the index
+        :rtype: SortedIndex
+        """
+        keys = self._prep(values)
+        n = len(self._keys)
+        new_sorting = np.argsort(keys, kind='mergesort')
+        new_keys = keys[new_sorting]
+        # `side='right'` keeps the original elements ahead of equal new ones
+        pos = np.searchsorted(self._sorted, new_keys, side='right')
+        self._sorted = np.insert(self._sorted, pos, new_keys)
+        self.sorting = np.insert(self.sorting.astype(np.promote_types(self.sorting.dtype, np.intp)), pos, new_sorting + n)
+        self._keys = np.concatenate([self._keys, keys])
+        self._orig_shape = (len(self._keys),) + self._orig_shape[1:]
+        return self
@@ -1,12 +1,16 @@
-import numpy as np, scipy.sparse as sp, itertools as ip, functools as fp, os, abc, gc
-from ..Scaffolding import MaxSizeCache, Logger
-from .SetOps import contained, unique as nput_unique, find
+import numpy as np, scipy.sparse as sp, itertools as ip, functools as fp, os, abc, gc, weakref
+from ..Scaffolding import ArrayCache, Logger
+from ..Parallelizers import Parallelizer, SerialNonParallelizer
+from .SetOps import contained, unique as nput_unique, find, merge_sorted_runs
 from .Misc import infer_inds_dtype, downcast_index_array
 
 __all__ = [
     "SparseArray",
     "ScipySparseArray",
+    "CSFSparseArray",
     "TensorFlowSparseArray",
+    "SparseAccumulator",
+    "SparseTensordotPlan",
     "sparse_tensordot"
 ]
 
@@ -34,7 +38,7 @@ class SparseArray(metaclass=abc.ABCMeta):
         :rtype:
         """
         if cls.backends is None:
-            return (('scipy', ScipySparseArray),)
+            return (('scipy', ScipySparseArray), ('csf', CSFSparseArray))
         else:
             return cls.backends
 
@@ -60,10 +64,11 @@ class SparseArray(metaclass=abc.ABCMeta):
         backend_errors = []
         backends = cls.get_backends()
         for name,backend in backends:
-            if target_backend is not None and name == target_backend:
-                if constructor is not None:
-                    backend = getattr(backend, constructor)
-                return backend(data, **kwargs)
+            if target_backend is not None:
+                if name == target_backend:
+                    if constructor is not None:
+                        backend = getattr(backend, constructor)
+                    return backend(data, **kwargs)
             else:
                 try:
                     if constructor is not None:
@@ -112,6 +117,25 @@ class SparseArray(metaclass=abc.ABCMeta):
         """
         raise NotImplementedError("{}.{} is an abstract method".format(cls.__name__, 'from_diagonal_data'))
         ...
+    @classmethod
+    def open_mmap(cls, file, mode='r', **kwargs):
+        """
+        A wrapper so that we can dispatch to the best
+        sparse backend we've got defined when loading an
+        array from an uncompressed, memory-mappable layout
+
+        :param file: the directory the array was saved to
+        :type file: str
+        :param mode: the `np.memmap` mode to open the buffers with
+        :type mode: str
+        :return:
+        :rtype: SparseArray
+        """
+        return cls.from_data(file,
+                             constructor='load_mmap',
+                             mode=mode,
+                             **kwargs
+                             )
     @property
     @abc.abstractmethod
     def shape(self):
@@ -351,6 +375,8 @@ class SparseArray(metaclass=abc.ABCMeta):
         return self.true_multiply(other)
 
     def _bcast_shapes(self, other):
+        if isinstance(other, np.ndarray) and other.ndim < self.ndim:
+            other = other.reshape((1,) * (self.ndim - other.ndim) + other.shape)
         if other.ndim != self.ndim:
             raise NotImplementedError("{} object only supports broadcasting when `ndims` align".format(
                 type(self).__name__
@@ -370,6 +396,7 @@ class SparseArray(metaclass=abc.ABCMeta):
                     other.shape
                 ))
 
+        total_shape = tuple(total_shape)
         if total_shape != self.shape:
             self = self.broadcast_to(total_shape)
 
@@ -535,6 +562,24 @@ class SparseArray(metaclass=abc.ABCMeta):
             if caching_status:
                 self.enable_caches()
 
+    @classmethod
+    def plan_tensordot(cls, a_pattern, b_pattern, axes=2):
+        """
+        Does the symbolic part of a tensordot (output pattern and the index
+        maps into each operand) once so that contractions of arrays with the same
+        sparsity patterns only have to do the numeric part
+
+        :param a_pattern: an array with the sparsity pattern of the left operand
+        :type a_pattern: SparseArray
+        :param b_pattern: an array with the sparsity pattern of the right operand
+        :type b_pattern: SparseArray
+        :param axes: the axes to contract along
+        :type axes: int | Iterable[int] | Iterable[Iterable[int]]
+        :return:
+        :rtype: SparseTensordotPlan
+        """
+        return SparseTensordotPlan(a_pattern, b_pattern, axes=axes)
+
     # TODO: Caching should be managed by keeping track of 'parent' `SparseArray`
     #       objects using a weakref so that it's possible to just ask the parents
     #       if they have the data we need in their caches and then all caches
@@ -558,7 +603,7 @@ class SparseArray(metaclass=abc.ABCMeta):
                 self.parent.disable_caches()
             self.cache_status = None
             if self.clear:
-                self.parent.clear_caches()
+                self.parent.clear_cache()
     @classmethod
     def cache_options(self, enabled=True, clear=False):
         return self.cacheing_manager(self, enabled=enabled, clear=clear)
@@ -687,6 +732,8 @@ class ScipySparseArray(SparseArray):
         self._block_data_sorted = False
         self._block_inds = None # cached to speed things up
         self._block_vals = None # cached to speed things up
+        self._view = None # (base, transposition) for lazy transposes/reshapes
+        self._dependent_views = None # lazy views onto this array that haven't been materialized
         self.logger = logger
         if initialize:
             cache_block_data = self.get_caching_status() if cache_block_data is None else cache_block_data
@@ -730,7 +777,10 @@ class ScipySparseArray(SparseArray):
             sorting = np.arange(ij_inds.shape[1])
 
         if memmap:
-            raise NotImplementedError("meh")
+            return cls._mmap_coo_to_cs(shape, vals, ij_inds, axis, other,
+                                       memmap if isinstance(memmap, str) else None,
+                                       assume_sorted=assume_sorted
+                                       )
         else:
             indptr = np.zeros(shape[axis] + 1, dtype=infer_inds_dtype(ij_inds.shape[1]+1))
             indices = ij_inds[other]#.astype(indptr.dtype)
@@ -768,6 +818,51 @@ class ScipySparseArray(SparseArray):
         # coo_tocsr(M, N, self.nnz, row, col, self.data,
         #           indptr, indices, data)
 
+    mmap_chunk_size = 2**22
+    @classmethod
+    def _mmap_coo_to_cs(cls, shape, vals, ij_inds, axis, other, mmap_dir, assume_sorted=False):
+        """
+        Builds the CSR/CSC buffers as `.npy` memmaps in `mmap_dir`, streaming through the
+        (possibly memory mapped) input a chunk at a time so that only `indptr`
+        (and the sorting, if the input isn't already sorted) has to be held in memory
+
+        :return:
+        :rtype:
+        """
+        import tempfile as tf
+
+        if mmap_dir is None:
+            mmap_dir = tf.mkdtemp()
+        os.makedirs(mmap_dir, exist_ok=True)
+
+        n = ij_inds.shape[1]
+        chunk = cls.mmap_chunk_size
+        # scipy will copy anything that isn't already its preferred index dtype
+        idx_dtype = np.int32 if max(n, max(shape)) < np.iinfo(np.int32).max else np.int64
+
+        indptr = np.zeros(shape[axis] + 1, dtype=idx_dtype)
+        for start in range(0, n, chunk):
+            # `bincount` won't take unsigned 64-bit indices
+            block = np.asarray(ij_inds[axis, start:start+chunk]).astype(np.intp, copy=False)
+            indptr[1:] += np.bincount(block, minlength=shape[axis]).astype(idx_dtype)
+        indptr = np.cumsum(indptr, out=indptr)
+
+        if assume_sorted:
+            sorting = None
+        else:
+            sorting = np.argsort(ij_inds[axis], kind='mergesort')
+
+        indices = np.lib.format.open_memmap(os.path.join(mmap_dir, 'indices.npy'), mode='w+', dtype=idx_dtype, shape=(n,))
+        data = np.lib.format.open_memmap(os.path.join(mmap_dir, 'data.npy'), mode='w+', dtype=vals.dtype, shape=(n,))
+        for start in range(0, n, chunk):
+            sel = slice(start, start+chunk) if sorting is None else sorting[start:start+chunk]
+            indices[start:start+chunk] = ij_inds[other][sel]
+            data[start:start+chunk] = vals[sel]
+        indices.flush()
+        data.flush()
+
+        return cls._init_cs(data, indices, indptr, shape)
+
     @classmethod
     # @profile
     def _init_cs(cls, vals, indices, indptr, shape):
@@ -847,14 +942,16 @@ class ScipySparseArray(SparseArray):
     # from memory_profiler import profile
     # @profile
     def _init_matrix(self, cache_block_data=True, init_kwargs=None):
+        if self._view is not None:
+            return self._materialize_view()
         a = self._a
         if isinstance(a, ScipySparseArray):
             if self.logger is not None:
                 self.logger.log_print("initializing from existing `SparseArray`", log_level=self.logger.LogLevel.Debug)
             if self.fmt is not a.fmt:
-                self._a = self.fmt(a._a, shape=a.shape)
+                self._a = self.fmt(a.data, shape=a.data.shape)
             else:
-                self._a = a._a
+                self._a = a.data
             shp = self._shape
             if shp is not None:
                 self.reshape(a.shape)
@@ -939,6 +1036,11 @@ class ScipySparseArray(SparseArray):
             block_inds = None
         else:
             block_inds = tuple(np.asanyarray(i) for i in block_inds)
+            if cls.compact_indices:
+                block_inds = tuple(
+                    i.astype(infer_inds_dtype(max(d - 1, 0)), copy=False)
+                    for i, d in zip(block_inds, shape)
+                )
             if isinstance(a, cls.initializer_list):
                 a[1] = None
             if len(block_inds) != len(shape):
@@ -951,7 +1053,7 @@ class ScipySparseArray(SparseArray):
             if logger is not None:
                 logger.log_print("calculating flat indices", log_level=logger.LogLevel.Debug)
 
-            flat = np.ravel_multi_index(block_inds, shape)  # no reason to cache this since we're going to sort it...
+            flat = cls._ravel(block_inds, shape)  # no reason to cache this since we're going to sort it...
             if cache_block_data:
                 if logger is not None:
                     logger.log_print("sorting cached data", log_level=logger.LogLevel.Debug)
@@ -1098,6 +1200,8 @@ class ScipySparseArray(SparseArray):
 
     @property
     def dtype(self):
+        if self._view is not None:
+            return self._view[0].dtype
         return self.data.dtype
 
     @property
@@ -1153,6 +1257,7 @@ class ScipySparseArray(SparseArray):
                 self.shape
             ))
         else:
+            self._detach_views()
             if new.format != self.data.format:
                 new = self.fmt(new)
             self._a = new
@@ -1189,10 +1294,13 @@ class ScipySparseArray(SparseArray):
         return len(self.shape)
     @property
     def non_zero_count(self):
+        if self._view is not None:
+            return self._view[0].non_zero_count
         return self.data.nnz
     # def __len__(self):
     #     return self.shape[0]
-    default_cache_size = 2
+    default_cache_size = None
+    default_cache_bytes = 2**27
     caching_enabled=True
     @classmethod
     def get_caching_status(cls):
@@ -1222,54 +1330,70 @@ class ScipySparseArray(SparseArray):
         cls.clear_ravel_caches()
     @classmethod
     def clear_ravel_caches(cls):
-        cls._unravel_cache = MaxSizeCache(cls.default_cache_size)
-        cls._ravel_cache = MaxSizeCache(cls.default_cache_size)
+        cls._unravel_cache = ArrayCache(max_bytes=cls.default_cache_bytes, max_items=cls.default_cache_size)
+        cls._ravel_cache = ArrayCache(max_bytes=cls.default_cache_bytes, max_items=cls.default_cache_size)
+    @classmethod
+    def get_ravel_cache_stats(cls):
+        """
+        Returns the hit/miss statistics of the ravel/unravel caches
+        so it's possible to tell if caching is actually paying off
+
+        :return:
+        :rtype: dict
+        """
+        return {'ravel': cls._ravel_cache.stats, 'unravel': cls._unravel_cache.stats}
 
     # this saves time when we have to do a bunch of reshaping into similarly sized arrays,
     # but won't help as much when the shape changes
-    _unravel_cache = MaxSizeCache(default_cache_size)  # hopefully faster than bunches of unravel_index calls...
+    _unravel_cache = ArrayCache(max_bytes=default_cache_bytes, max_items=default_cache_size)  # hopefully faster than bunches of unravel_index calls...
 
+    @classmethod
+    def _unravel(cls, n, dims):
+        if cls.compact_indices:
+            # each axis only gets as many bytes as its own size needs
+            return tuple(
+                x.astype(infer_inds_dtype(max(d - 1, 0)), copy=False)
+                for x, d in zip(np.unravel_index(n, dims), dims)
+            )
+        else:
+            minimal_dtype = infer_inds_dtype(np.max(dims))
+            return tuple(x.astype(minimal_dtype) for x in np.unravel_index(n, dims))
     @classmethod
     def _unravel_indices(cls, n, dims):
 
         # we're hoping that we call with `n` often enough that we get a performance benefit
         if not cls.caching_enabled:
-            minimal_dtype = infer_inds_dtype(np.max(dims))
-            res = tuple(x.astype(minimal_dtype) for x in np.unravel_index(n, dims))
-            return res
-        if dims not in cls._unravel_cache:
-            cls._unravel_cache[dims] = MaxSizeCache(cls.default_cache_size)
-        cache = cls._unravel_cache[dims]
-
-        if isinstance(n, np.ndarray):
-            n_hash = hash(n.data.tobytes())
-        else:
-            n_hash = hash(n)
+            return cls._unravel(n, dims)
+        if isinstance(dims, list):
+            dims = tuple(dims)
 
-        if n_hash in cache:
-            res = cache[n_hash]
-        else:
-            minimal_dtype = infer_inds_dtype(np.max(dims))
-            res = tuple(x.astype(minimal_dtype) for x in np.unravel_index(n, dims))
-            cache[n_hash] = res
+        key = (dims, cls.compact_indices, n)
+        res = cls._unravel_cache.get(key)
+        if res is None:
+            res = cls._unravel(n, dims)
+            cls._unravel_cache[key] = res
         return res
 
     # we cache the common ops...
     @classmethod
-    def set_ravel_cache_size(cls, size):
-        cls.default_cache_size = size
-        if cls._ravel_cache is None:
-            cls._ravel_cache = MaxSizeCache(size)
-        elif cls._ravel_cache.max_items != size:
-            cls._ravel_cache = MaxSizeCache(size)
-
-        if cls._unravel_cache is None:
-            cls._unravel_cache = MaxSizeCache(size)
-        elif cls._unravel_cache.max_items != size:
-            cls._unravel_cache = MaxSizeCache(size)
+    def set_ravel_cache_size(cls, size=None, max_bytes=None):
+        """
+        Resets the ravel/unravel caches with the given number of entries
+        and total byte budget
 
+        :param size: the maximum number of cached index arrays (`None` for no limit)
+        :type size: int | None
+        :param max_bytes: the maximum total size of the cached index arrays
+        :type max_bytes: int | None
+        :return:
+        :rtype:
+        """
+        cls.default_cache_size = size
+        if max_bytes is not None:
+            cls.default_cache_bytes = max_bytes
+        cls.clear_ravel_caches()
 
-    _ravel_cache = MaxSizeCache(default_cache_size)  # hopefully faster than bunches of ravel_index calls...
+    _ravel_cache = ArrayCache(max_bytes=default_cache_bytes, max_items=default_cache_size)  # hopefully faster than bunches of ravel_index calls...
     @classmethod
     def _ravel_indices(cls, mult, dims):
         # we're hoping that we call with `n` often enough that we get a performance benefit
@@ -1278,30 +1402,77 @@ class ScipySparseArray(SparseArray):
         # max_dtype = max(dtypes)
         # mult = tuple(m.astype(max_dtype) for m in mult)
         if not cls.caching_enabled:
-            return np.ravel_multi_index(mult, dims)
+            return cls._ravel(mult, dims)
         if isinstance(dims, list):
             dims = tuple(dims)
-        if dims not in cls._ravel_cache:
-            cls._ravel_cache[dims] = MaxSizeCache(cls.default_cache_size)
-        cache = cls._ravel_cache[dims]
-        if isinstance(mult[0], np.ndarray):
-            n_hash = hash(tuple(m.data.tobytes() for m in mult))
-        else:
-            try:
-                n_hash = hash(mult)
-            except TypeError:
-                # means hashing failed so we just shortcut out rather than try to be clever
-                # raise Exception([mult, dims])
-                return np.ravel_multi_index(mult, dims)
-        if n_hash in cache:
-            res = cache[n_hash]
-        else:
+        if isinstance(mult, list):
+            mult = tuple(mult)
+
+        key = (dims, cls.compact_indices, mult)
+        res = cls._ravel_cache.get(key)
+        if res is None:
             try:
-                res = np.ravel_multi_index(mult, dims)
+                res = cls._ravel(mult, dims)
             except:
                 raise Exception(mult, dims)
-            cache[n_hash] = res
+            cls._ravel_cache[key] = res
+        return res
+    @classmethod
+    def _ravel(cls, mult, dims):
+        res = np.ravel_multi_index(mult, dims)
+        if cls.compact_indices and isinstance(res, np.ndarray):
+            res = res.astype(cls._flat_index_dtype(dims), copy=False)
         return res
+    @staticmethod
+    def _flat_index_dtype(dims):
+        # signed, since mixing unsigned 64-bit indices with numpy's int64 ones promotes to float64
+        return np.dtype(np.int32) if int(np.prod(dims, dtype=object)) - 1 <= np.iinfo(np.int32).max else np.dtype(np.int64)
+
+    compact_indices = False
+    class compact_index_manager:
+        def __init__(self, parent, enabled=True):
+            self.parent = parent
+            self.enabled = enabled
+            self.status = None
+        def __enter__(self):
+            self.status = self.parent.compact_indices
+            self.parent.compact_indices = self.enabled
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            self.parent.compact_indices = self.status
+            self.status = None
+    @classmethod
+    def compact_index_options(cls, enabled=True):
+        """
+        Returns a context manager that turns compact index mode on (or off).
+        In compact mode the flat block indices are `int32` whenever the total size of the array
+        allows it and the per-axis indices use the smallest dtype
+        that can hold that axis, rather than promoting everything to `int64`
+
+        :param enabled:
+        :type enabled: bool
+        :return:
+        :rtype:
+        """
+        return cls.compact_index_manager(cls, enabled=enabled)
+    @property
+    def index_nbytes(self):
+        """
+        The number of bytes used by the cached block indices and
+        the index buffers of the underlying sparse matrix
+
+        :return:
+        :rtype: int
+        """
+        d = self.data
+        nbytes = sum(getattr(d, k).nbytes for k in ['indices', 'indptr', 'row', 'col'] if hasattr(d, k))
+        bi = self._block_inds
+        if bi is not None:
+            if isinstance(bi, np.ndarray):
+                nbytes += bi.nbytes
+            else:
+                flat, unflat = bi
+                nbytes += flat.nbytes + sum(u.nbytes for u in unflat)
+        return nbytes
 
     def _getinds(self):
         # pulled from tocoo except without the final conversion to COO...
@@ -1329,6 +1500,10 @@ class ScipySparseArray(SparseArray):
     # import memory_profiler
     # @memory_profiler.profile
     def _load_block_data(self):
+        if self._view is not None:
+            self._materialize_view()
+            if self._block_vals is not None and self._block_inds is not None:
+                return
         d = self.data
 
         row_inds, col_inds, data = self.find()
@@ -1337,7 +1512,8 @@ class ScipySparseArray(SparseArray):
         unflat = self._unravel_indices(flat, self.shape)
         self._block_inds = (flat, unflat)
         self._block_vals = data
-        self._block_data_sorted = True
+        # only CSR data comes out in row-major order
+        self._block_data_sorted = d.format == 'csr'
 
     def _load_full_block_inds(self):
         if self._block_inds.ndim == 1:
@@ -1426,10 +1602,66 @@ class ScipySparseArray(SparseArray):
 
     # import memory_profiler
     # @memory_profiler.profile
+    lazy_views = True
+    def _view_spec(self):
+        """
+        Returns the base array and transposition that this array
+        is a (lazy) view onto, if the view can be extended without materializing it
+
+        :return:
+        :rtype: (ScipySparseArray, tuple[int] | None)
+        """
+        if self._view is None:
+            return self, None
+        base, transp = self._view
+        base_shape = base.shape if transp is None else tuple(base.shape[i] for i in transp)
+        if base_shape != self._shape:
+            # there's a pending reshape, so further transpositions need to start from here
+            return self, None
+        return base, transp
+    def _make_view(self, base, transp, shape):
+        new = type(self)(None, shape=shape, layout=base._fmt, initialize=False)
+        new._view = (base, transp)
+        new._validated = True
+        new.logger = self.logger
+        if base._dependent_views is None:
+            base._dependent_views = weakref.WeakSet()
+        base._dependent_views.add(new)
+        return new
+    def _detach_views(self):
+        """
+        Materializes any outstanding lazy views onto this array so that
+        they keep the data they had when they were taken.
+        Needs to be called before the array is modified in place.
+        """
+        if self._dependent_views is not None:
+            views = list(self._dependent_views)
+            self._dependent_views = None
+            for v in views:
+                if v._view is not None and v._view[0] is self:
+                    v._materialize_view()
+    def _materialize_view(self):
+        """
+        Applies the pending transposition and reshape in one pass
+        """
+        base, transp = self._view
+        if transp is None:
+            new = base._reshape(self._shape)
+        else:
+            new = base._transpose(transp, shape=self._shape)
+        self._a = new._a
+        self._fmt = new._fmt
+        self._block_vals = new._block_vals
+        self._block_inds = new._block_inds
+        self._block_data_sorted = new._block_data_sorted
+        self._view = None
+
     def transpose(self, transp):
         """
         Transposes the array and returns a new one.
-        Not necessarily a cheap operation.
+        By default this returns a view which records the transposition
+        (merged with any transposition already pending on `self`)
+        and only rebuilds the data when it's actually needed.
 
         :param transp: the transposition to do
         :type transp: Iterable[int]
@@ -1437,14 +1669,40 @@ class ScipySparseArray(SparseArray):
         :rtype:
         """
 
-        # import time
-
-        shp = self.shape
-
         if len(transp) != self.ndim or np.any(np.sort(transp) != np.arange(self.ndim)):
             raise ValueError("transposition {} can't apply to shape {}".format(
                 transp, self.shape
             ))
+        if not self.lazy_views:
+            return self._transpose(transp)
+
+        base, base_transp = self._view_spec()
+        if base_transp is not None:
+            transp = [base_transp[i] for i in transp]
+        transp = tuple(int(i) for i in transp)
+        if transp == tuple(range(len(transp))):
+            transp = None
+
+        new_shape = base.shape if transp is None else tuple(base.shape[i] for i in transp)
+        return self._make_view(base, transp, new_shape)
+
+    def _transpose(self, transp, shape=None):
+        """
+        Transposes the array and returns a new one, optionally
+        reshaping the result in the same pass.
+        Not necessarily a cheap operation.
+
+        :param transp: the transposition to do
+        :type transp: Iterable[int]
+        :param shape: the shape to give the transposed array
+        :type shape: Iterable[int] | None
+        :return:
+        :rtype:
+        """
+
+        # import time
+
+        shp = self.shape
 
         track_data = self.get_caching_status()
         if self._block_vals is None:
@@ -1462,17 +1720,19 @@ class ScipySparseArray(SparseArray):
             new_inds = [inds[i] for i in transp]
 
         new_shape = tuple(shp[i] for i in transp)
+        final_shape = new_shape if shape is None else tuple(shape)
         if len(data) == 0:
-            return type(self).empty(new_shape, layout=self.fmt, dtype=data.dtype)
+            return type(self).empty(final_shape, layout=self.fmt, dtype=data.dtype)
 
-        if len(new_shape) > 2:
-            total_shape = self._get_balanced_shape(new_shape)
-            flat = self._ravel_indices(new_inds, new_shape)
-            unflat = self._unravel_indices(flat, total_shape)
-        else:
+        if len(final_shape) == 2 and final_shape == new_shape:
             flat = None
             unflat = new_inds
             total_shape = new_shape
+        else:
+            # raveling with the transposed shape gives the flat indices for any reshape of it too
+            total_shape = final_shape if len(final_shape) == 2 else self._get_balanced_shape(final_shape)
+            flat = self._ravel_indices(new_inds, new_shape)
+            unflat = self._unravel_indices(flat, total_shape)
 
         # time.sleep(.5)
         data = self._build_data(data, unflat, total_shape)
@@ -1483,7 +1743,7 @@ class ScipySparseArray(SparseArray):
             del total_shape
         # except MemoryError:
         #     raise Exception(data, unflat, new_shape, total_shape)
-        new = type(self)(data, shape=new_shape, layout=self.fmt, initialize=False) # this is tuned for SciPySparse array...
+        new = type(self)(data, shape=final_shape, layout=self.fmt, initialize=False) # this is tuned for SciPySparse array...
         # time.sleep(.5)
 
         if track_data:
@@ -1491,17 +1751,19 @@ class ScipySparseArray(SparseArray):
             if flat is not None:
                 arr = np.argsort(flat)
             else:
-                arr = np.lexsort(unflat)
+                arr = np.lexsort(unflat[::-1])
 
-            new_inds = [inds[arr] for inds in new_inds]
             if self._block_vals is not None:
                 new_v = self._block_vals[arr]
                 new._block_vals = new_v
             if flat is None:
-                new.block_inds = new_inds
-            else:
+                new.block_inds = [inds[arr] for inds in new_inds]
+            elif final_shape == new_shape:
                 # try:
-                new.block_inds = (flat[arr], new_inds)
+                new.block_inds = (flat[arr], [inds[arr] for inds in new_inds])
+            else:
+                flat = flat[arr]
+                new.block_inds = (flat, self._unravel_indices(flat, final_shape))
             new._block_data_sorted = True
                 # except:
                 #     raise Exception(new_shape, len(total_shape))
@@ -1564,6 +1826,9 @@ class ScipySparseArray(SparseArray):
     def reshape(self, shp):
         """
         Had to make this op not in-place because otherwise got scary errors...
+        By default this returns a view which gets merged with any pending transposition
+        and only materializes when the data are needed.
+
         :param shp:
         :type shp:
         :return:
@@ -1572,6 +1837,14 @@ class ScipySparseArray(SparseArray):
 
         if np.prod(shp) != np.prod(self.shape):
             raise ValueError("Can't reshape {} into {}".format(self.shape, shp))
+        if not self.lazy_views:
+            return self._reshape(shp)
+        if self._view is not None:
+            base, transp = self._view
+        else:
+            base, transp = self, None
+        return self._make_view(base, transp, tuple(shp))
+    def _reshape(self, shp):
         new = self.copy() # I'm not sure I want a whole copy here...?
         new._shape = tuple(shp)
 
@@ -1586,8 +1859,7 @@ class ScipySparseArray(SparseArray):
             new.data = new.data.reshape(shp)
         return new
     def squeeze(self):
-        self.reshape([x for x in self.shape if x != 1])
-        return self
+        return self.reshape([x for x in self.shape if x != 1])
 
     def resize(self, newsize):
         """
@@ -1620,14 +1892,30 @@ class ScipySparseArray(SparseArray):
 
         return type(self)((vals, inds), shape=newsize)
 
-    @staticmethod
-    def _concat_coo(all_inds, all_vals, all_shapes, axis):
+    @classmethod
+    def _concat_coo(cls, all_inds, all_vals, all_shapes, axis):
 
         full_vals = np.concatenate(all_vals)
 
         tot_shape = list(all_shapes[0])
         tot_shape[axis] = sum(a[axis] for a in all_shapes)
 
+        # make sure the offset indices along the concatenation axis don't overflow
+        # and keep the rest as small as possible in compact mode
+        if cls.compact_indices:
+            dtypes = [infer_inds_dtype(max(d - 1, 0)) for d in tot_shape]
+        else:
+            dtypes = [
+                np.promote_types(
+                    np.result_type(*[ind[i] for ind in all_inds]),
+                    infer_inds_dtype(d)
+                ) for i, d in enumerate(tot_shape)
+            ]
+        all_inds = [
+            tuple(np.asanyarray(x).astype(dt, copy=False) for x, dt in zip(ind, dtypes))
+            for ind in all_inds
+        ]
+
         # pull all the shapes along the concatenation axis
 
         # add the offset to each block along the concatenation axis
@@ -1849,7 +2137,18 @@ class ScipySparseArray(SparseArray):
         self._tocs()
         return self
 
-    def dot(self, b, reverse=False):
+    def dot(self, b, reverse=False, parallelizer=None):
+        """
+        Takes the dot product of self and b
+
+        :param b:
+        :type b:
+        :param parallelizer: if supplied, the rows of `self` are split into blocks which are
+        multiplied on the parallelizer's processes and restacked as a CSR matrix
+        :type parallelizer: Parallelizer | str | None
+        :return:
+        :rtype:
+        """
         self._tocs()
 
         bshp = b.shape
@@ -1871,16 +2170,21 @@ class ScipySparseArray(SparseArray):
             b = b.ascsr()
 
         try:
-            woof = a.dot(b)
+            if parallelizer is not None:
+                woof = parallel_sparse_dot(a, b, parallelizer)
+            else:
+                woof = a.dot(b)
         except ValueError as e:
             if e.args[0] == 'dimension mismatch':
                 raise ValueError("dimensions of tensors not aligned {} and {} incompatible".format(
                     a.shape,
                     b.shape
                 ))
+            else:
+                raise
 
         if isinstance(woof, sp.spmatrix):
-            return type(self)(a.dot(b))
+            return type(self)(woof)
         else:
             return woof
 
@@ -1895,6 +2199,8 @@ class ScipySparseArray(SparseArray):
     def __radd__(self, other):
         return self.plus(other)
     def plus(self, other, inplace=False):
+        if inplace:
+            self._detach_views()
         d = self.data
         if isinstance(other, (int, float, np.integer, np.floating)):
             if other == 0.:
@@ -1914,6 +2220,15 @@ class ScipySparseArray(SparseArray):
                         new._block_data_sorted = self._block_data_sorted
                     return new
 
+        if (
+                not inplace
+                and isinstance(other, ScipySparseArray)
+                and other.shape == self.shape
+                and other.data.shape != d.shape
+        ):
+            # avoid reshaping the scipy data by merging the sorted block data directly
+            return self._merge_sparse(other, np.add)
+
         if isinstance(other, ScipySparseArray):
             other = other.data
         if isinstance(other, sp.spmatrix):
@@ -1965,6 +2280,28 @@ class ScipySparseArray(SparseArray):
                     new._block_data_sorted = self._block_data_sorted
                 return new
 
+        if isinstance(other, np.ndarray) and d.format in ['csr', 'csc']:
+            try:
+                bcast_shape = np.broadcast_shapes(self.shape, other.shape)
+            except ValueError:
+                bcast_shape = None
+            if bcast_shape == self.shape:
+                # only the values of `other` at our non-zero positions matter
+                # so we gather those rather than broadcasting `other` out to a dense array
+                row_inds, col_inds, vals = self.find()
+                flat = self._ravel_indices((row_inds, col_inds), d.shape)
+                unflat = self._unravel_indices(flat, self.shape)
+                new = d.copy()
+                new.data = vals * np.broadcast_to(other, self.shape)[unflat]
+                new.eliminate_zeros()
+                return type(self)(new, shape=self.shape, layout=self.fmt)
+        if (
+                isinstance(other, ScipySparseArray)
+                and other.shape == self.shape
+                and other.data.shape != d.shape
+        ):
+            return self._merge_sparse(other, np.multiply)
+
         if isinstance(other, ScipySparseArray):
             other = other.data
         if isinstance(other, sp.spmatrix):
@@ -1977,11 +2314,90 @@ class ScipySparseArray(SparseArray):
         else:
             return np.array(new).reshape(self.shape)
 
+    def _merge_sparse(self, other, op):
+        """
+        Combines the non-zero elements of two arrays of the same shape by working
+        directly with their sorted flat indices, which avoids reshaping one of the
+        underlying scipy matrices to match the other.
+        `np.add` takes the union of the indices and `np.multiply` the intersection.
+
+        :param other:
+        :type other: ScipySparseArray
+        :param op:
+        :type op: np.ufunc
+        :return:
+        :rtype: ScipySparseArray
+        """
+        f1 = self.block_inds[0]
+        v1 = self.block_vals
+        f2 = other.block_inds[0]
+        v2 = other.block_vals
+        if op is np.multiply:
+            flat, i1, i2 = np.intersect1d(f1, f2, assume_unique=True, return_indices=True)
+            vals = v1[i1] * v2[i2]
+        elif op is np.add:
+            flat = np.concatenate([f1, f2])
+            vals = np.concatenate([v1, v2])
+            # both blocks are already sorted so a stable sort is just a merge
+            sorting = np.argsort(flat, kind='stable')
+            flat = flat[sorting]
+            vals = vals[sorting]
+            if len(flat) > 0:
+                starts = np.concatenate([[0], np.where(flat[1:] != flat[:-1])[0] + 1])
+                flat = flat[starts]
+                vals = np.add.reduceat(vals, starts)
+        else:
+            raise ValueError("don't know how to merge sparse arrays with {}".format(op))
+
+        nonzero = vals != 0
+        if not nonzero.all():
+            flat = flat[nonzero]
+            vals = vals[nonzero]
+
+        new = type(self)(None, shape=self.shape, layout=self._fmt, initialize=False)
+        new._set_sorted_block_data(flat, vals, self.data.shape)
+        return new
+
+    def _set_sorted_block_data(self, flat, vals, data_shape=None):
+        """
+        Rebuilds the underlying sparse matrix from sorted, unique flat indices
+
+        :param flat:
+        :type flat: np.ndarray
+        :param vals:
+        :type vals: np.ndarray
+        :param data_shape: the 2D shape of the sparse matrix
+        :type data_shape: tuple[int]
+        :return:
+        :rtype:
+        """
+        if data_shape is None:
+            data_shape = self.data.shape
+        row_inds, col_inds = self._unravel_indices(flat, data_shape)
+        data = self.coo_to_cs(
+            data_shape, vals, (row_inds, col_inds),
+            assume_sorted=data_shape[0] <= data_shape[1]
+        )
+        if self._fmt is not None:
+            fmt = self.format_from_string(self._fmt)
+            if not isinstance(data, fmt):
+                data = fmt(data)
+        self._a = data
+        self._view = None
+        self._validated = False
+        if self.compact_indices:
+            flat = flat.astype(self._flat_index_dtype(self.shape), copy=False)
+        self._block_vals = vals
+        self._block_inds = (flat, self._unravel_indices(flat, self.shape))
+        self._block_data_sorted = True
+
     def copy(self):
         import copy
 
+        data = self.data # make sure any pending view is materialized before copying
         base = copy.copy(self)
-        if base.data is self.data:
+        base._dependent_views = None
+        if base.data is data:
             base.data = base.data.copy()
         # I'm not sure I mutate anything else?
 
@@ -2166,6 +2582,7 @@ class ScipySparseArray(SparseArray):
         :rtype:
         """
         # Just here so I can be smart
+        self._detach_views()
         try:
             self.data[unflat] = val
         except TypeError:
@@ -2204,11 +2621,7 @@ class ScipySparseArray(SparseArray):
                 set_elements = all(len(x) == e1 for x in idx)
 
         if set_elements:
-            flat = self._ravel_indices(idx, self.shape)
-            unflat = self._unravel_indices(flat, self.data.shape)
-            # try:
-
-            self._set_data(unflat, val)
+            self.put(idx, val)
             # except TypeError:
             #     # need to construct a new data object in its entirety :weep:
             #     # or convert to an assignable format?
@@ -2243,6 +2656,8 @@ class ScipySparseArray(SparseArray):
         :rtype:
         """
 
+        self._detach_views()
+
         # we check first to see if we were asked for just a single vector of elements
         # the detection heuristic is basically: is everything just a slice of ints or nah
         if isinstance(idx, (int, np.integer)):
@@ -2284,6 +2699,114 @@ class ScipySparseArray(SparseArray):
             self._block_vals = None
             self._block_inds = None
 
+    def _prep_flat_indices(self, indices):
+        """
+        Converts either flat indices or a set of index arrays (one per axis)
+        into flat indices into the array
+
+        :param indices:
+        :type indices: np.ndarray | Iterable[np.ndarray]
+        :return:
+        :rtype: np.ndarray
+        """
+        if isinstance(indices, np.ndarray) and indices.ndim == 1:
+            flat = indices
+        elif isinstance(indices, (int, np.integer)):
+            flat = np.array([indices])
+        else:
+            indices = tuple(np.asanyarray(i) for i in indices)
+            if len(indices) != len(self.shape):
+                raise ValueError("{}: need one index array per axis ({}); was given {}".format(
+                    type(self).__name__,
+                    len(self.shape),
+                    len(indices)
+                ))
+            flat = np.ravel_multi_index(indices, self.shape)
+        flat = np.asanyarray(flat)
+        if flat.ndim != 1:
+            flat = flat.reshape(-1)
+        return flat
+
+    def take(self, indices):
+        """
+        Pulls the elements at the specified positions all at once by
+        sorting the requested flat indices and binary searching them against
+        the (sorted) flat indices of the non-zero elements
+
+        :param indices: flat indices or one index array per axis
+        :type indices: np.ndarray | Iterable[np.ndarray]
+        :return:
+        :rtype: np.ndarray
+        """
+        flat = self._prep_flat_indices(indices)
+        vals = self.block_vals
+        block_flat = self.block_inds[0]
+
+        res = np.zeros(len(flat), dtype=self.dtype)
+        if len(flat) == 0 or len(block_flat) == 0:
+            return res
+
+        sorting = np.argsort(flat, kind='stable')
+        pos = np.searchsorted(block_flat, flat[sorting])
+        pos[pos == len(block_flat)] = 0
+        found = block_flat[pos] == flat[sorting]
+        res[sorting[found]] = vals[pos[found]]
+
+        return res
+
+    def put(self, indices, values):
+        """
+        Assigns the elements at the specified positions all at once.
+        Existing non-zero elements are updated in place, the remainder are merged into the
+        sorted block data, and the underlying sparse matrix is rebuilt a single time.
+        As with NumPy, the last value wins when an index is repeated.
+
+        :param indices: flat indices or one index array per axis
+        :type indices: np.ndarray | Iterable[np.ndarray]
+        :param values:
+        :type values: np.ndarray | float
+        :return:
+        :rtype:
+        """
+        flat = self._prep_flat_indices(indices)
+        values = np.broadcast_to(np.asanyarray(values), flat.shape)
+        if len(flat) == 0:
+            return
+        self._detach_views()
+
+        # sort once, keeping only the last assignment to each position
+        sorting = np.argsort(flat, kind='stable')
+        flat = flat[sorting]
+        values = values[sorting]
+        last = np.concatenate([flat[1:] != flat[:-1], [True]])
+        flat = flat[last]
+        values = values[last]
+
+        block_flat = self.block_inds[0]
+        vals = self.block_vals
+        dtype = np.result_type(vals.dtype, values.dtype)
+        vals = vals.astype(dtype)
+
+        pos = np.searchsorted(block_flat, flat)
+        found = pos < len(block_flat)
+        found[found] = block_flat[pos[found]] == flat[found]
+
+        vals[pos[found]] = values[found]
+        new = np.logical_not(found)
+        new[new] = values[new] != 0
+        if new.any():
+            block_flat = block_flat.astype(np.result_type(block_flat.dtype, flat.dtype))
+            ins = pos[new]
+            block_flat = np.insert(block_flat, ins, flat[new])
+            vals = np.insert(vals, ins, values[new])
+
+        nonzero = vals != 0
+        if not nonzero.all():
+            block_flat = block_flat[nonzero]
+            vals = vals[nonzero]
+
+        self._set_sorted_block_data(block_flat, vals)
+
     def savez(self, file, compressed=True):
         """
         Saves a SparseArray to a file (must have the npz extension)
@@ -2332,11 +2855,82 @@ class ScipySparseArray(SparseArray):
         :return:
         :rtype: SparseArray
         """
+        if isinstance(file, str) and os.path.isdir(file):
+            return cls.load_mmap(file)
         data = sp.load_npz(file) #type: sp.spmatrix
         other = np.load(file)
         new = cls(data, shape=other['_block_shape'], layout=type(data), initialize=False)
-        new._block_inds = (other['_block_inds_flat'], other['_block_inds_unflat'])
-        new._block_inds = other['_block_vals']
+        new._block_inds = (other['_block_inds_flat'], tuple(other['_block_inds_unflat']))
+        new._block_vals = other['_block_vals']
+        new._block_data_sorted = True
+        return new
+
+    mmap_buffers = ('data', 'indices', 'indptr', 'block_vals', 'block_inds_flat', 'block_inds_unflat')
+    def save_mmap(self, file):
+        """
+        Saves a SparseArray to a directory of uncompressed `.npy` buffers
+        that can be mapped back in with `np.memmap` by `load_mmap`
+
+        :param file: the directory to write to
+        :type file: str
+        :return: the saved directory
+        :rtype: str
+        """
+
+        self._tocs()
+        os.makedirs(file, exist_ok=True)
+        d = self.data
+        flat, unflat = self.block_inds
+        buffers = {
+            'data': d.data,
+            'indices': d.indices,
+            'indptr': d.indptr,
+            'block_vals': self.block_vals,
+            'block_inds_flat': flat,
+            'block_inds_unflat': np.array(unflat)
+        }
+        for k in self.mmap_buffers:
+            np.save(os.path.join(file, k + '.npy'), buffers[k])
+        np.save(
+            os.path.join(file, 'meta.npy'),
+            np.array([d.format] + [str(s) for s in d.shape] + [str(s) for s in self.shape])
+        )
+        return file
+    @classmethod
+    def load_mmap(cls, file, mode='r'):
+        """
+        Loads a SparseArray saved with `save_mmap`, memory mapping
+        the underlying buffers so that nothing is read from disk until
+        it is actually used
+
+        :param file: the directory the array was saved to
+        :type file: str
+        :param mode: the `np.memmap` mode to open the buffers with
+        :type mode: str
+        :return:
+        :rtype: ScipySparseArray
+        """
+
+        meta = np.load(os.path.join(file, 'meta.npy'))
+        fmt = cls.format_from_string(str(meta[0]))
+        data_shape = tuple(int(s) for s in meta[1:3])
+        shape = tuple(int(s) for s in meta[3:])
+        buffers = {
+            k: np.load(os.path.join(file, k + '.npy'), mmap_mode=mode)
+            for k in cls.mmap_buffers
+        }
+
+        # we skip the `spmatrix` constructor because it
+        # checks (and possibly copies) the index arrays
+        data = fmt(data_shape, dtype=buffers['data'].dtype)
+        data.data = buffers['data']
+        data.indices = buffers['indices']
+        data.indptr = buffers['indptr']
+
+        new = cls(data, shape=shape, layout=fmt, initialize=False)
+        new._block_vals = buffers['block_vals']
+        new._block_inds = (buffers['block_inds_flat'], tuple(buffers['block_inds_unflat']))
+        new._block_data_sorted = True
         return new
 
     def __getitem__(self, item):
@@ -2352,41 +2946,627 @@ class ScipySparseArray(SparseArray):
                                           self.non_zero_count
                                            )
 
-# import tensorflow
-class TensorFlowSparseArray(SparseArray):
+class CSFSparseArray(SparseArray):
     """
-    Provides a SparseArray implementation that uses TensorFlow as the backend
+    Array class that stores an N-dimensional tensor natively as a set of compressed sparse fibers.
+    Level `k` of the fiber tree holds the distinct values of axis `k` for every distinct prefix of the first `k+1`
+    axes, along with pointers into level `k+1`, so no index ever needs to be raveled over the full shape.
+    Transposes, reshapes, slices, and contractions all work on the per-axis indices directly.
     """
-    def __init__(self, data, dtype=None):
-        import tensorflow
-        self.tensor = self._init_tensor(data, dtype=dtype) #type: tensorflow.sparse.SparseTensor
 
-    def _init_tensor(self, data, dtype=None):
+    def __init__(self, a, shape=None, dtype=None, assume_sorted=False):
         """
-        :param data:
-        :type data:
-        :return:
-        :rtype: tensorflow.sparse.SparseTensor
+
+        :param a: the data to initialize from, either an array, a `SparseArray`, or a `(vals, inds)` pair
+        :type a:
+        :param shape:
+        :type shape:
+        :param dtype:
+        :type dtype:
+        :param assume_sorted: whether the passed indices are already in lexicographic order with no duplicates
+        :type assume_sorted: bool
         """
-        import tensorflow
-        if isinstance(data, TensorFlowSparseArray):
-            import copy
-            new = copy.copy(data.tensor)
-            if dtype is not None and new.dtype != dtype:
-                raise NotImplementedError("not sure how to convert dtypes...")
-            return new
-        elif isinstance(data, tensorflow.sparse.SparseTensor):
-            if dtype is not None and data.dtype != dtype:
-                raise NotImplementedError("not sure how to convert dtypes...")
-            return data
-        elif isinstance(data, ScipySparseArray):
-            vals, inds = data.block_data
-            if dtype is not None and vals.dtype != dtype:
-                vals = vals.astype(dtype)
-            return tensorflow.sparse.SparseTensor(inds, vals, data.shape)
-        elif isinstance(data, sp.spmatrix):
-            row_inds, col_inds, vals = sp.find(data)
-            if dtype is not None and vals.dtype != dtype:
+        vals, inds, shape = self._prep_data(a, shape)
+        vals = np.asanyarray(vals)
+        if dtype is not None:
+            vals = vals.astype(dtype)
+        self._shape = tuple(int(s) for s in shape)
+        self._coords = None
+        self._fids, self._fptr, self._vals = self._build_fibers(vals, inds, self._shape, assume_sorted=assume_sorted)
+
+    @classmethod
+    def _prep_data(cls, a, shape):
+        if isinstance(a, CSFSparseArray):
+            vals, inds = a.block_data
+            if shape is None:
+                shape = a.shape
+        elif isinstance(a, SparseArray):
+            vals, inds = a.block_data
+            if shape is None:
+                shape = a.shape
+            elif np.prod(shape) != np.prod(a.shape):
+                raise ValueError("{}: can't initialize array of shape {} from array of shape {}".format(
+                    cls.__name__,
+                    shape,
+                    a.shape
+                ))
+            elif tuple(shape) != tuple(a.shape):
+                return cls._prep_data(cls(a).reshape(shape), None)
+        elif isinstance(a, sp.spmatrix):
+            row_inds, col_inds, vals = sp.find(a)
+            inds = (row_inds, col_inds)
+            if shape is None:
+                shape = a.shape
+            elif tuple(shape) != a.shape:
+                return cls._prep_data(cls(a).reshape(shape), None)
+        elif isinstance(a, np.ndarray):
+            if a.dtype == np.dtype(object):
+                raise TypeError("{}: can't initialize from object array".format(cls.__name__))
+            inds = np.nonzero(a)
+            vals = a[inds]
+            if shape is None:
+                shape = a.shape
+            elif tuple(shape) != a.shape:
+                return cls._prep_data(a.reshape(shape), None)
+        elif (
+                isinstance(a, (tuple, list)) and len(a) == 2
+                and not isinstance(a[1], (int, np.integer))
+                and len(a[1]) > 0 and not isinstance(a[1][0], (int, np.integer))
+        ):
+            vals, inds = a
+            inds = tuple(np.asanyarray(i) for i in inds)
+            if shape is None:
+                shape = tuple(np.max(i) + 1 for i in inds)
+            if len(inds) != len(shape):
+                raise ValueError("{}: can't initialize array of shape {} from non-zero indices of dimension {}".format(
+                    cls.__name__,
+                    shape,
+                    len(inds)
+                ))
+        else:
+            a = np.asanyarray(a)
+            if a.dtype == np.dtype(object) or a.ndim == 0:
+                raise TypeError("{}: don't know how to initialize from {}".format(cls.__name__, a))
+            return cls._prep_data(a, shape)
+
+        return vals, inds, shape
+
+    @staticmethod
+    def _lexsort(inds):
+        return np.lexsort(tuple(reversed(inds)))
+    @staticmethod
+    def _level_changes(inds):
+        """
+        Returns boolean masks marking where a new fiber starts at each level
+        for indices that are already in lexicographic order
+        """
+        n = len(inds[0]) if len(inds) > 0 else 0
+        change = np.zeros(n, dtype=bool)
+        changes = []
+        for i in inds:
+            if n > 0:
+                change[0] = True
+                change[1:] |= i[1:] != i[:-1]
+            changes.append(change.copy())
+        return changes
+
+    @classmethod
+    def _build_fibers(cls, vals, inds, shape, assume_sorted=False):
+        inds = tuple(
+            np.asanyarray(i).astype(infer_inds_dtype(max(s - 1, 0)), copy=False)
+            for i, s in zip(inds, shape)
+        )
+        if not assume_sorted and len(vals) > 0:
+            sorting = cls._lexsort(inds)
+            inds = tuple(i[sorting] for i in inds)
+            vals = vals[sorting]
+
+        changes = cls._level_changes(inds)
+        starts = [np.nonzero(c)[0] for c in changes]
+        if len(starts) > 0 and len(starts[-1]) < len(vals):
+            # duplicate positions get summed, the same way `sp.coo_matrix` treats them
+            vals = np.add.reduceat(vals, starts[-1])
+        ptr_dtype = infer_inds_dtype(len(vals))
+        fids = [i[s] for i, s in zip(inds, starts)]
+        fptr = [
+            np.concatenate([np.searchsorted(s_next, s), [len(s_next)]]).astype(ptr_dtype)
+            for s, s_next in zip(starts, starts[1:])
+        ]
+        return fids, fptr, vals
+
+    @property
+    def fibers(self):
+        """
+        Returns the compressed fiber tree as a list of `(fiber_ids, fiber_pointers)` pairs,
+        one per level, where `fiber_pointers[i]:fiber_pointers[i+1]` are the children of node `i`
+        in the next level (the last level has no pointers and lines up with the stored values)
+
+        :return:
+        :rtype: list[tuple[np.ndarray, np.ndarray|None]]
+        """
+        return list(zip(self._fids, self._fptr + [None]))
+
+    def _expand_coords(self):
+        if self._coords is None:
+            ndim = len(self._fids)
+            coords = [None] * ndim
+            coords[-1] = self._fids[-1]
+            leaf_ptr = None
+            for k in range(ndim - 2, -1, -1):
+                leaf_ptr = self._fptr[k] if leaf_ptr is None else leaf_ptr[self._fptr[k]]
+                coords[k] = np.repeat(self._fids[k], np.diff(leaf_ptr))
+            self._coords = tuple(coords)
+        return self._coords
+
+    @classmethod
+    def from_diagonal_data(cls, diags, shape=None, **kw):
+        if isinstance(diags[0], (int, np.integer, float, np.floating)):
+            diags = np.asanyarray(diags)
+            N = len(diags)
+            if shape is None:
+                shape = (N, N)
+            pos = np.arange(N)
+            return cls((diags, (pos, pos)), shape=shape, **kw)
+        else:
+            diags = [np.asanyarray(d) for d in diags]
+            block_size = diags[0].shape
+            all_vals = []
+            all_inds = []
+            for n, d in enumerate(diags):
+                r, c = np.nonzero(d)
+                all_vals.append(d[r, c])
+                all_inds.append((np.full(len(r), n), r, np.full(len(r), n), c))
+            vals = np.concatenate(all_vals)
+            inds = tuple(np.concatenate(x) for x in zip(*all_inds))
+            if shape is None:
+                shape = (len(diags), block_size[0], len(diags), block_size[1])
+            return cls((vals, inds), shape=shape, **kw).transpose((0, 2, 1, 3))
+
+    @classmethod
+    def initialize_empty(cls, shp, dtype=None, **kw):
+        if dtype is None:
+            dtype = np.float64
+        return cls(
+            (np.zeros((0,), dtype=dtype), tuple(np.zeros((0,), dtype=int) for _ in shp)),
+            shape=shp,
+            **kw
+        )
+
+    @property
+    def shape(self):
+        return self._shape
+    @property
+    def dtype(self):
+        return self._vals.dtype
+    @property
+    def non_zero_count(self):
+        return len(self._vals)
+
+    def to_state(self, serializer=None):
+        """
+        Provides just the state that is needed to
+        serialize the object
+        :param serializer:
+        :type serializer:
+        :return:
+        :rtype:
+        """
+        return {
+            'shape': self.shape,
+            'dtype': self.dtype.name,
+            'block_data': self.block_data
+        }
+    @classmethod
+    def from_state(cls, state, serializer=None):
+        block_vals, block_inds = state['block_data']
+        block_vals = np.asarray(block_vals)
+        block_inds = tuple(np.asarray(x) for x in block_inds)
+        return cls(
+            (block_vals, block_inds),
+            dtype=np.dtype(state['dtype']),
+            shape=state['shape'],
+            assume_sorted=True
+        )
+
+    @property
+    def block_vals(self):
+        return self._vals
+    @property
+    def block_inds(self):
+        return self._expand_coords()
+    @property
+    def block_data(self):
+        return self.block_vals, self.block_inds
+
+    def _from_coords(self, vals, inds, shape, assume_sorted=False):
+        return type(self)((vals, inds), shape=shape, assume_sorted=assume_sorted)
+
+    def transpose(self, axes):
+        """
+        Transposes the array by permuting the per-axis indices and
+        rebuilding the fiber tree, without raveling anything
+
+        :param axes:
+        :type axes: Iterable[int]
+        :return:
+        :rtype: CSFSparseArray
+        """
+        axes = [self.ndim + a if a < 0 else a for a in axes]
+        if len(axes) != self.ndim or np.any(np.sort(axes) != np.arange(self.ndim)):
+            raise ValueError("transposition {} can't apply to shape {}".format(
+                axes, self.shape
+            ))
+        inds = self.block_inds
+        new_shape = tuple(self.shape[a] for a in axes)
+        return self._from_coords(self.block_vals, [inds[a] for a in axes], new_shape)
+
+    @staticmethod
+    def _reshape_groups(old_shape, new_shape):
+        """
+        Finds the smallest runs of old and new axes that have the same total size,
+        since a C-ordered reshape only mixes indices within those runs
+        """
+        groups = []
+        i = j = 0
+        while i < len(old_shape) or j < len(new_shape):
+            gi = [i] if i < len(old_shape) else []
+            gj = [j] if j < len(new_shape) else []
+            po = old_shape[i] if i < len(old_shape) else 1
+            pn = new_shape[j] if j < len(new_shape) else 1
+            i += 1
+            j += 1
+            while po != pn:
+                if po < pn:
+                    po *= old_shape[i]
+                    gi.append(i)
+                    i += 1
+                else:
+                    pn *= new_shape[j]
+                    gj.append(j)
+                    j += 1
+            groups.append((gi, gj))
+        return groups
+
+    def reshape(self, newshape):
+        """
+        Reshapes the array by raveling indices only within the groups
+        of axes that get merged or split, which preserves the lexicographic
+        order of the stored elements
+
+        :param newshape:
+        :type newshape: Iterable[int]
+        :return:
+        :rtype: CSFSparseArray
+        """
+        newshape = tuple(int(s) for s in newshape)
+        if np.prod(newshape) != np.prod(self.shape):
+            raise ValueError("Can't reshape {} into {}".format(self.shape, newshape))
+        inds = self.block_inds
+        n = self.non_zero_count
+        new_inds = [None] * len(newshape)
+        for gi, gj in self._reshape_groups(self.shape, newshape):
+            if len(gi) == 1 and len(gj) == 1:
+                new_inds[gj[0]] = inds[gi[0]]
+            elif len(gi) == 0:
+                for j in gj:
+                    new_inds[j] = np.zeros(n, dtype=np.uint8)
+            elif len(gj) == 0:
+                continue
+            else:
+                sub_old = [self.shape[i] for i in gi]
+                sub_new = [newshape[j] for j in gj]
+                flat = np.ravel_multi_index([inds[i] for i in gi], sub_old)
+                for j, x in zip(gj, np.unravel_index(flat, sub_new)):
+                    new_inds[j] = x
+        return self._from_coords(self.block_vals, new_inds, newshape, assume_sorted=True)
+
+    def squeeze(self):
+        return self.reshape([x for x in self.shape if x != 1])
+
+    def resize(self, newsize):
+        """
+        Returns a resized version of the tensor, dropping
+        elements that fall outside the new shape
+
+        :param newsize:
+        :type newsize: tuple[int]
+        :return:
+        :rtype:
+        """
+        if len(newsize) != self.ndim:
+            raise ValueError("unclear how to resize a tensor with rank {} into a tensor of rank {}".format(
+                self.ndim,
+                len(newsize)
+            ))
+        vals, inds = self.block_data
+        mask = np.ones(len(vals), dtype=bool)
+        for i, n in zip(inds, newsize):
+            mask &= i < n
+        return self._from_coords(vals[mask], [i[mask] for i in inds], newsize, assume_sorted=True)
+
+    def _get_element(self, idx):
+        if not isinstance(idx, tuple):
+            idx = (idx,)
+        nell = sum(1 for i in idx if i is Ellipsis)
+        if nell > 1:
+            raise IndexError("an index can only have a single ellipsis ('...')")
+        elif nell == 1:
+            k = next(k for k, i in enumerate(idx) if i is Ellipsis)
+            idx = idx[:k] + (slice(None),) * max(self.ndim - len(idx) + 1, 0) + idx[k+1:]
+        if len(idx) > self.ndim:
+            raise IndexError("too many indices for array of shape {}".format(self.shape))
+        vals, inds = self.block_data
+        mask = np.ones(len(vals), dtype=bool)
+        new_inds = []
+        new_shape = []
+        resort = False
+        for k, s in enumerate(self.shape):
+            i = idx[k] if k < len(idx) else slice(None)
+            if isinstance(i, (int, np.integer)):
+                if i < -s or i >= s:
+                    raise IndexError("index {} is out of bounds for axis {} with size {}".format(i, k, s))
+                if i < 0:
+                    i += s
+                mask &= inds[k] == i
+                continue
+            elif isinstance(i, slice) and i == slice(None):
+                new_inds.append(inds[k])
+                new_shape.append(s)
+                continue
+            sel = np.arange(s)[i,].flatten()
+            if len(np.unique(sel)) < len(sel):
+                raise ValueError("sparse array slicing can't duplicate indices")
+            resort = resort or np.any(np.diff(sel) < 0)
+            mapping = np.full(s, -1, dtype=int)
+            mapping[sel] = np.arange(len(sel))
+            mapped = mapping[inds[k]]
+            mask &= mapped >= 0
+            new_inds.append(mapped)
+            new_shape.append(len(sel))
+        if len(new_shape) == 0:
+            return vals[mask].sum() if mask.any() else np.zeros((), dtype=vals.dtype)[()]
+        return self._from_coords(vals[mask], [i[mask] for i in new_inds], new_shape, assume_sorted=not resort)
+    def __getitem__(self, item):
+        return self._get_element(item)
+
+    def asarray(self):
+        arr = np.zeros(self.shape, dtype=self.dtype)
+        vals, inds = self.block_data
+        arr[inds] = vals
+        return arr
+    def todense(self):
+        return self.asarray()
+    def ascoo(self):
+        vals, inds = self.block_data
+        if self.ndim == 1:
+            return sp.coo_matrix((vals, (inds[0], np.zeros_like(inds[0]))), shape=self.shape + (1,))
+        elif self.ndim == 2:
+            return sp.coo_matrix((vals, inds), shape=self.shape)
+        else:
+            cols = np.ravel_multi_index(inds[1:], self.shape[1:])
+            return sp.coo_matrix((vals, (inds[0], cols)), shape=(self.shape[0], int(np.prod(self.shape[1:]))))
+    def ascsr(self):
+        return self.ascoo().tocsr()
+
+    def copy(self):
+        import copy
+        new = copy.copy(self)
+        new._vals = self._vals.copy()
+        return new
+
+    def concatenate(self, *others, axis=0):
+        """
+        Concatenates multiple arrays along the specified axis
+
+        :param others:
+        :type others:
+        :param axis:
+        :type axis:
+        :return:
+        :rtype: CSFSparseArray
+        """
+        others = [o if isinstance(o, CSFSparseArray) else type(self)(o) for o in others]
+        all_vals = [self.block_vals]
+        all_inds = [self.block_inds]
+        tot_shape = list(self.shape)
+        for o in others:
+            vals, inds = o.block_data
+            inds = list(inds)
+            inds[axis] = inds[axis].astype(int) + tot_shape[axis]
+            tot_shape[axis] += o.shape[axis]
+            all_vals.append(vals)
+            all_inds.append(inds)
+        vals = np.concatenate(all_vals)
+        inds = tuple(np.concatenate([i[k] for i in all_inds]) for k in range(self.ndim))
+        # blocks stacked along the leading axis stay in order
+        return self._from_coords(vals, inds, tot_shape, assume_sorted=axis == 0)
+
+    @classmethod
+    def _tuple_ids(cls, cols, n):
+        """
+        Assigns dense, lexicographically ordered ids to the index tuples
+        in `cols` without raveling them
+
+        :return: the ids and the columns of the distinct tuples
+        :rtype: tuple[np.ndarray, tuple[np.ndarray]]
+        """
+        if len(cols) == 0:
+            return np.zeros(n, dtype=int), ()
+        sorting = cls._lexsort(cols)
+        scols = [c[sorting] for c in cols]
+        change = cls._level_changes(scols)[-1]
+        ids = np.empty(n, dtype=int)
+        ids[sorting] = np.cumsum(change) - 1
+        return ids, tuple(c[change] for c in scols)
+
+    def _as_csf(self, other):
+        if not isinstance(other, CSFSparseArray):
+            other = type(self)(other)
+        if other.shape != self.shape:
+            raise ValueError("shape mismatch for objects with shapes {} and {}".format(
+                self.shape,
+                other.shape
+            ))
+        return other
+
+    def true_multiply(self, other):
+        """
+        Multiplies self and other elementwise
+
+        :param other:
+        :type other:
+        :return:
+        :rtype: CSFSparseArray
+        """
+        if isinstance(other, (int, float, np.integer, np.floating)):
+            new = self.copy()
+            new._vals = self._vals * other
+            return new
+        if isinstance(other, np.ndarray):
+            vals = self.block_vals * np.broadcast_to(other, self.shape)[self.block_inds]
+            return self._from_coords(vals, self.block_inds, self.shape, assume_sorted=True)
+        other = self._as_csf(other)
+        # both sides are lexicographically sorted, so a stable merge puts matches side-by-side
+        n = self.non_zero_count
+        inds = tuple(np.concatenate([a, b]) for a, b in zip(self.block_inds, other.block_inds))
+        sorting = self._lexsort(inds)
+        inds = [i[sorting] for i in inds]
+        change = self._level_changes(inds)[-1]
+        matches = np.nonzero(~change[1:])[0]
+        left = sorting[matches]
+        right = sorting[matches + 1] - n
+        vals = self.block_vals[left] * other.block_vals[right]
+        return self._from_coords(vals, [i[left] for i in self.block_inds], self.shape, assume_sorted=True)
+
+    def plus(self, other):
+        if isinstance(other, (int, float, np.integer, np.floating)):
+            if other == 0:
+                return self.copy()
+            return self.asarray() + other
+        if isinstance(other, np.ndarray):
+            return self.asarray() + other
+        other = self._as_csf(other)
+        inds = tuple(np.concatenate([a, b]) for a, b in zip(self.block_inds, other.block_inds))
+        vals = np.concatenate([self.block_vals, other.block_vals])
+        return self._from_coords(vals, inds, self.shape)
+    def __add__(self, other):
+        return self.plus(other)
+    def __radd__(self, other):
+        return self.plus(other)
+    def __neg__(self):
+        return -1 * self
+
+    def tensordot(self, other, axes=2):
+        """
+        Contracts self and other along the specified axes.
+        Rather than flattening each operand over its full shape, the free and contracted
+        index tuples that actually occur are given dense ids, so the intermediate matrix product
+        only ever spans the stored fibers.
+
+        :param other:
+        :type other:
+        :param axes: the axes to contract along
+        :type axes: int | Iterable[int] | Iterable[Iterable[int]]
+        :return:
+        :rtype: CSFSparseArray
+        """
+        try:
+            iter(axes)
+        except TypeError:
+            axes_a = list(range(self.ndim - axes, self.ndim))
+            axes_b = list(range(0, axes))
+        else:
+            axes_a, axes_b = axes
+        if isinstance(axes_a, (int, np.integer)):
+            axes_a = [axes_a]
+        if isinstance(axes_b, (int, np.integer)):
+            axes_b = [axes_b]
+
+        if not isinstance(other, CSFSparseArray):
+            other = type(self)(other)
+
+        axes_a = [self.ndim + a if a < 0 else a for a in axes_a]
+        axes_b = [other.ndim + b if b < 0 else b for b in axes_b]
+        if len(axes_a) != len(axes_b) or any(self.shape[a] != other.shape[b] for a, b in zip(axes_a, axes_b)):
+            raise ValueError("shape-mismatch for sum ({}{}@{}{})".format(self.shape, axes_a, other.shape, axes_b))
+
+        free_a = [k for k in range(self.ndim) if k not in axes_a]
+        free_b = [k for k in range(other.ndim) if k not in axes_b]
+        new_shape = tuple(self.shape[k] for k in free_a) + tuple(other.shape[k] for k in free_b)
+
+        a_vals, a_inds = self.block_data
+        b_vals, b_inds = other.block_data
+        na = len(a_vals)
+        nb = len(b_vals)
+
+        rows, row_keys = self._tuple_ids([a_inds[k] for k in free_a], na)
+        cols, col_keys = self._tuple_ids([b_inds[k] for k in free_b], nb)
+        shared, _ = self._tuple_ids(
+            [np.concatenate([a_inds[i], b_inds[j]]) for i, j in zip(axes_a, axes_b)],
+            na + nb
+        )
+        nshared = (np.max(shared) + 1) if na + nb > 0 else 0
+        a_mat = sp.csr_matrix((a_vals, (rows, shared[:na])),
+                              shape=((np.max(rows) + 1) if na > 0 else 0, nshared))
+        b_mat = sp.csr_matrix((b_vals, (shared[na:], cols)),
+                              shape=(nshared, (np.max(cols) + 1) if nb > 0 else 0))
+        res = a_mat.dot(b_mat).tocoo()
+
+        if len(new_shape) == 0:
+            return res.sum()
+        res_vals = res.data
+        res_inds = (
+                [k[res.row] for k in row_keys]
+                + [k[res.col] for k in col_keys]
+        )
+        return self._from_coords(res_vals, res_inds, new_shape)
+
+    def dot(self, other):
+        return self.tensordot(other, axes=[[self.ndim - 1], [0]])
+    def __matmul__(self, other):
+        return self.dot(other)
+
+    def __repr__(self):
+        return "{}(<{}> nonzero={})".format(type(self).__name__,
+                                           ", ".join([str(x) for x in self.shape]),
+                                           self.non_zero_count
+                                           )
+
+# import tensorflow
+class TensorFlowSparseArray(SparseArray):
+    """
+    Provides a SparseArray implementation that uses TensorFlow as the backend
+    """
+    def __init__(self, data, dtype=None):
+        import tensorflow
+        self.tensor = self._init_tensor(data, dtype=dtype) #type: tensorflow.sparse.SparseTensor
+
+    def _init_tensor(self, data, dtype=None):
+        """
+        :param data:
+        :type data:
+        :return:
+        :rtype: tensorflow.sparse.SparseTensor
+        """
+        import tensorflow
+        if isinstance(data, TensorFlowSparseArray):
+            import copy
+            new = copy.copy(data.tensor)
+            if dtype is not None and new.dtype != dtype:
+                raise NotImplementedError("not sure how to convert dtypes...")
+            return new
+        elif isinstance(data, tensorflow.sparse.SparseTensor):
+            if dtype is not None and data.dtype != dtype:
+                raise NotImplementedError("not sure how to convert dtypes...")
+            return data
+        elif isinstance(data, ScipySparseArray):
+            vals, inds = data.block_data
+            if dtype is not None and vals.dtype != dtype:
+                vals = vals.astype(dtype)
+            return tensorflow.sparse.SparseTensor(inds, vals, data.shape)
+        elif isinstance(data, sp.spmatrix):
+            row_inds, col_inds, vals = sp.find(data)
+            if dtype is not None and vals.dtype != dtype:
                 vals = vals.astype(dtype)
             return tensorflow.sparse.SparseTensor((row_inds, col_inds), vals, data.shape)
         elif isinstance(data, np.ndarray) and data.dtype != np.dtype(object):
@@ -2598,7 +3778,264 @@ class TensorFlowSparseArray(SparseArray):
             raise TypeError("dot not defined for {} and {}".format(type(self).__name__, type(other).__name__))
 
 
-def _dot(a, b):
+class SparseAccumulator:
+    """
+    Accumulates many (indices, values) contributions to a sparse array,
+    summing repeated positions.
+    Chunks are buffered until they pass `memory_budget` bytes, at which point they're
+    sorted, deduplicated, and spilled to a memory mapped run on disk.
+    The final array is built with a single merge over the runs rather than re-sorting
+    the growing array on every addition.
+    """
+
+    def __init__(self, shape, dtype=None, memory_budget=2**28, spill_dir=None, memmap=None, merge_chunk_size=2**20):
+        """
+        :param shape: the shape of the array being built
+        :type shape: Iterable[int]
+        :param dtype: the dtype of the values (if not supplied, it's promoted to fit every appended chunk)
+        :type dtype: np.dtype | None
+        :param memory_budget: the number of bytes to buffer before spilling a sorted run to disk
+        :type memory_budget: int
+        :param spill_dir: the directory to write runs to (a temporary one is used if not supplied)
+        :type spill_dir: str | None
+        :param memmap: whether the final sparse buffers should be memory mapped (defaults to whether anything was spilled)
+        :type memmap: bool | None
+        :param merge_chunk_size: the number of elements per run to merge at a time
+        :type merge_chunk_size: int
+        """
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self._promote = dtype is None
+        self.memory_budget = memory_budget
+        self._spill_dir = spill_dir
+        self._own_dir = False
+        self.memmap = memmap
+        self.merge_chunk_size = merge_chunk_size
+        # signed so that the indices can go straight into `np.bincount` and scipy
+        self.flat_dtype = np.int32 if int(np.prod(self.shape, dtype=object)) < np.iinfo(np.int32).max else np.int64
+        self._chunks = []
+        self._buffered = 0
+        self._runs = []
+
+    @property
+    def spill_dir(self):
+        if self._spill_dir is None:
+            import tempfile as tf
+            self._spill_dir = tf.mkdtemp()
+            self._own_dir = True
+        return self._spill_dir
+
+    def append(self, indices, values):
+        """
+        Adds values at the given positions
+
+        :param indices: flat indices or one index array per axis
+        :type indices: np.ndarray | Iterable[np.ndarray]
+        :param values:
+        :type values: np.ndarray | float
+        :return:
+        :rtype:
+        """
+        if isinstance(indices, np.ndarray) and indices.ndim == 1:
+            flat = indices.astype(self.flat_dtype, copy=False)
+        else:
+            flat = np.ravel_multi_index(tuple(np.asanyarray(i) for i in indices), self.shape).astype(self.flat_dtype, copy=False)
+        values = np.asanyarray(values)
+        if self._promote:
+            self.dtype = values.dtype if self.dtype is None else np.result_type(self.dtype, values.dtype)
+        values = np.broadcast_to(values.astype(self.dtype, copy=False), flat.shape)
+        self._chunks.append((flat, values))
+        self._buffered += flat.nbytes + values.nbytes
+        if self._buffered > self.memory_budget:
+            self.spill()
+    def __iadd__(self, other):
+        self.append(*other)
+        return self
+
+    def _sorted_buffer(self):
+        flat = np.concatenate([c[0] for c in self._chunks])
+        vals = np.concatenate([c[1] for c in self._chunks]).astype(self.dtype, copy=False)
+
+        sorting = np.argsort(flat, kind='mergesort')
+        flat = flat[sorting]
+        vals = vals[sorting]
+        mask = np.empty(flat.shape, dtype=np.bool_)
+        mask[:1] = True
+        mask[1:] = flat[1:] != flat[:-1]
+        if not mask.all():
+            vals = np.add.reduceat(vals, np.nonzero(mask)[0])
+            flat = flat[mask]
+        return flat, vals
+
+    def spill(self):
+        """
+        Sorts the buffered chunks and writes them out as a memory mapped run
+
+        :return:
+        :rtype:
+        """
+        if len(self._chunks) == 0:
+            return
+        flat, vals = self._sorted_buffer()
+        self._chunks = []
+        self._buffered = 0
+        base = os.path.join(self.spill_dir, 'run_{}'.format(len(self._runs)))
+        np.save(base + '_inds.npy', flat)
+        np.save(base + '_vals.npy', vals)
+        self._runs.append((
+            np.load(base + '_inds.npy', mmap_mode='r'),
+            np.load(base + '_vals.npy', mmap_mode='r')
+        ))
+
+    def _build_dir(self):
+        # every build gets its own directory so that later builds can't overwrite
+        # the buffers of arrays that were already handed out
+        import tempfile as tf
+        return tf.mkdtemp(prefix='build_', dir=self.spill_dir)
+
+    def _merged_runs(self, build_dir):
+        self.spill()
+        n = sum(len(r[0]) for r in self._runs)
+        out_dir = os.path.join(build_dir, 'merged')
+        os.makedirs(out_dir, exist_ok=True)
+        flat = np.lib.format.open_memmap(os.path.join(out_dir, 'flat.npy'), mode='w+', dtype=self.flat_dtype, shape=(n,))
+        vals = np.lib.format.open_memmap(os.path.join(out_dir, 'vals.npy'), mode='w+', dtype=self.dtype, shape=(n,))
+        m = 0
+        for f, v in merge_sorted_runs(
+                [r[0] for r in self._runs],
+                [r[1] for r in self._runs],
+                chunk_size=self.merge_chunk_size
+        ):
+            flat[m:m+len(f)] = f
+            vals[m:m+len(f)] = v
+            m += len(f)
+        return flat[:m], vals[:m]
+
+    def to_sparse(self, layout=None):
+        """
+        Builds the accumulated array.
+        The accumulator is left as is, so more values can be appended and the array rebuilt.
+
+        :return:
+        :rtype: ScipySparseArray
+        """
+        shape = self.shape
+        data_shape = shape if len(shape) == 2 else ScipySparseArray._get_balanced_shape(shape)
+        use_mmap = self.memmap if self.memmap is not None else len(self._runs) > 0
+
+        build_dir = None
+        if len(self._runs) == 0:
+            if len(self._chunks) > 0:
+                flat, vals = self._sorted_buffer()
+                # keep the deduplicated buffer around so later appends add onto it
+                self._chunks = [(flat, vals)]
+                self._buffered = flat.nbytes + vals.nbytes
+            else:
+                flat = np.zeros((0,), dtype=self.flat_dtype)
+                vals = np.zeros((0,), dtype=self.dtype)
+        else:
+            build_dir = self._build_dir()
+            flat, vals = self._merged_runs(build_dir)
+
+        if use_mmap:
+            if build_dir is None:
+                build_dir = self._build_dir()
+            n = len(flat)
+            # matches the index dtype scipy uses for the final matrix
+            ij_dtype = np.int32 if max(max(data_shape), n) < np.iinfo(np.int32).max else np.int64
+            ij_inds = np.lib.format.open_memmap(
+                os.path.join(build_dir, 'ij_inds.npy'),
+                mode='w+', dtype=ij_dtype, shape=(2, n)
+            )
+            chunk = ScipySparseArray.mmap_chunk_size
+            for start in range(0, n, chunk):
+                ij_inds[0, start:start+chunk], ij_inds[1, start:start+chunk] = np.unravel_index(flat[start:start+chunk], data_shape)
+            if self._own_dir:
+                # the result owns its buffers so that `cleanup` can't pull them out from under it
+                import tempfile as tf
+                out_dir = tf.mkdtemp()
+            else:
+                out_dir = os.path.join(build_dir, 'csr')
+            data = ScipySparseArray.coo_to_cs(data_shape, vals, ij_inds,
+                                              memmap=out_dir,
+                                              assume_sorted=data_shape[0] <= data_shape[1]
+                                              )
+            new = ScipySparseArray(data, shape=shape, layout=layout, initialize=False)
+            if self._own_dir:
+                import shutil
+                weakref.finalize(new, shutil.rmtree, out_dir, ignore_errors=True)
+        else:
+            new = ScipySparseArray(None, shape=shape, layout=layout, initialize=False)
+            new._set_sorted_block_data(flat, vals, data_shape)
+        return new
+
+    def cleanup(self):
+        """
+        Removes the spilled runs (and the spill directory if it was created by the accumulator).
+        Memory mapped arrays returned by `to_sparse` keep their own buffers, which are
+        removed once the array is garbage collected.
+
+        :return:
+        :rtype:
+        """
+        import shutil
+
+        self._runs = []
+        if self._own_dir and self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+            self._own_dir = False
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cleanup()
+
+    def __repr__(self):
+        return "{}({}, buffered={}, runs={})".format(
+            type(self).__name__,
+            self.shape,
+            sum(len(c[0]) for c in self._chunks),
+            len(self._runs)
+        )
+
+def _block_dot(block, b):
+    return block.dot(b)
+def _parallel_block_dot(blocks=None, b=None, parallelizer=None):
+    return parallelizer.map(_block_dot, blocks, extra_args=(b,))
+def parallel_sparse_dot(a, b, parallelizer=None):
+    """
+    Takes the dot product of a sparse matrix with `b` by splitting `a`
+    into row blocks with roughly equal numbers of non-zero elements, multiplying each
+    block on a different process, and restacking the blocks
+
+    :param a:
+    :type a: sp.spmatrix
+    :param b:
+    :type b: sp.spmatrix | np.ndarray
+    :param parallelizer:
+    :type parallelizer: Parallelizer | str | None
+    :return:
+    :rtype: sp.csr_matrix | np.ndarray
+    """
+
+    par = parallelizer if isinstance(parallelizer, Parallelizer) else Parallelizer.lookup(parallelizer)
+    if isinstance(par, SerialNonParallelizer):
+        return a.dot(b)
+
+    a = sp.csr_matrix(a)
+    with par:
+        nblocks = par.nprocs + 1
+        cuts = np.searchsorted(a.indptr, np.linspace(0, a.nnz, nblocks + 1)[1:-1])
+        bounds = np.concatenate([[0], np.clip(cuts, 0, a.shape[0]), [a.shape[0]]])
+        blocks = [a[s:e] for s, e in zip(bounds[:-1], bounds[1:])]
+        res = par.run(_parallel_block_dot, main_kwargs={'blocks': blocks, 'b': b})
+
+    if isinstance(res[0], sp.spmatrix):
+        return sp.vstack(res, format='csr')
+    else:
+        return np.concatenate([np.asarray(r) for r in res], axis=0)
+
+def _dot(a, b, parallelizer=None):
     if isinstance(a, SparseArray):
         a = a.ascsr()
     if isinstance(b, SparseArray):
@@ -2611,7 +4048,10 @@ def _dot(a, b):
             # we convert it to a sparse thing to avoid memory blow-ups when we get dense unpacking...?
             b = sp.csr_matrix(b)
 
-        wat = a.dot(b)
+        if parallelizer is not None:
+            wat = parallel_sparse_dot(a, b, parallelizer)
+        else:
+            wat = a.dot(b)
         # raise Exception(wat.shape, a.shape, b.shape)
     else:
         dense_output = True
@@ -2633,7 +4073,7 @@ def _dot(a, b):
 #     if not isinstance(a, sp.coo_matrix):
 #         a = sp.coo_matrix(a)
 #     return a
-def sparse_tensordot(a, b, axes=2):
+def sparse_tensordot(a, b, axes=2, parallelizer=None):
     """Defines a version of tensordot that uses sparse arrays, adapted from the sparse package on PyPI
 
     :param a: the array to contract from
@@ -2642,10 +4082,18 @@ def sparse_tensordot(a, b, axes=2):
     :type b: SparseArray | sp.spmatrix | np.ndarray
     :param axes: the axes to contract along
     :type axes: int | Iterable[int]
+    :param parallelizer: a parallelizer to split the sparse matrix product over
+    (ignored if either operand is a `CSFSparseArray`, since those contract over their stored fibers directly)
+    :type parallelizer: Parallelizer | str | None
     :return:
     :rtype:
     """
 
+    if isinstance(a, CSFSparseArray):
+        return a.tensordot(b, axes=axes)
+    elif isinstance(b, CSFSparseArray):
+        return CSFSparseArray(a).tensordot(b, axes=axes)
+
     try:
         iter(axes)
     except TypeError:
@@ -2733,7 +4181,7 @@ def sparse_tensordot(a, b, axes=2):
         # if isinstance(bt, np.ndarray):
         #     bt = sp.csr_matrix(bt)
 
-        res = _dot(bt, at).transpose()
+        res = _dot(bt, at, parallelizer=parallelizer).transpose()
 
     else:
         if a.ndim > 1:
@@ -2748,7 +4196,7 @@ def sparse_tensordot(a, b, axes=2):
             bt = b
         bt = bt.reshape(newshape_b)
 
-        res = _dot(at, bt)
+        res = _dot(at, bt, parallelizer=parallelizer)
 
     if isinstance(res, sp.spmatrix):
         if isinstance(a, ScipySparseArray):
@@ -2760,4 +4208,199 @@ def sparse_tensordot(a, b, axes=2):
     else:
         res = res.reshape(olda + oldb)
 
-    return res
\ No newline at end of file
+    return res
+
+class SparseTensordotPlan:
+    """
+    Splits a sparse tensordot into a symbolic phase, which depends only on the sparsity
+    patterns of the operands and is done once, and a numeric phase, which can be
+    reapplied to new values that share those patterns.
+    The symbolic phase enumerates every pair of stored elements that contributes to the
+    output, so it takes memory proportional to the number of multiply-adds.
+    """
+
+    def __init__(self, a, b, axes=2):
+        """
+        :param a: the array whose sparsity pattern defines the left operand
+        :type a: SparseArray
+        :param b: the array whose sparsity pattern defines the right operand
+        :type b: SparseArray
+        :param axes: the axes to contract along
+        :type axes: int | Iterable[int] | Iterable[Iterable[int]]
+        """
+        if not isinstance(a, SparseArray):
+            a = ScipySparseArray(a)
+        if not isinstance(b, SparseArray):
+            b = ScipySparseArray(b)
+        self.a_shape = a.shape
+        self.b_shape = b.shape
+        self.target = type(a)
+        axes_a, axes_b = self._prep_axes(a.shape, b.shape, axes)
+        self.axes = (axes_a, axes_b)
+        free_a = [k for k in range(a.ndim) if k not in axes_a]
+        free_b = [k for k in range(b.ndim) if k not in axes_b]
+        self.shape = tuple(a.shape[k] for k in free_a) + tuple(b.shape[k] for k in free_b)
+        a_inds = a.block_data[1]
+        b_inds = b.block_data[1]
+        self.a_nnz = len(a_inds[0]) if a.ndim > 0 else 0
+        self.b_nnz = len(b_inds[0]) if b.ndim > 0 else 0
+        self.a_inds, self.b_inds, self.out_starts, self.out_inds = self._plan(
+            [a_inds[k] for k in free_a],
+            [a_inds[k] for k in axes_a],
+            [b_inds[k] for k in axes_b],
+            [b_inds[k] for k in free_b]
+        )
+        self._output_template = None
+
+    @staticmethod
+    def _prep_axes(a_shape, b_shape, axes):
+        try:
+            iter(axes)
+        except TypeError:
+            axes_a = list(range(len(a_shape) - axes, len(a_shape)))
+            axes_b = list(range(0, axes))
+        else:
+            axes_a, axes_b = axes
+        if isinstance(axes_a, (int, np.integer)):
+            axes_a = [axes_a]
+        if isinstance(axes_b, (int, np.integer)):
+            axes_b = [axes_b]
+        axes_a = [len(a_shape) + x if x < 0 else x for x in axes_a]
+        axes_b = [len(b_shape) + x if x < 0 else x for x in axes_b]
+        if len(axes_a) != len(axes_b) or any(a_shape[x] != b_shape[y] for x, y in zip(axes_a, axes_b)):
+            raise ValueError("shape-mismatch for sum ({}{}@{}{})".format(a_shape, axes_a, b_shape, axes_b))
+        return axes_a, axes_b
+
+    def _plan(self, a_free, a_shared, b_shared, b_free):
+        na = self.a_nnz
+        nb = self.b_nnz
+        rows, row_keys = CSFSparseArray._tuple_ids(a_free, na)
+        cols, col_keys = CSFSparseArray._tuple_ids(b_free, nb)
+        shared, _ = CSFSparseArray._tuple_ids(
+            [np.concatenate([x, y]) for x, y in zip(a_shared, b_shared)],
+            na + nb
+        )
+        a_shared = shared[:na]
+        b_shared = shared[na:]
+        nshared = (np.max(shared) + 1) if na + nb > 0 else 0
+
+        # every `a` element pairs with the whole block of `b` elements sharing its contracted indices
+        b_sorting = np.argsort(b_shared, kind='mergesort')
+        b_counts = np.bincount(b_shared, minlength=nshared)
+        b_starts = np.concatenate([[0], np.cumsum(b_counts)[:-1]])
+        pair_counts = b_counts[a_shared]
+        npairs = np.sum(pair_counts)
+        pair_offsets = np.cumsum(pair_counts) - pair_counts
+        a_idx = np.repeat(np.arange(na), pair_counts)
+        b_idx = b_sorting[
+            np.arange(npairs)
+            - np.repeat(pair_offsets, pair_counts)
+            + np.repeat(b_starts[a_shared], pair_counts)
+            ]
+
+        # group the pairs by the output element they contribute to
+        out_ids, out_keys = CSFSparseArray._tuple_ids([rows[a_idx], cols[b_idx]], npairs)
+        sorting = np.argsort(out_ids, kind='mergesort')
+        a_idx = downcast_index_array(a_idx[sorting], na)
+        b_idx = downcast_index_array(b_idx[sorting], nb)
+        out_ids = out_ids[sorting]
+        out_starts = np.nonzero(np.concatenate([[True], out_ids[1:] != out_ids[:-1]]))[0] if npairs > 0 else out_ids
+        if len(out_keys) > 0:
+            out_rows, out_cols = out_keys
+            out_inds = tuple(k[out_rows] for k in row_keys) + tuple(k[out_cols] for k in col_keys)
+        else:
+            out_inds = ()
+        return a_idx, b_idx, out_starts, out_inds
+
+    @staticmethod
+    def _get_vals(x, nnz):
+        if isinstance(x, SparseArray):
+            x = x.block_vals
+        x = np.asanyarray(x)
+        if len(x) != nnz:
+            raise ValueError("expected {} values to match the planned sparsity pattern, got {}".format(nnz, len(x)))
+        return x
+
+    def values(self, a_vals, b_vals):
+        """
+        Applies the numeric phase, returning the values of the stored output elements
+        in the order of `out_inds`
+
+        :param a_vals: the values of the left operand, ordered like the planned pattern's `block_vals`
+        :type a_vals: np.ndarray | SparseArray
+        :param b_vals: the values of the right operand, ordered like the planned pattern's `block_vals`
+        :type b_vals: np.ndarray | SparseArray
+        :return:
+        :rtype: np.ndarray
+        """
+        a_vals = self._get_vals(a_vals, self.a_nnz)
+        b_vals = self._get_vals(b_vals, self.b_nnz)
+        prods = a_vals[self.a_inds] * b_vals[self.b_inds]
+        if len(prods) == 0:
+            return prods
+        return np.add.reduceat(prods, self.out_starts)
+
+    def apply(self, a_vals, b_vals):
+        """
+        Applies the numeric phase and packages the result as a `SparseArray`
+        of the same type as the left pattern (or a scalar for a full contraction)
+
+        :param a_vals:
+        :type a_vals: np.ndarray | SparseArray
+        :param b_vals:
+        :type b_vals: np.ndarray | SparseArray
+        :return:
+        :rtype: SparseArray | float
+        """
+        vals = self.values(a_vals, b_vals)
+        # every result gets its own copy of the cached index arrays,
+        # so in-place updates to one result can't leak into the next
+        if len(self.shape) == 0:
+            return np.sum(vals)
+        elif self.target is CSFSparseArray:
+            return CSFSparseArray((vals, tuple(i.copy() for i in self.out_inds)), shape=self.shape, assume_sorted=True)
+        elif len(vals) == 0:
+            return ScipySparseArray((vals, tuple(i.copy() for i in self.out_inds)), shape=self.shape)
+        else:
+            fmt, indices, indptr, data_shape, data_order, block_inds, block_order = self._get_output_template()
+            data = fmt((vals[data_order], indices.copy(), indptr.copy()), shape=data_shape)
+            new = ScipySparseArray(data, shape=self.shape, initialize=False)
+            new._block_vals = vals[block_order]
+            flat, unflat = block_inds
+            new._block_inds = (flat.copy(), tuple(u.copy() for u in unflat))
+            new._block_data_sorted = True
+            return new
+
+    def _get_output_template(self):
+        """
+        Builds the sparse matrix structure of the output once, by pushing the
+        positions of the output values through the usual constructor, so that
+        `apply` only has to permute the new values into place
+
+        :return:
+        :rtype:
+        """
+        if self._output_template is None:
+            n = len(self.out_starts)
+            template = ScipySparseArray((np.arange(1, n + 1, dtype=float), self.out_inds), shape=self.shape)
+            data = template.data
+            self._output_template = (
+                type(data),
+                data.indices,
+                data.indptr,
+                data.shape,
+                data.data.astype(int) - 1,
+                template.block_inds,
+                template.block_vals.astype(int) - 1
+            )
+        return self._output_template
+    def __call__(self, a_vals, b_vals):
+        return self.apply(a_vals, b_vals)
+
+    def __repr__(self):
+        return "{}(<{}>x<{}> pairs={})".format(
+            type(self).__name__,
+            ", ".join(str(s) for s in self.a_shape),
+            ", ".join(str(s) for s in self.b_shape),
+            len(self.a_inds)
+        )
@@ -1,11 +1,18 @@
 
 from .VectorOps import vec_normalize, vec_angles
+from .Options import Options
 import math, numpy as np
 
 __all__ = [
     "rotation_matrix",
     "translation_matrix",
-    "affine_matrix"
+    "affine_matrix",
+    "quaternion_from_axis_angle",
+    "quaternion_multiply",
+    "quaternion_conjugate",
+    "quaternion_matrix",
+    "quaternion_from_matrix",
+    "quaternion_rotate"
 ]
 
 #######################################################################################################################
@@ -109,21 +116,11 @@ def rotation_matrix_ER_vec(axes, thetas):
     axes = np.asarray(axes)
     thetas = np.asarray(thetas)
     if len(axes.shape) == 1:
-        axes = axes/np.linalg.norm(axes)
         axes = np.broadcast_to(axes, (len(thetas), 3))
-    else:
-        axes = vec_normalize(axes)
 
-    a = np.cos(thetas/2.0)
-    b, c, d = ( -axes * np.reshape(np.sin(thetas / 2.0), (len(thetas), 1)) ).T
-    # raise Exception(axes)
-    aa, bb, cc, dd = a * a, b * b, c * c, d * d
-    bc, ad, ac, ab, bd, cd = b * c, a * d, a * c, a * b, b * d, c * d
-    return np.array([
-        [aa + bb - cc - dd, 2 * (bc + ad),     2 * (bd - ac)    ],
-        [2 * (bc - ad),     aa + cc - bb - dd, 2 * (cd + ab)    ],
-        [2 * (bd + ac),    2 * (cd - ab),     aa + dd - bb - cc]
-    ]).T
+    # the vectorized matrices have always been the transposes of the scalar ones
+    # (i.e. clockwise rotations), which the embedding code relies on
+    return quaternion_matrix(quaternion_from_axis_angle(axes, -thetas))
 
 def rotation_matrix_align_vectors(vec1, vec2):
     angles, normals = vec_angles(vec1, vec2)
@@ -139,6 +136,11 @@ def rotation_matrix(axis, theta):
     :rtype:
     """
 
+    if Options.dtype is not None:
+        theta = Options.cast(theta)
+        if type(axis) != str:
+            axis = Options.cast(axis)
+
     try:
         flen = len(theta)
     except TypeError:
@@ -170,18 +172,190 @@ def rotation_matrix(axis, theta):
         else:
             mat_fun = rotation_matrix_ER
 
-    mats = mat_fun(axis, theta)
+    mats = Options.cast(mat_fun(axis, theta)) # the scalar constructors go through python floats
     if extra_shape is not None:
         mats = mats.reshape(extra_shape + (3, 3))
     return mats
 
+#######################################################################################################################
+#
+#                                                 quaternions
+#
+# quaternions are stored scalar-first, i.e. as (w, x, y, z), along the last axis and
+# all of the functions here broadcast over any leading axes
+
+def _quat_dtype(*arrays):
+    if Options.dtype is not None:
+        return Options.dtype
+    return np.result_type(*[np.asanyarray(a).dtype for a in arrays], np.float16)
+
+def quaternion_from_axis_angle(axes, thetas):
+    """
+    Returns the unit quaternions for counterclockwise rotations by `thetas` about `axes`
+
+    :param axes: rotation axes (need not be normalized)
+    :type axes: np.ndarray
+    :param thetas: rotation angles in radians
+    :type thetas: np.ndarray | float
+    :return:
+    :rtype: np.ndarray
+    """
+    axes = np.asanyarray(Options.cast(axes))
+    thetas = np.asanyarray(Options.cast(thetas))
+    dtype = _quat_dtype(axes, thetas)
+    shape = np.broadcast_shapes(axes.shape[:-1], thetas.shape)
+    half = thetas.astype(dtype, copy=False) / 2
+    quats = np.empty(shape + (4,), dtype=dtype)
+    quats[..., 0] = np.cos(half)
+    np.multiply(vec_normalize(axes.astype(dtype, copy=False)), np.sin(half)[..., np.newaxis], out=quats[..., 1:])
+    return quats
+
+def quaternion_multiply(q1, q2):
+    """
+    Composes two (stacks of) quaternions, so that rotating by the product
+    is the same as rotating by `q2` and then by `q1`
+
+    :param q1:
+    :type q1: np.ndarray
+    :param q2:
+    :type q2: np.ndarray
+    :return:
+    :rtype: np.ndarray
+    """
+    q1 = np.asanyarray(q1)
+    q2 = np.asanyarray(q2)
+    w1, x1, y1, z1 = np.moveaxis(q1, -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(q2, -1, 0)
+    prod = np.empty(np.broadcast_shapes(q1.shape, q2.shape), dtype=_quat_dtype(q1, q2))
+    prod[..., 0] = w1*w2 - x1*x2 - y1*y2 - z1*z2
+    prod[..., 1] = w1*x2 + x1*w2 + y1*z2 - z1*y2
+    prod[..., 2] = w1*y2 - x1*z2 + y1*w2 + z1*x2
+    prod[..., 3] = w1*z2 + x1*y2 - y1*x2 + z1*w2
+    return prod
+
+def quaternion_conjugate(quats):
+    """
+    Returns the conjugate (i.e. the inverse rotation for unit) quaternions
+
+    :param quats:
+    :type quats: np.ndarray
+    :return:
+    :rtype: np.ndarray
+    """
+    conj = np.array(quats, dtype=_quat_dtype(quats))
+    conj[..., 1:] *= -1
+    return conj
+
+def quaternion_matrix(quats):
+    """
+    Returns the rotation matrices for a stack of unit quaternions
+
+    :param quats:
+    :type quats: np.ndarray
+    :return:
+    :rtype: np.ndarray
+    """
+    quats = np.asanyarray(quats)
+    w, x, y, z = np.moveaxis(quats, -1, 0)
+    ww, xx, yy, zz = w*w, x*x, y*y, z*z
+    xy, wz, xz, wy, yz, wx = x*y, w*z, x*z, w*y, y*z, w*x
+    mats = np.empty(quats.shape[:-1] + (3, 3), dtype=_quat_dtype(quats))
+    mats[..., 0, 0] = ww + xx - yy - zz
+    mats[..., 0, 1] = 2 * (xy - wz)
+    mats[..., 0, 2] = 2 * (xz + wy)
+    mats[..., 1, 0] = 2 * (xy + wz)
+    mats[..., 1, 1] = ww - xx + yy - zz
+    mats[..., 1, 2] = 2 * (yz - wx)
+    mats[..., 2, 0] = 2 * (xz - wy)
+    mats[..., 2, 1] = 2 * (yz + wx)
+    mats[..., 2, 2] = ww - xx - yy + zz
+    return mats
+
+def quaternion_from_matrix(mats):
+    """
+    Returns unit quaternions (with non-negative scalar part) for a stack of rotation matrices,
+    picking the numerically best-conditioned branch of Shepperd's method for each matrix
+
+    :param mats:
+    :type mats: np.ndarray
+    :return:
+    :rtype: np.ndarray
+    """
+    mats = np.asanyarray(mats)
+    dtype = _quat_dtype(mats)
+    diag = np.stack([
+        mats[..., 0, 0] + mats[..., 1, 1] + mats[..., 2, 2],
+        mats[..., 0, 0],
+        mats[..., 1, 1],
+        mats[..., 2, 2]
+    ], axis=-1).astype(dtype, copy=False)
+    branch = np.argmax(diag, axis=-1)
+
+    quats = np.empty(mats.shape[:-2] + (4,), dtype=dtype)
+    # trace branch
+    sel = branch == 0
+    if sel.any():
+        m = mats[sel]
+        quats[sel] = np.stack([
+            1 + diag[sel][..., 0],
+            m[..., 2, 1] - m[..., 1, 2],
+            m[..., 0, 2] - m[..., 2, 0],
+            m[..., 1, 0] - m[..., 0, 1]
+        ], axis=-1)
+    # diagonal branches, with (i, j, k) cyclic
+    for i in range(3):
+        sel = branch == i + 1
+        if not sel.any():
+            continue
+        j = (i + 1) % 3
+        k = (i + 2) % 3
+        m = mats[sel]
+        q = np.empty(m.shape[:-2] + (4,), dtype=dtype)
+        q[..., 0] = m[..., k, j] - m[..., j, k]
+        q[..., 1 + i] = 1 + 2 * m[..., i, i] - diag[sel][..., 0]
+        q[..., 1 + j] = m[..., j, i] + m[..., i, j]
+        q[..., 1 + k] = m[..., k, i] + m[..., i, k]
+        quats[sel] = q
+
+    quats = vec_normalize(quats)
+    flip = quats[..., 0] < 0
+    quats[flip] *= -1
+    return quats
+
+def quaternion_rotate(quats, coords, center=None, out=None):
+    """
+    Rotates a stack of coordinate frames by a stack of quaternions in a single batched product,
+    e.g. `(n_frames, 4)` quaternions applied to `(n_frames, n_atoms, 3)` coordinates
+
+    :param quats:
+    :type quats: np.ndarray
+    :param coords:
+    :type coords: np.ndarray
+    :param center: the point (or points, one per frame) to rotate about
+    :type center: np.ndarray | None
+    :param out: an array to write the rotated coordinates into
+    :type out: np.ndarray | None
+    :return:
+    :rtype: np.ndarray
+    """
+    coords = np.asanyarray(Options.cast(coords))
+    mats = quaternion_matrix(quats).astype(_quat_dtype(quats, coords), copy=False)
+    mats = np.swapaxes(mats, -1, -2) # we multiply row vectors from the right
+    if center is None:
+        return np.matmul(coords, mats, out=out)
+    center = np.expand_dims(np.asanyarray(Options.cast(center)), -2)
+    out = np.matmul(coords - center, mats, out=out)
+    out += center
+    return out
+
 #######################################################################################################################
 #
 #                                                 translation_matrix
 #
 
 def translation_matrix(shift):
-    share = np.asarray(shift)
+    share = np.asarray(Options.cast(shift))
+    dtype = np.result_type(share.dtype, np.float16)
     if len(share.shape) == 1:
         ss = share
         zs = 0.
@@ -192,11 +366,12 @@ def translation_matrix(shift):
                 [zs, os, zs, ss[1]],
                 [zs, zs, os, ss[2]],
                 [zs, zs, zs, os   ]
-            ]
+            ],
+            dtype=dtype
         )
     else:
-        zs = np.zeros((share.shape[0],))
-        os = np.ones((share.shape[0],))
+        zs = np.zeros((share.shape[0],), dtype=dtype)
+        os = np.ones((share.shape[0],), dtype=dtype)
         ss = share.T
         mat = np.array(
             [
@@ -224,9 +399,10 @@ def affine_matrix(tmat, shift):
     :rtype:
     """
 
-    base_mat = np.asanyarray(tmat)
+    base_mat = np.asanyarray(Options.cast(tmat))
     if shift is None:
         return base_mat
+    shift = np.asanyarray(Options.cast(shift))
 
     if base_mat.ndim > 2:
         shifts = np.asanyarray(shift)
@@ -235,7 +411,7 @@ def affine_matrix(tmat, shift):
         shifts = np.broadcast_to(shifts, base_mat.shape[:-2] + (3,))
         shifts = np.expand_dims(shifts, -1)
         mat = np.concatenate([base_mat, shifts], axis=-1)
-        padding = np.array([0., 0., 0., 1.])
+        padding = np.array([0., 0., 0., 1.], dtype=mat.dtype)
         padding = np.broadcast_to(
             np.broadcast_to(padding, (1,)*(base_mat.ndim-2) + padding.shape),
             mat.shape[:-2] + (4,)
@@ -244,5 +420,5 @@ def affine_matrix(tmat, shift):
         mat = np.concatenate([mat, padding], axis=-2)
     else:
         mat = np.concatenate([base_mat, shift[:, np.newaxis]], axis=-1)
-        mat = np.concatenate([mat, [[0., 0., 0., 1.]]], axis=-2)
+        mat = np.concatenate([mat, np.array([[0., 0., 0., 1.]], dtype=mat.dtype)], axis=-2)
     return mat
\ No newline at end of file
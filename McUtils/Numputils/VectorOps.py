@@ -2,10 +2,12 @@
 A module of useful math for handling coordinate transformations and things
 """
 
-import numpy as np
+import numpy as np, functools, string
+from ..Misc import jit, import_from_numba
 from .Options import Options
 
 __all__ = [
+    "VectorWorkspace",
     "vec_dots",
     "vec_handle_zero_norms",
     "vec_apply_zero_threshold",
@@ -18,10 +20,12 @@ __all__ = [
     "vec_sins",
     "vec_cos",
     "vec_outer",
+    "vec_einsum",
     "pts_norms",
     "pts_angles",
     "pts_normals",
     "pts_dihedrals",
+    "internal_coordinates",
     "mat_vec_muls",
     "one_pad_vecs",
     "affine_multiply",
@@ -38,6 +42,68 @@ __all__ = [
 #       But then there's also like "vec_tensordot" which is explicitly non-vector in scope...
 #       Not sure what exactly I want with this. Lots of stuff TBD.
 
+################################################
+#
+#       VectorWorkspace
+#
+class VectorWorkspace:
+    """
+    A pool of scratch buffers, keyed by name, shape, and dtype, that the vector ops
+    can reuse across calls so that tight loops don't have to allocate temporaries
+    """
+    def __init__(self):
+        self._buffers = {}
+    def get(self, name, shape, dtype=float):
+        """
+        Returns the (uninitialized) buffer for `name` with the given shape and dtype
+
+        :param name:
+        :type name: str
+        :param shape:
+        :type shape: tuple[int]
+        :param dtype:
+        :type dtype: np.dtype
+        :return:
+        :rtype: np.ndarray
+        """
+        key = (name, tuple(shape), np.dtype(dtype))
+        buf = self._buffers.get(key, None)
+        if buf is None:
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[key] = buf
+        return buf
+    @property
+    def nbytes(self):
+        return sum(b.nbytes for b in self._buffers.values())
+    def clear(self):
+        self._buffers = {}
+    def __len__(self):
+        return len(self._buffers)
+    def __repr__(self):
+        return "{}(<{} buffers>, nbytes={})".format(type(self).__name__, len(self), self.nbytes)
+
+def _scratch(workspace, name, shape, dtype=float):
+    if workspace is None:
+        return np.empty(shape, dtype=dtype)
+    else:
+        return workspace.get(name, shape, dtype=dtype)
+
+def _float_dtype(*arrays):
+    return np.result_type(*[a.dtype for a in arrays], np.float16)
+
+def _policy_einsum_kwargs():
+    acc = Options.accumulation_dtype
+    if acc is None or acc == Options.dtype:
+        return {}
+    return dict(dtype=acc, casting='unsafe')
+
+def _policy_dots(vecs1, vecs2):
+    # dot products under the working precision policy, accumulated in the accumulation dtype
+    acc = Options.accumulation_dtype
+    if acc == Options.dtype:
+        return np.einsum('...i,...i->...', vecs1, vecs2)
+    return np.einsum('...i,...i->...', vecs1, vecs2, dtype=acc).astype(Options.dtype)
+
 ################################################
 #
 #       vec_dots
@@ -52,6 +118,9 @@ def vec_dots(vecs1, vecs2, axis=-1):
     :type vecs2:
     """
 
+    if Options.dtype is not None and axis == -1:
+        return _policy_dots(Options.cast(vecs1), Options.cast(vecs2))
+
     vecs1 = np.expand_dims(vecs1, axis-1)
     vecs2 = np.expand_dims(vecs2, axis)
     res = np.matmul(vecs1, vecs2)
@@ -80,6 +149,9 @@ def vec_norms(vecs, axis=-1):
     """
     if axis != -1:
         raise NotImplementedError("Norm along not-the-last axis not there yet...")
+    if Options.dtype is not None:
+        vecs = Options.cast(vecs)
+        return np.sqrt(_policy_dots(vecs, vecs))
     return np.linalg.norm(vecs, axis=-1)
 
 ################################################
@@ -123,22 +195,48 @@ def vec_handle_zero_norms(vecs, norms, zero_thresh=None):
     norms = norms[..., np.newaxis]
     zero_thresh = Options.norm_zero_threshold if zero_thresh is None else zero_thresh
     zeros = np.abs(norms) < zero_thresh
-    vecs = vecs * (1 - zeros.astype(int))
+    vecs = vecs * np.logical_not(zeros) # multiplying by bools keeps the dtype of vecs
     return vecs, zeros
 
-def vec_normalize(vecs, axis=-1, zero_thresh=None):
+def _normalize_into(vecs, out, zero_thresh, workspace, inclusive=False):
+    norms = _scratch(workspace, 'normalize.norms', vecs.shape[:-1] + (1,), out.dtype)
+    zeros = _scratch(workspace, 'normalize.zeros', norms.shape, bool)
+    np.einsum('...i,...i->...', vecs, vecs, out=norms[..., 0], **_policy_einsum_kwargs())
+    np.sqrt(norms, out=norms)
+    zero_thresh = Options.norm_zero_threshold if zero_thresh is None else zero_thresh
+    if inclusive:
+        np.less_equal(norms, zero_thresh, out=zeros)
+    else:
+        np.less(norms, zero_thresh, out=zeros)
+    np.copyto(norms, Options.zero_placeholder, where=zeros)
+    np.divide(vecs, norms, out=out)
+    np.copyto(out, 0., where=zeros)
+    return out
+
+def vec_normalize(vecs, axis=-1, zero_thresh=None, out=None, workspace=None):
     """
 
     :param vecs:
     :type vecs: np.ndarray
     :param axis:
     :type axis: int
+    :param out: an array to write the normalized vectors into
+    :type out: np.ndarray | None
+    :param workspace: a pool of scratch buffers to reuse for temporaries
+    :type workspace: VectorWorkspace | None
     :return:
     :rtype:
     """
     if axis != -1:
         raise NotImplementedError("Normalization along not-the-last axis not there yet...")
 
+    vecs = Options.cast(vecs)
+    if out is not None or workspace is not None:
+        vecs = np.asanyarray(vecs)
+        if out is None:
+            out = np.empty(vecs.shape, dtype=_float_dtype(vecs))
+        return _normalize_into(vecs, out, zero_thresh, workspace)
+
     norms = vec_norms(vecs, axis=axis)
     vecs, zeros = vec_handle_zero_norms(vecs, norms, zero_thresh=zero_thresh)
     norms = norms[..., np.newaxis]
@@ -151,7 +249,51 @@ def vec_normalize(vecs, axis=-1, zero_thresh=None):
 #       vec_crosses
 #
 
-def vec_crosses(vecs1, vecs2, normalize=False, zero_thresh=None, axis=-1):
+def _cross_into(a, b, out, workspace):
+    if np.may_share_memory(out, a) or np.may_share_memory(out, b):
+        res = _scratch(workspace, 'crosses.res', out.shape, out.dtype)
+    else:
+        res = out
+    tmp = _scratch(workspace, 'crosses.tmp', out.shape[:-1], out.dtype)
+    for i, (j, k) in enumerate([(1, 2), (2, 0), (0, 1)]):
+        np.multiply(a[..., j], b[..., k], out=res[..., i])
+        np.multiply(a[..., k], b[..., j], out=tmp)
+        np.subtract(res[..., i], tmp, out=res[..., i])
+    if res is not out:
+        np.copyto(out, res)
+    return out
+
+def vec_crosses(vecs1, vecs2, normalize=False, zero_thresh=None, axis=-1, out=None, workspace=None):
+    """
+    Gets the cross products of two stacks of 3D vectors
+
+    :param vecs1:
+    :type vecs1: np.ndarray
+    :param vecs2:
+    :type vecs2: np.ndarray
+    :param normalize: whether to normalize the cross products
+    :type normalize: bool
+    :param out: an array to write the cross products into
+    :type out: np.ndarray | None
+    :param workspace: a pool of scratch buffers to reuse for temporaries
+    :type workspace: VectorWorkspace | None
+    :return:
+    :rtype: np.ndarray
+    """
+    vecs1 = Options.cast(vecs1)
+    vecs2 = Options.cast(vecs2)
+    if out is not None or workspace is not None:
+        if axis != -1:
+            raise NotImplementedError("preallocated cross products along not-the-last axis not there yet...")
+        vecs1 = np.asanyarray(vecs1)
+        vecs2 = np.asanyarray(vecs2)
+        if out is None:
+            out = np.empty(np.broadcast_shapes(vecs1.shape, vecs2.shape), dtype=_float_dtype(vecs1, vecs2))
+        _cross_into(vecs1, vecs2, out, workspace)
+        if normalize:
+            _normalize_into(out, out, zero_thresh, workspace, inclusive=True)
+        return out
+
     crosses = np.cross(vecs1, vecs2, axis=axis)
     if normalize:
         norms = vec_norms(crosses, axis=axis)
@@ -231,7 +373,42 @@ def vec_sins(vectors1, vectors2, zero_thresh=None, axis=-1):
 #
 #       vec_angles
 #
-def vec_angles(vectors1, vectors2, up_vectors=None, zero_thresh=None, axis=-1):
+def _angles_into(vectors1, vectors2, up_vectors, zero_thresh, out, workspace):
+    dtype = out.dtype
+    shape = out.shape
+    acc = _policy_einsum_kwargs()
+    crosses = _scratch(workspace, 'angles.crosses', shape + (3,), dtype)
+    _cross_into(vectors1, vectors2, crosses, workspace)
+    dots = _scratch(workspace, 'angles.dots', shape, dtype)
+    norm_prod = _scratch(workspace, 'angles.norm_prod', shape, dtype)
+    norms2 = _scratch(workspace, 'angles.norms2', shape, dtype)
+    cross_norms = _scratch(workspace, 'angles.cross_norms', shape, dtype)
+    bad = _scratch(workspace, 'angles.bad', shape, bool)
+
+    np.einsum('...i,...i->...', vectors1, vectors2, out=dots, **acc)
+    np.einsum('...i,...i->...', vectors1, vectors1, out=norm_prod, **acc)
+    np.einsum('...i,...i->...', vectors2, vectors2, out=norms2, **acc)
+    np.multiply(norm_prod, norms2, out=norm_prod)
+    np.sqrt(norm_prod, out=norm_prod)
+    zero_thresh = Options.norm_zero_threshold if zero_thresh is None else zero_thresh
+    np.less_equal(norm_prod, zero_thresh, out=bad)
+    np.copyto(norm_prod, 1., where=bad)
+    np.einsum('...i,...i->...', crosses, crosses, out=cross_norms, **acc)
+    np.sqrt(cross_norms, out=cross_norms)
+
+    np.divide(cross_norms, norm_prod, out=cross_norms)
+    np.divide(dots, norm_prod, out=dots)
+    np.arctan2(cross_norms, dots, out=out)
+    np.copyto(out, 0., where=bad)
+
+    if up_vectors is not None:
+        np.einsum('...i,...i->...', up_vectors, crosses, out=dots, **acc)
+        np.sign(dots, out=dots)
+        np.multiply(out, dots, out=out)
+
+    return out, crosses
+
+def vec_angles(vectors1, vectors2, up_vectors=None, zero_thresh=None, axis=-1, out=None, workspace=None):
     """
     Gets the angles and normals between two vectors
 
@@ -241,9 +418,23 @@ def vec_angles(vectors1, vectors2, up_vectors=None, zero_thresh=None, axis=-1):
     :type vectors2: np.ndarray
     :param up_vectors: orientation vectors to obtain signed angles
     :type up_vectors: None | np.ndarray
+    :param out: an array to write the angles into
+    :type out: np.ndarray | None
+    :param workspace: a pool of scratch buffers to reuse for temporaries (the returned normals live in it)
+    :type workspace: VectorWorkspace | None
     :return: angles and normals between two vectors
     :rtype: (np.ndarray, np.ndarray)
     """
+    vectors1 = Options.cast(vectors1)
+    vectors2 = Options.cast(vectors2)
+    if out is not None or workspace is not None:
+        if axis != -1:
+            raise NotImplementedError("preallocated angles along not-the-last axis not there yet...")
+        vectors1 = np.asanyarray(vectors1)
+        vectors2 = np.asanyarray(vectors2)
+        if out is None:
+            out = np.empty(np.broadcast_shapes(vectors1.shape, vectors2.shape)[:-1], dtype=_float_dtype(vectors1, vectors2))
+        return _angles_into(vectors1, vectors2, up_vectors, zero_thresh, out, workspace)
     dots    = vec_dots(vectors1, vectors2, axis=axis)
     crosses = vec_crosses(vectors1, vectors2, axis=axis)
     norms1  = vec_norms(vectors1, axis=axis)
@@ -275,6 +466,31 @@ def vec_angles(vectors1, vectors2, up_vectors=None, zero_thresh=None, axis=-1):
 #
 #       vec_normals
 #
+@functools.lru_cache(maxsize=256)
+def _vec_outer_plan(a_shape, b_shape, a_ax, b_ax):
+    a_ndim = len(a_shape)
+    a_ax = [ax + a_ndim if ax<0 else ax for ax in a_ax]
+    a_leftover = [x for x in range(a_ndim) if x not in a_ax]
+    a_transp = a_leftover + a_ax
+    a_old_shape = [a_shape[x] for x in a_leftover]
+    a_subshape = [a_shape[x] for x in a_ax]
+    a_contract = a_old_shape + [np.prod(a_subshape)]
+
+    b_ndim = len(b_shape)
+    b_ax = [ax + b_ndim if ax<0 else ax for ax in b_ax]
+    b_leftover = [x for x in range(b_ndim) if x not in b_ax]
+    b_transp = b_leftover + b_ax
+    b_old_shape = [b_shape[x] for x in b_leftover]
+    b_subshape = [b_shape[x] for x in b_ax]
+    b_contract = b_old_shape + [np.prod(b_subshape)]
+
+    # base assumption is that a_old_shape == b_old_shape
+    # if not we'll get an error anyway
+    final_shape = a_old_shape + a_subshape + b_subshape
+    final_transp = np.argsort(a_leftover + a_ax + b_ax)
+
+    return a_transp, a_contract, b_transp, b_contract, final_shape, final_transp
+
 def vec_outer(a, b, axes=None):
     """
     Provides the outer product of a and b in a vectorized way.
@@ -299,46 +515,21 @@ def vec_outer(a, b, axes=None):
         else:
             axes = [0, 0]
 
-    # we figure out how we'd conver
-    a_ax = axes[0]
-    if isinstance(a_ax, (int, np.integer)):
-        a_ax = [a_ax]
-    a_ax = [ax + a.ndim if ax<0 else ax for ax in a_ax]
-    a_leftover = [x for x in range(a.ndim) if x not in a_ax]
-    a_transp = a_leftover + a_ax
-    a_shape = a.shape
-    a_old_shape = [a_shape[x] for x in a_leftover]
-    a_subshape = [a_shape[x] for x in a_ax]
-    a_contract = a_old_shape + [np.prod(a_subshape)]
-
-    b_ax = axes[1]
-    if isinstance(b_ax, (int, np.integer)):
-        b_ax = [b_ax]
-    b_ax = [ax + b.ndim if ax<0 else ax for ax in b_ax]
-    b_leftover = [x for x in range(b.ndim) if x not in b_ax]
-    b_transp = b_leftover + b_ax
-    b_shape = b.shape
-    b_old_shape = [b_shape[x] for x in b_leftover]
-    b_subshape = [b_shape[x] for x in b_ax]
-    b_contract = b_old_shape + [np.prod(b_subshape)]
+    # the transpositions only depend on the shapes, so we cache them
+    a_ax, b_ax = axes
+    a_ax = (a_ax,) if isinstance(a_ax, (int, np.integer)) else tuple(a_ax)
+    b_ax = (b_ax,) if isinstance(b_ax, (int, np.integer)) else tuple(b_ax)
+    a_transp, a_contract, b_transp, b_contract, final_shape, final_transp = _vec_outer_plan(
+        a.shape, b.shape, a_ax, b_ax
+    )
 
     a_new = a.transpose(a_transp).reshape(a_contract)
     b_new = b.transpose(b_transp).reshape(b_contract)
 
-    if b_new.ndim < a_new.ndim:
-        ...
-    elif a_new.ndim < b_new.ndim:
-        ...
-
     outer = a_new[..., :, np.newaxis] * b_new[..., np.newaxis, :]
 
     # now we put the shapes right again and revert the transposition
-    # base assumption is that a_old_shape == b_old_shape
-    # if not we'll get an error anyway
-    final_shape = a_old_shape + a_subshape + b_subshape
-
     res = outer.reshape(final_shape)
-    final_transp = np.argsort(a_leftover + a_ax + b_ax)
 
     return res.transpose(final_transp)
 
@@ -346,9 +537,63 @@ def vec_outer(a, b, axes=None):
 #
 #   vec_tensordot
 #
+@functools.lru_cache(maxsize=256)
+def _vec_tensordot_plan(as_, bs, axes_a, axes_b, shared):
+    nda = len(as_)
+    ndb = len(bs)
+    na = len(axes_a)
+    nb = len(axes_b)
+    axes_a = list(axes_a)
+    axes_b = list(axes_b)
+
+    if na != nb:
+        raise ValueError("{}: shape-mismatch ({}) and ({}) in number of axes to contract over".format(
+            "vec_tensordot",
+            na,
+            nb
+        ))
+    else:
+        for k in range(na):
+            if as_[axes_a[k]] != bs[axes_b[k]]:
+                raise ValueError("{}: shape-mismatch ({}) and ({}) in contraction over axes ({}) and ({})".format(
+                    "vec_tensordot",
+                    axes_a[k],
+                    axes_b[k],
+                    na,
+                    nb
+                    ))
+            if axes_a[k] < 0:
+                axes_a[k] += nda
+            if axes_b[k] < 0:
+                axes_b[k] += ndb
+
+    # Move the axes to sum over to the end of "a"
+    # and to the front of "b"
+    # preserve things so that the "shared" stuff remains at the fron of both of these...
+    notin_a = [k for k in range(shared, nda) if k not in axes_a]
+    newaxes_a = list(range(shared)) + notin_a + axes_a
+    N2_a = 1
+    for axis in axes_a:
+        N2_a *= as_[axis]
+    newshape_a = as_[:shared] + (int(np.prod([as_[ax] for ax in notin_a if ax >= shared])), N2_a)
+    olda = [as_[axis] for axis in notin_a if axis >= shared]
+
+    notin_b = [k for k in range(shared, ndb) if k not in axes_b]
+    newaxes_b = list(range(shared)) + axes_b + notin_b
+    N2_b = 1
+    for axis in axes_b:
+        N2_b *= bs[axis]
+    newshape_b = as_[:shared] + (N2_b, int(np.prod([bs[ax] for ax in notin_b if ax >= shared])))
+    oldb = [bs[axis] for axis in notin_b if axis >= shared]
+
+    final_shape = list(as_[:shared]) + olda + oldb
+
+    return newaxes_a, newshape_a, newaxes_b, newshape_b, final_shape
+
 def vec_tensordot(tensa, tensb, axes=2, shared=None):
     """Defines a version of tensordot that uses matmul to operate over stacks of things
-    Basically had to duplicate the code for regular tensordot but then change the final call
+    Basically had to duplicate the code for regular tensordot but then change the final call.
+    The transpositions and reshapes only depend on the shapes and axes, so they're cached.
 
     :param tensa:
     :type tensa:
@@ -400,60 +645,147 @@ def vec_tensordot(tensa, tensb, axes=2, shared=None):
     if shared == 0: #easier to just delegate here than handle more special cases
         return np.tensordot(a, b, axes=axes)
 
-    as_ = a_shape
-    nda = a.ndim
-    bs = b.shape
-    ndb = b.ndim
-
-    equal = True
-    if na != nb:
-        equal = False
-        raise ValueError("{}: shape-mismatch ({}) and ({}) in number of axes to contract over".format(
-            "vec_tensordot",
-            na,
-            nb
-        ))
-    else:
-        for k in range(na):
-            if as_[axes_a[k]] != bs[axes_b[k]]:
-                equal = False
-                raise ValueError("{}: shape-mismatch ({}) and ({}) in contraction over axes ({}) and ({})".format(
-                    "vec_tensordot",
-                    axes_a[k],
-                    axes_b[k],
-                    na,
-                    nb
-                    ))
-            if axes_a[k] < 0:
-                axes_a[k] += nda
-            if axes_b[k] < 0:
-                axes_b[k] += ndb
-
-    # Move the axes to sum over to the end of "a"
-    # and to the front of "b"
-    # preserve things so that the "shared" stuff remains at the fron of both of these...
-    notin_a = [k for k in range(shared, nda) if k not in axes_a]
-    newaxes_a = list(range(shared)) + notin_a + axes_a
-    N2_a = 1
-    for axis in axes_a:
-        N2_a *= as_[axis]
-    newshape_a = as_[:shared] + (int(np.product([as_[ax] for ax in notin_a if ax >= shared])), N2_a)
-    olda = [as_[axis] for axis in notin_a if axis >= shared]
-
-    notin_b = [k for k in range(shared, ndb) if k not in axes_b]
-    newaxes_b = list(range(shared)) + axes_b + notin_b
-    N2_b = 1
-    for axis in axes_b:
-        N2_b *= bs[axis]
-    newshape_b = as_[:shared] + (N2_b, int(np.product([bs[ax] for ax in notin_b if ax >= shared])))
-    oldb = [bs[axis] for axis in notin_b if axis >= shared]
+    newaxes_a, newshape_a, newaxes_b, newshape_b, final_shape = _vec_tensordot_plan(
+        tuple(a_shape), tuple(b_shape), tuple(axes_a), tuple(axes_b), shared
+    )
 
     at = a.transpose(newaxes_a).reshape(newshape_a)
     bt = b.transpose(newaxes_b).reshape(newshape_b)
     res = np.matmul(at, bt)
-    final_shape = list(a_shape[:shared]) + olda + oldb
-    # raise Exception(res.shape, final_shape)
     return res.reshape(final_shape)
+
+#################################################################################
+#
+#   vec_einsum
+#
+def _einsum_split(subscripts):
+    if '->' in subscripts:
+        inputs, output = subscripts.split('->')
+    else:
+        inputs = subscripts
+        labels = inputs.replace(',', '').replace('.', '')
+        output = "".join(sorted(c for c in set(labels) if labels.count(c) == 1))
+        if '...' in inputs:
+            output = '...' + output
+    return inputs.split(','), output
+
+def _einsum_pair_plan(a, b, remaining, sizes):
+    # labels in both operands that survive the step are batch axes (like `shared` in `vec_tensordot`),
+    # the rest of the common labels are summed over
+    common = [c for c in a if c in b]
+    if not all(c in remaining for c in a + b if c not in common):
+        return None
+    batch = [c for c in common if c in remaining]
+    summed = [c for c in common if c not in remaining]
+    free_a = [c for c in a if c not in common]
+    free_b = [c for c in b if c not in common]
+    kept = "".join(batch + free_a + free_b)
+    if len(batch) == 0:
+        axes = ([a.index(c) for c in summed], [b.index(c) for c in summed])
+        return 'tensordot', axes, kept
+    batch_shape = tuple(sizes[c] for c in batch)
+    prod = lambda labs: int(np.prod([sizes[c] for c in labs]))
+    spec = (
+        tuple(a.index(c) for c in batch + free_a + summed),
+        batch_shape + (prod(free_a), prod(summed)),
+        tuple(b.index(c) for c in batch + summed + free_b),
+        batch_shape + (prod(summed), prod(free_b)),
+        tuple(sizes[c] for c in kept)
+    )
+    return 'matmul', spec, kept
+
+@functools.lru_cache(maxsize=256)
+def _einsum_plan(subscripts, shapes, optimize):
+    inputs, output = _einsum_split(subscripts)
+    if any('...' in x for x in inputs):
+        return None # broadcast labels aren't worth tracking by hand, just let np.einsum do it
+    # zero-stride views let us plan without allocating anything
+    dummies = [np.broadcast_to(np.empty((), dtype=float), s) for s in shapes]
+    if isinstance(optimize, tuple):
+        optimize = list(optimize)
+    path, _ = np.einsum_path(subscripts, *dummies, optimize=optimize)
+    sizes = {c: n for x, s in zip(inputs, shapes) for c, n in zip(x, s)}
+
+    # we run the path ourselves as a sequence of pairwise contractions,
+    # using the same operand bookkeeping as np.einsum (contracted operands are
+    # popped in reverse order and the intermediate is appended to the end)
+    steps = []
+    subs = list(inputs)
+    for contract in path[1:]:
+        contract = tuple(sorted(contract, reverse=True))
+        picked = [subs.pop(x) for x in contract]
+        remaining = set("".join(subs) + output)
+        if len(picked) == 2 and all(len(set(x)) == len(x) for x in picked):
+            pair = _einsum_pair_plan(*picked, remaining, sizes)
+            if pair is not None:
+                method, spec, kept = pair
+                steps.append((contract, method, spec))
+                subs.append(kept)
+                continue
+        kept = "".join(c for c in dict.fromkeys("".join(picked)) if c in remaining)
+        steps.append((contract, 'einsum', ",".join(picked) + '->' + kept))
+        subs.append(kept)
+
+    final = subs[0]
+    perm = None if final == output else tuple(final.index(c) for c in output)
+    return steps, perm
+
+def _einsum_shared_subscripts(subscripts, ndims, shared):
+    letters = [c for c in string.ascii_letters if c not in subscripts][:shared]
+    if len(letters) < shared:
+        raise ValueError("not enough free labels to share {} axes in {}".format(shared, subscripts))
+    batch = "".join(letters)
+    inputs, output = _einsum_split(subscripts)
+    inputs = ",".join(batch + x for x in inputs)
+    return inputs + '->' + batch + output
+
+def vec_einsum(subscripts, *operands, shared=None, optimize='greedy'):
+    """
+    Evaluates a multi-operand contraction like `np.einsum`, but plans the contraction order
+    once per set of subscripts and operand shapes and caches it,
+    so that repeated contractions (e.g. over the terms of a Taylor series) only pay for the BLAS calls.
+    The planned path is executed as explicit pairwise `np.tensordot`/`np.matmul` calls
+    (the latter when the pair shares batch axes, e.g. with `shared`), falling back to `np.einsum`
+    for steps that aren't plain contractions; subscripts with an ellipsis go straight to `np.einsum`
+
+    :param subscripts: the `einsum` subscripts
+    :type subscripts: str
+    :param operands: the tensors to contract
+    :type operands: np.ndarray
+    :param shared: the number of leading axes shared by every operand (and kept in the output)
+    :type shared: int | None
+    :param optimize: the `np.einsum_path` strategy or an explicit path
+    :type optimize: str | bool | list
+    :return:
+    :rtype: np.ndarray
+    """
+    operands = [np.asanyarray(o) for o in operands]
+    if shared is not None and shared > 0:
+        subscripts = _einsum_shared_subscripts(subscripts, [o.ndim for o in operands], shared)
+    if isinstance(optimize, (list, tuple)): # explicit paths need to be hashable for the plan cache
+        optimize = tuple(x if isinstance(x, str) else tuple(x) for x in optimize)
+    plan = _einsum_plan(subscripts.replace(' ', ''), tuple(o.shape for o in operands), optimize)
+    if plan is None:
+        return np.einsum(subscripts, *operands)
+    steps, perm = plan
+    for contract, method, spec in steps:
+        picked = [operands.pop(x) for x in contract]
+        if method == 'matmul':
+            perm_a, shape_a, perm_b, shape_b, new_shape = spec
+            res = np.matmul(
+                picked[0].transpose(perm_a).reshape(shape_a),
+                picked[1].transpose(perm_b).reshape(shape_b)
+            ).reshape(new_shape)
+        elif method == 'tensordot':
+            res = np.tensordot(picked[0], picked[1], axes=spec)
+        else:
+            res = np.einsum(spec, *picked)
+        operands.append(res)
+    res = operands[0]
+    if perm is not None:
+        res = res.transpose(perm)
+    return res
+
 def vec_tdot(tensa, tensb, axes=[[-1], [1]]):
     """
     Tensor dot but just along the final axes by default. Totally a convenience function.
@@ -484,6 +816,7 @@ def pts_norms(pts1, pts2):
     :return:
     :rtype: np.ndarray
     """
+    pts1, pts2 = Options.cast(pts1), Options.cast(pts2)
     return vec_norms(pts2-pts1)
 
 ################################################
@@ -502,6 +835,7 @@ def pts_angles(pts1, pts2, pts3):
     :return:
     :rtype: np.ndarray
     """
+    pts1, pts2, pts3 = Options.cast(pts1), Options.cast(pts2), Options.cast(pts3)
     return vec_angles(pts1-pts2, pts3-pts2)
 
 ################################################
@@ -523,6 +857,7 @@ def pts_normals(pts1, pts2, pts3, normalize=True):
     :rtype: np.ndarray
     """
     # should I normalize these...?
+    pts1, pts2, pts3 = Options.cast(pts1), Options.cast(pts2), Options.cast(pts3)
     return vec_crosses(pts2-pts1, pts3-pts1, normalize=normalize)
 
 ################################################
@@ -549,6 +884,7 @@ def pts_dihedrals(pts1, pts2, pts3, pts4):
     # return vec_angles(normals, off_plane_vecs)[0]
 
     # compute signed angle between the normals to the b1xb2 plane and b2xb3 plane
+    pts1, pts2, pts3, pts4 = [Options.cast(p) for p in (pts1, pts2, pts3, pts4)]
     b1 = pts2-pts1 # 4->1
     b2 = pts3-pts2 # 1->2
     b3 = pts4-pts3 # 2->3
@@ -562,20 +898,177 @@ def pts_dihedrals(pts1, pts2, pts3, pts4):
     # arctan(d2/d1) + sign stuff from relative signs of d2 and d1
     return -np.arctan2(d2, d1)
 
+################################################
+#
+#       internal_coordinates
+#
+@jit(nopython=True, cache=True)
+def _internal_coordinate_kernel(coords, specs, sizes, zero_thresh, out):
+    """
+    Evaluates bonds, angles, and dihedrals directly from the coordinates
+    without building any intermediate arrays
+    """
+    for c in range(coords.shape[0]):
+        x = coords[c]
+        for s in range(specs.shape[0]):
+            i = specs[s, 0]
+            j = specs[s, 1]
+            n = sizes[s]
+            if n == 2:
+                a0 = x[j, 0] - x[i, 0]
+                a1 = x[j, 1] - x[i, 1]
+                a2 = x[j, 2] - x[i, 2]
+                out[c, s] = np.sqrt(a0*a0 + a1*a1 + a2*a2)
+            elif n == 3:
+                k = specs[s, 2]
+                a0 = x[i, 0] - x[j, 0]
+                a1 = x[i, 1] - x[j, 1]
+                a2 = x[i, 2] - x[j, 2]
+                b0 = x[k, 0] - x[j, 0]
+                b1 = x[k, 1] - x[j, 1]
+                b2 = x[k, 2] - x[j, 2]
+                norm_prod = np.sqrt((a0*a0 + a1*a1 + a2*a2)*(b0*b0 + b1*b1 + b2*b2))
+                if abs(norm_prod) <= zero_thresh:
+                    out[c, s] = 0.
+                else:
+                    c0 = a1*b2 - a2*b1
+                    c1 = a2*b0 - a0*b2
+                    c2 = a0*b1 - a1*b0
+                    out[c, s] = np.arctan2(
+                        np.sqrt(c0*c0 + c1*c1 + c2*c2) / norm_prod,
+                        (a0*b0 + a1*b1 + a2*b2) / norm_prod
+                    )
+            else:
+                k = specs[s, 2]
+                l = specs[s, 3]
+                a0 = x[j, 0] - x[i, 0]
+                a1 = x[j, 1] - x[i, 1]
+                a2 = x[j, 2] - x[i, 2]
+                b0 = x[k, 0] - x[j, 0]
+                b1 = x[k, 1] - x[j, 1]
+                b2 = x[k, 2] - x[j, 2]
+                d0 = x[l, 0] - x[k, 0]
+                d1 = x[l, 1] - x[k, 1]
+                d2 = x[l, 2] - x[k, 2]
+                # normals to the two planes
+                n0 = a1*b2 - a2*b1
+                n1 = a2*b0 - a0*b2
+                n2 = a0*b1 - a1*b0
+                nn = np.sqrt(n0*n0 + n1*n1 + n2*n2)
+                if nn <= zero_thresh:
+                    nn = np.inf
+                n0 /= nn
+                n1 /= nn
+                n2 /= nn
+                m0 = b1*d2 - b2*d1
+                m1 = b2*d0 - b0*d2
+                m2 = b0*d1 - b1*d0
+                mn = np.sqrt(m0*m0 + m1*m1 + m2*m2)
+                if mn <= zero_thresh:
+                    mn = np.inf
+                m0 /= mn
+                m1 /= mn
+                m2 /= mn
+                bn = np.sqrt(b0*b0 + b1*b1 + b2*b2)
+                if bn < zero_thresh:
+                    bn = np.inf
+                # (n1 x b2/|b2|) . n2
+                o0 = (n1*b2 - n2*b1) / bn
+                o1 = (n2*b0 - n0*b2) / bn
+                o2 = (n0*b1 - n1*b0) / bn
+                out[c, s] = -np.arctan2(
+                    o0*m0 + o1*m1 + o2*m2,
+                    n0*m0 + n1*m1 + n2*m2
+                )
+    return out
+
+def _prep_internal_specs(specs):
+    if isinstance(specs, np.ndarray) and specs.ndim == 2:
+        specs = specs.astype(np.int64)
+        sizes = np.full(len(specs), specs.shape[1], dtype=np.int64)
+    else:
+        sizes = np.array([len(s) for s in specs], dtype=np.int64)
+        padded = np.zeros((len(specs), 4), dtype=np.int64)
+        for n, s in enumerate(specs):
+            padded[n, :len(s)] = s
+        specs = padded
+    if np.any(sizes < 2) or np.any(sizes > 4):
+        raise ValueError("internal coordinates need 2, 3, or 4 indices (got specs of size {})".format(
+            np.unique(sizes[np.logical_or(sizes < 2, sizes > 4)])
+        ))
+    return specs, sizes
+
+def _internal_coordinates_numpy(coords, specs, sizes, zero_thresh, out):
+    for n, fn in [
+        (2, lambda i, j: pts_norms(coords[:, i], coords[:, j])),
+        (3, lambda i, j, k: vec_angles(coords[:, i] - coords[:, j], coords[:, k] - coords[:, j], zero_thresh=zero_thresh)[0]),
+        (4, lambda i, j, k, l: pts_dihedrals(coords[:, i], coords[:, j], coords[:, k], coords[:, l]))
+    ]:
+        pos = np.where(sizes == n)[0]
+        if len(pos) > 0:
+            out[:, pos] = fn(*specs[pos, :n].T)
+    return out
+
+def internal_coordinates(coords, specs, zero_thresh=None, method=None):
+    """
+    Evaluates bond lengths (`(i, j)`), angles (`(i, j, k)`, centered on `j`),
+    and dihedrals (`(i, j, k, l)`) for every configuration in `coords` in a single pass.
+    When Numba is available this uses a fused kernel that doesn't build any temporary
+    difference/cross product arrays, otherwise it falls back to `pts_norms`/`vec_angles`/`pts_dihedrals`.
+
+    :param coords: the coordinates, with the atoms and xyz components along the last two axes
+    :type coords: np.ndarray
+    :param specs: the index tuples for each coordinate
+    :type specs: Iterable[Iterable[int]] | np.ndarray
+    :param zero_thresh: the threshold for treating norms as zero
+    :type zero_thresh: float | None
+    :param method: `'numba'` or `'numpy'` (by default `'numba'` if it's installed)
+    :type method: str | None
+    :return: the coordinate values with shape `coords.shape[:-2] + (len(specs),)`
+    :rtype: np.ndarray
+    """
+    coords = np.asanyarray(Options.cast(coords))
+    base_shape = coords.shape[:-2]
+    coords = coords.reshape((-1,) + coords.shape[-2:])
+    specs, sizes = _prep_internal_specs(specs)
+    zero_thresh = Options.norm_zero_threshold if zero_thresh is None else zero_thresh
+    if method is None:
+        method = 'numba' if import_from_numba('njit', None) is not None else 'numpy'
+
+    dtype = coords.dtype if coords.dtype.kind == 'f' else np.dtype(float)
+    out = np.empty((coords.shape[0], len(specs)), dtype=dtype)
+    if method == 'numba':
+        if not coords.flags.c_contiguous or coords.dtype != dtype:
+            coords = np.ascontiguousarray(coords, dtype=dtype)
+        out = _internal_coordinate_kernel(coords, specs, sizes, zero_thresh, out)
+    elif method == 'numpy':
+        out = _internal_coordinates_numpy(coords, specs, sizes, zero_thresh, out)
+    else:
+        raise ValueError("unknown method {}".format(method))
+
+    return out.reshape(base_shape + (len(specs),))
+
 ################################################
 #
 #       mat_vec_muls
-def mat_vec_muls(mats, vecs):
+def mat_vec_muls(mats, vecs, out=None):
     """Pairwise multiplies mats and vecs
 
     :param mats:
     :type mats:
     :param vecs:
     :type vecs:
+    :param out: an array to write the products into
+    :type out: np.ndarray | None
     :return:
     :rtype:
     """
 
+    mats, vecs = Options.cast(mats), Options.cast(vecs)
+    if out is not None:
+        np.matmul(mats, vecs[..., np.newaxis], out=out[..., np.newaxis])
+        return out
+
     vecs_2 = np.matmul(mats, vecs[..., np.newaxis])
     return np.reshape(vecs_2, vecs.shape)
 
@@ -583,14 +1076,14 @@ def mat_vec_muls(mats, vecs):
 #
 #       one_pad_vecs
 def one_pad_vecs(vecs):
-    ones = np.ones(vecs.shape[:-1] + (1,))
+    ones = np.ones(vecs.shape[:-1] + (1,), dtype=vecs.dtype if vecs.dtype.kind == 'f' else float)
     vecs = np.concatenate([vecs, ones], axis=-1)
     return vecs
 
 ################################################
 #
 #       affine_multiply
-def affine_multiply(mats, vecs):
+def affine_multiply(mats, vecs, out=None):
     """
     Multiplies affine mats and vecs
 
@@ -598,11 +1091,22 @@ def affine_multiply(mats, vecs):
     :type mats:
     :param vecs:
     :type vecs:
+    :param out: an array to write the transformed vectors into
+    :type out: np.ndarray | None
     :return:
     :rtype:
     """
 
+    mats, vecs = Options.cast(mats), Options.cast(vecs)
     vec_shape = vecs.shape
+    if out is not None:
+        if vec_shape[-1] == 4:
+            return mat_vec_muls(mats, vecs, out=out)
+        # apply the rotation and translation blocks directly rather than padding
+        np.matmul(mats[..., :3, :3], vecs[..., np.newaxis], out=out[..., np.newaxis])
+        np.add(out, mats[..., :3, 3], out=out)
+        return out
+
     if vec_shape[-1] != 4:
         vecs = one_pad_vecs(vecs)
     res = mat_vec_muls(mats, vecs)
@@ -613,7 +1117,7 @@ def affine_multiply(mats, vecs):
 ###
 #
 #       cartesian_from_rad_transforms
-def cartesian_from_rad_transforms(centers, vecs1, vecs2, angles, dihedrals, return_comps=False):
+def cartesian_from_rad_transforms(centers, vecs1, vecs2, angles, dihedrals, return_comps=False, workspace=None):
     """Builds a single set of affine transformation matrices to apply to the vecs1 to get a set of points
 
     :param centers: central coordinates
@@ -626,12 +1130,20 @@ def cartesian_from_rad_transforms(centers, vecs1, vecs2, angles, dihedrals, retu
     :type angles: np.ndarray
     :param dihedrals: dihedral values
     :type dihedrals: np.ndarray | None
+    :param workspace: a pool of scratch buffers to reuse for temporaries
+    :type workspace: VectorWorkspace | None
     :return:
     :rtype:
     """
     from .TransformationMatrices import rotation_matrix, affine_matrix
 
-    crosses = vec_crosses(vecs1, vecs2)
+    if workspace is None:
+        crosses = vec_crosses(vecs1, vecs2)
+    else:
+        crosses = vec_crosses(vecs1, vecs2,
+                              out=workspace.get('rad.crosses', np.broadcast_shapes(vecs1.shape, vecs2.shape), vecs1.dtype),
+                              workspace=workspace
+                              )
     rot_mats_1 = rotation_matrix(crosses, -angles)
     if dihedrals is not None:
         rot_mats_2 = rotation_matrix(vecs1, dihedrals)
@@ -651,7 +1163,7 @@ def cartesian_from_rad_transforms(centers, vecs1, vecs2, angles, dihedrals, retu
 #
 #       cartesian_from_rad
 #
-def cartesian_from_rad(xa, xb, xc, r, a, d, psi=False, return_comps=False):
+def cartesian_from_rad(xa, xb, xc, r, a, d, psi=False, return_comps=False, out=None, workspace=None):
     """
     Constructs a Cartesian coordinate from a bond length, angle, and dihedral
     and three points defining an embedding
@@ -671,10 +1183,19 @@ def cartesian_from_rad(xa, xb, xc, r, a, d, psi=False, return_comps=False):
     :type ref_axis:
     :param return_comps:
     :type return_comps:
+    :param out: an array to write the new points into
+    :type out: np.ndarray | None
+    :param workspace: a pool of scratch buffers to reuse for temporaries (not used for returned components)
+    :type workspace: VectorWorkspace | None
     :return:
     :rtype:
     """
 
+    xa, xb, xc, r, a, d = [Options.cast(x) for x in (xa, xb, xc, r, a, d)]
+    if out is not None or workspace is not None:
+        return _cartesian_from_rad_into(xa, xb, xc, r, a, d, psi=psi, return_comps=return_comps,
+                                        out=out, workspace=workspace)
+
     v = xb - xa
     center = xa
     if a is None:
@@ -709,6 +1230,37 @@ def cartesian_from_rad(xa, xb, xc, r, a, d, psi=False, return_comps=False):
             comps = None
     return newstuff, comps
 
+def _cartesian_from_rad_into(xa, xb, xc, r, a, d, psi=False, return_comps=False, out=None, workspace=None):
+    if return_comps: # the components have to outlive the call
+        workspace = None
+    xa = np.asanyarray(xa)
+    xb = np.asanyarray(xb)
+    dtype = _float_dtype(xa, xb)
+    shape = np.broadcast_shapes(xa.shape, xb.shape)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+
+    v = np.subtract(xb, xa, out=_scratch(workspace, 'rad.v', shape, dtype))
+    vecs1 = vec_normalize(v, out=_scratch(workspace, 'rad.vecs1', shape, dtype), workspace=workspace)
+    if a is None:
+        np.multiply(r[..., np.newaxis], vecs1, out=out)
+        np.add(out, xa, out=out)
+        comps = (v, None, None, None, None)
+    else:
+        u = np.subtract(xc, xb, out=_scratch(workspace, 'rad.u', shape, dtype))
+        if isinstance(psi, np.ndarray):
+            d = np.pi - d
+        vecs2 = vec_normalize(u, out=_scratch(workspace, 'rad.vecs2', shape, dtype), workspace=workspace)
+        transfs, comps = cartesian_from_rad_transforms(xa, vecs1, vecs2, a, d,
+                                                       return_comps=return_comps, workspace=workspace)
+        scaled = np.multiply(r, vecs1, out=_scratch(workspace, 'rad.scaled', shape, dtype))
+        affine_multiply(transfs, scaled, out=out)
+        if return_comps:
+            comps = (v, u) + comps
+        else:
+            comps = None
+    return out, comps
+
 ##############################################################################
 #
 #       polar_to_cartesian
@@ -1,9 +1,11 @@
-import abc, weakref
+import abc, weakref, threading
+import numpy as np
 from collections import OrderedDict
 
 __all__ = [
     "Cache",
     "MaxSizeCache",
+    "ArrayCache",
     "ObjectRegistry"
 ]
 
@@ -42,6 +44,186 @@ class MaxSizeCache:
         if len(self.od) > self.max_items:
             self.od.popitem(last=False)
 
+class ArrayCache(Cache):
+    """
+    A thread-safe lru-cache for results computed from NumPy arrays.
+    Array keys are fingerprinted by identity, shape, strides, dtype, and a handful of
+    sampled elements, so no hash of the full buffer is ever taken, and entries are
+    evicted both when the total size of the cached values goes over a byte budget
+    and when a key array gets garbage collected
+    """
+
+    def __init__(self, max_bytes=2**26, max_items=None, samples=4):
+        """
+        :param max_bytes: the total size of the cached values before old entries get evicted
+        :type max_bytes: int
+        :param max_items: an optional cap on the number of entries
+        :type max_items: int | None
+        :param samples: the number of elements of each key array to fold into the fingerprint
+        :type samples: int
+        """
+        self.od = OrderedDict()
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.samples = samples
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+    def _fingerprint(self, array):
+        array = np.asanyarray(array)
+        n = array.size
+        if n == 0:
+            sample = ()
+        else:
+            flat = array.reshape(-1) if array.flags.contiguous else array.ravel()
+            pos = np.unique(np.linspace(0, n - 1, min(n, self.samples)).astype(int))
+            sample = tuple(flat[pos].tolist())
+        return (
+            id(array),
+            array.__array_interface__['data'][0],
+            array.shape,
+            array.strides,
+            array.dtype.str,
+            sample
+        )
+    def _prep_key(self, key):
+        if isinstance(key, np.ndarray):
+            return (self._fingerprint(key),), (key,)
+        elif isinstance(key, tuple):
+            fps = []
+            arrays = []
+            for k in key:
+                sub_fp, sub_arrays = self._prep_key(k)
+                fps.append(sub_fp)
+                arrays.extend(sub_arrays)
+            return tuple(fps), tuple(arrays)
+        else:
+            hash(key) # make sure we fail early on unhashable keys
+            return key, ()
+
+    @staticmethod
+    def _value_size(value):
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        elif isinstance(value, (tuple, list)):
+            return sum(ArrayCache._value_size(v) for v in value)
+        else:
+            return 0
+
+    def _lookup(self, key):
+        try:
+            fp, arrays = self._prep_key(key)
+        except TypeError:
+            return None, None
+        entry = self.od.get(fp, None)
+        if entry is not None:
+            refs, value, size = entry
+            if any(r() is not a for r, a in zip(refs, arrays)):
+                # ids were recycled after the original keys were collected
+                self._drop(fp)
+                entry = None
+        return fp, entry
+
+    def _drop(self, fp):
+        entry = self.od.pop(fp, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+        return entry
+    def _evict(self, fp):
+        with self._lock:
+            if self._drop(fp) is not None:
+                self.evictions += 1
+
+    def __contains__(self, item):
+        with self._lock:
+            fp, entry = self._lookup(item)
+            return entry is not None
+    def __getitem__(self, item):
+        with self._lock:
+            fp, entry = self._lookup(item)
+            if entry is None:
+                self.misses += 1
+                raise KeyError(item)
+            self.hits += 1
+            self.od.move_to_end(fp)
+            return entry[1]
+    def get(self, item, default=None):
+        try:
+            return self[item]
+        except KeyError:
+            return default
+    def __setitem__(self, key, value):
+        try:
+            fp, arrays = self._prep_key(key)
+        except TypeError:
+            return # unhashable keys just don't get cached
+        size = self._value_size(value)
+        if size > self.max_bytes:
+            return
+        callback = lambda ref, cache=weakref.ref(self), fp=fp: cache() is not None and cache()._evict(fp)
+        try:
+            refs = tuple(weakref.ref(a, callback) for a in arrays)
+        except TypeError:
+            return # can't track the lifetime of the key
+        with self._lock:
+            self._drop(fp)
+            self.od[fp] = (refs, value, size)
+            self.nbytes += size
+            while self.od and (
+                    self.nbytes > self.max_bytes
+                    or (self.max_items is not None and len(self.od) > self.max_items)
+            ):
+                _, (_, _, old_size) = self.od.popitem(last=False)
+                self.nbytes -= old_size
+                self.evictions += 1
+
+    def get_or_compute(self, key, func):
+        """
+        Returns the cached value for `key` or computes and caches `func()`
+
+        :param key:
+        :type key: np.ndarray | tuple
+        :param func:
+        :type func: callable
+        :return:
+        :rtype:
+        """
+        try:
+            return self[key]
+        except KeyError:
+            val = func()
+            self[key] = val
+            return val
+
+    def __len__(self):
+        return len(self.od)
+    def clear(self):
+        with self._lock:
+            self.od.clear()
+            self.nbytes = 0
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+    @property
+    def stats(self):
+        """
+        :return: the hit/miss/eviction counts and current size of the cache
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'items': len(self.od),
+                'nbytes': self.nbytes
+            }
+
 class ObjectRegistryDefaults:
     Raise="raise"
     NotFound="NotFound"
@@ -5,6 +5,7 @@ from unittest import TestCase
 from McUtils.Combinatorics import *
 import McUtils.Numputils as nput
 from McUtils.Scaffolding import Logger
+from .TestHelpers import ScatterRecordingParallelizer
 import sys, os, numpy as np, itertools
 
 class CombinatoricsTests(TestCase):
@@ -163,6 +164,37 @@ class CombinatoricsTests(TestCase):
             msg="{} should have indices {} but got {}".format(test_parts, inds, test_inds)
         )
 
+    @validationTest
+    def test_PartitionTableCache(self):
+        import tempfile, shutil
+
+        ref_counts = IntegerPartitioner.count_partitions(30)
+        ref_sub = IntegerPartitioner.count_partitions(30, 10, 10)
+        ref_parts = IntegerPartitioner.partitions(12, pad=True, max_len=5)
+        cache_dir = tempfile.mkdtemp()
+        try:
+            IntegerPartitioner.enable_table_cache(cache_dir)
+            IntegerPartitioner.fill_counts(30, 10, 10)
+            IntegerPartitioner.save_table_cache()
+            self.assertTrue(os.path.isfile(os.path.join(cache_dir, 'partition_counts_int64.npy')))
+
+            # simulate a fresh process
+            IntegerPartitioner._partition_counts = None
+            IntegerPartitioner._counts_cache_checked = False
+            IntegerPartitioner._load_cached_counts()
+            self.assertTrue(all(x >= y for x, y in zip(IntegerPartitioner._partition_counts.shape, (30, 10, 10))))
+            self.assertEquals(IntegerPartitioner.count_partitions(30, 10, 10), ref_sub)
+            self.assertEquals(IntegerPartitioner.count_partitions(30), ref_counts)
+
+            parts = IntegerPartitioner.partitions(12, pad=True, max_len=5)
+            self.assertEquals(parts.tolist(), ref_parts.tolist())
+            shorter = IntegerPartitioner.partitions(12, pad=True, max_len=3) # served from the max_len=5 table
+            self.assertEquals(shorter.tolist(), ref_parts[:len(shorter), :3].tolist())
+            self.assertEquals(len([f for f in os.listdir(cache_dir) if f.startswith('partitions_')]), 1)
+        finally:
+            IntegerPartitioner.disable_table_cache()
+            shutil.rmtree(cache_dir)
+
     @validationTest
     def test_UniquePartitionPermutations(self):
         """
@@ -534,6 +566,28 @@ class CombinatoricsTests(TestCase):
 
         # self.assertEquals(np.unique(bleeeh, axis=0).tolist(), u_tests.tolist())
 
+    @validationTest
+    def test_ParallelDirectSum(self):
+        gen = SymmetricGroupGenerator(5)
+        test_states = gen.get_terms(range(4), flatten=True)
+        test_rules = [[2], [-2], [-3], [1, 1], [-1, -1], [-1, 1], [-1, -1, 1]]
+        serial_perms, serial_inds = gen.take_permutation_rule_direct_sum(test_states, test_rules,
+                                                                         return_indices=True,
+                                                                         split_results=True)
+        par = ScatterRecordingParallelizer(processes=2)
+        par_perms, par_inds = gen.take_permutation_rule_direct_sum(test_states, test_rules,
+                                                                   return_indices=True,
+                                                                   split_results=True,
+                                                                   parallelizer=par)
+        # the main process only keeps its share of the tasks, the rest ran on the workers
+        ntasks, nmain = par.scattered
+        self.assertLess(nmain, ntasks)
+        self.assertEquals(len(serial_perms), len(par_perms))
+        for a, b in zip(serial_perms, par_perms):
+            self.assertEquals(a.tolist(), b.tolist())
+        for a, b in zip(serial_inds, par_inds):
+            self.assertEquals(a.tolist(), b.tolist())
+
     @validationTest
     def test_DirectSumExtra(self):
         """
@@ -1077,6 +1131,66 @@ class CombinatoricsTests(TestCase):
         self.assertEquals(full_basis._basis.shape[0], 5200300)
         self.assertEquals(full_basis.find([10, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]), 293930)
 
+    @validationTest
+    def test_StreamingTerms(self):
+
+        gen = SymmetricGroupGenerator(6)
+        full = gen.get_terms(range(5))
+        blocks = list(gen.iter_terms(range(5), block_size=37))
+        self.assertTrue(all(len(b) == 37 for b, _ in blocks[:-1]))
+        self.assertTrue(np.all(np.concatenate([b for b, _ in blocks]) == full))
+        self.assertTrue(np.all(np.concatenate([i for _, i in blocks]) == gen.to_indices(full)))
+
+        full_basis = CompleteSymmetricGroupSpace(6)
+        for block, inds in full_basis.iter_basis(4, min_sum=2, block_size=50):
+            self.assertEquals(block.dtype, np.dtype(full_basis.permutation_dtype))
+            self.assertTrue(np.all(full_basis.take(inds) == block))
+
+    @validationTest
+    def test_PackedBasis(self):
+
+        full_basis = CompleteSymmetricGroupSpace(6)
+        packed_basis = CompleteSymmetricGroupSpace(6, packed=True)
+        full_basis.load_to_sum(2)
+        packed_basis.load_to_sum(2)
+        bits = packed_basis.packing.bits
+        self.assertLess(packed_basis.basis_nbytes, full_basis._basis.nbytes)
+
+        np.random.seed(3)
+        inds = np.random.choice(len(full_basis._basis), 200)
+        self.assertTrue(np.all(packed_basis.take(inds) == full_basis.take(inds)))
+        self.assertTrue(np.all(packed_basis.find(full_basis.take(inds)) == inds))
+
+        # loading more quanta than the packing can hold forces a repack
+        high = [0, 0, 0, 0, 0, 2**bits + 1]
+        self.assertEquals(packed_basis.find(high), full_basis.find(high))
+        self.assertGreater(packed_basis.packing.bits, bits)
+        self.assertTrue(np.all(packed_basis.find(full_basis.take(inds)) == inds))
+        self.assertTrue(np.all(packed_basis.packing.unpack(packed_basis.take(inds, return_packed=True)) == full_basis.take(inds)))
+
+    @validationTest
+    def test_PermutationHashIndex(self):
+
+        np.random.seed(5)
+        for ndim in [6, 50]: # exact keys and hashed keys
+            rows = nput.unique(np.random.randint(0, 4, (2000, ndim)))[0]
+            np.random.shuffle(rows)
+            index = PermutationHashIndex(rows)
+            self.assertEquals(index.exact, ndim == 6)
+            inds = np.random.choice(len(rows), 300)
+            self.assertTrue(np.all(index.find(rows[inds]) == inds))
+            missing = np.full((2, ndim), 5)
+            missing[1, 0] = -1
+            self.assertEquals(index.find(missing).tolist(), [-1, -1])
+
+        gen = SymmetricGroupGenerator(20)
+        terms = gen.get_terms(range(4))
+        inds = np.random.choice(len(terms), 500)
+        ref = gen.to_indices(terms[inds])
+        gen.load_index(3)
+        self.assertTrue(np.all(gen.to_indices(terms[inds]) == ref))
+        self.assertTrue(np.all(ref == inds))
+
     @validationTest
     def test_SelRules(self):
 
@@ -4,7 +4,8 @@ from Peeves import BlockProfiler
 from McUtils.Numputils import *
 from McUtils.Zachary import FiniteDifferenceDerivative
 from unittest import TestCase
-import numpy as np, functools as ft
+from .TestHelpers import ScatterRecordingParallelizer
+import numpy as np, scipy.sparse as sp, functools as ft, os, tempfile as tmpf
 
 class NumputilsTests(TestCase):
 
@@ -1189,4 +1190,641 @@ class NumputilsTests(TestCase):
                 meh,
                 new2.asarray()
             )
-        )
\ No newline at end of file
+        )
+    @validationTest
+    def test_SparseMemmap(self):
+
+        shape = (100, 50, 20)
+        np.random.seed(1)
+        inds = np.unique(np.array([np.random.choice(x, 500) for x in shape]).T, axis=0).T
+        vals = np.random.rand(inds.shape[1])
+        array = SparseArray.from_data((vals, inds), shape=shape)
+        dense = array.asarray()
+
+        with tmpf.TemporaryDirectory() as temp_dir:
+            file = array.save_mmap(os.path.join(temp_dir, 'array'))
+            mapped = SparseArray.open_mmap(file)
+            self.assertIsInstance(mapped.data.data, np.memmap)
+            self.assertIsInstance(mapped.block_vals, np.memmap)
+            self.assertEquals(mapped.shape, shape)
+            self.assertTrue(np.allclose(mapped.asarray(), dense))
+            self.assertTrue(np.allclose(
+                mapped.tensordot(mapped, axes=[[1, 2], [1, 2]]).asarray(),
+                np.tensordot(dense, dense, axes=[[1, 2], [1, 2]])
+            ))
+
+            loaded = ScipySparseArray.loadz(array.savez(os.path.join(temp_dir, 'array')))
+            self.assertTrue(np.allclose(loaded.asarray(), dense))
+            self.assertTrue(np.allclose(loaded.block_vals, array.block_vals))
+
+    @validationTest
+    def test_CSFSparseArray(self):
+
+        shape = (6, 5, 4, 7)
+        np.random.seed(3)
+        inds = np.unique(np.array([np.random.choice(x, 200) for x in shape]).T, axis=0).T
+        vals = np.random.rand(inds.shape[1])
+        array = SparseArray.from_data((vals, inds), shape=shape, target_backend='csf')
+        self.assertIsInstance(array, CSFSparseArray)
+        dense = array.asarray()
+
+        self.assertTrue(np.allclose(array.transpose((2, 0, 3, 1)).asarray(), dense.transpose((2, 0, 3, 1))))
+        self.assertTrue(np.allclose(array.reshape((3, 2, 5, 2, 2, 7)).asarray(), dense.reshape((3, 2, 5, 2, 2, 7))))
+        self.assertTrue(np.allclose(array.reshape((30, 28)).asarray(), dense.reshape((30, 28))))
+        self.assertTrue(np.allclose(array[2, :, 1:3].asarray(), dense[2, :, 1:3]))
+        self.assertTrue(np.allclose(array[:, [4, 0, 2]].asarray(), dense[:, [4, 0, 2]]))
+        self.assertTrue(np.allclose(array[..., 1:3].asarray(), dense[..., 1:3]))
+        self.assertTrue(np.allclose(array[2, ..., 3].asarray(), dense[2, ..., 3]))
+        self.assertEquals(array[-1, 2, ..., 1, 3], dense[-1, 2, ..., 1, 3])
+        with self.assertRaises(IndexError):
+            array[6]
+        with self.assertRaises(IndexError):
+            array[1, -6]
+        self.assertTrue(np.allclose(
+            array.tensordot(array, axes=[[1, 3], [1, 3]]).asarray(),
+            np.tensordot(dense, dense, axes=[[1, 3], [1, 3]])
+        ))
+        scipy_array = SparseArray.from_data((vals, inds), shape=shape)
+        self.assertTrue(np.allclose(
+            sparse_tensordot(scipy_array, array, axes=[[0, 1], [0, 1]]).asarray(),
+            np.tensordot(dense, dense, axes=[[0, 1], [0, 1]])
+        ))
+
+    @validationTest
+    def test_PlannedTensordot(self):
+
+        np.random.seed(3)
+        def random_sparse(shape, n):
+            inds = np.unique(np.array([np.random.choice(x, n) for x in shape]).T, axis=0).T
+            return SparseArray.from_data((np.random.rand(inds.shape[1]), inds), shape=shape)
+
+        a = random_sparse((10, 8, 9, 7), 400)
+        b = random_sparse((9, 7, 11), 200)
+        plan = SparseArray.plan_tensordot(a, b, axes=[[2, 3], [0, 1]])
+        self.assertTrue(np.allclose(
+            plan(a, b).asarray(),
+            np.tensordot(a.asarray(), b.asarray(), axes=[[2, 3], [0, 1]])
+        ))
+
+        # same patterns, new values
+        a_vals = np.random.rand(a.non_zero_count)
+        b_vals = np.random.rand(b.non_zero_count)
+        a2 = ScipySparseArray((a_vals, a.block_inds[1]), shape=a.shape)
+        b2 = ScipySparseArray((b_vals, b.block_inds[1]), shape=b.shape)
+        self.assertTrue(np.allclose(
+            plan(a_vals, b_vals).asarray(),
+            np.tensordot(a2.asarray(), b2.asarray(), axes=[[2, 3], [0, 1]])
+        ))
+        # the output structure is only built once
+        template = plan._get_output_template()
+        plan(a, b)
+        self.assertIs(plan._get_output_template(), template)
+        # but results don't share index buffers with each other
+        ref = plan(a_vals, b_vals).asarray()
+        out = plan(a_vals, b_vals)
+        self.assertIsNot(out.data.indptr, plan(a_vals, b_vals).data.indptr)
+        out.data.indices[:] = 0
+        out.block_inds[1][0][:] = 0
+        out[0, 0, 0] = 5.
+        self.assertTrue(np.allclose(plan(a_vals, b_vals).asarray(), ref))
+
+        # integer values on the left get promoted
+        int_vals = np.random.randint(1, 5, a.non_zero_count)
+        a3 = ScipySparseArray((int_vals.astype(float), a.block_inds[1]), shape=a.shape)
+        res = plan(int_vals, b_vals)
+        self.assertTrue(np.allclose(
+            res.asarray(),
+            np.tensordot(a3.asarray(), b2.asarray(), axes=[[2, 3], [0, 1]])
+        ))
+        self.assertTrue(np.allclose(res.block_vals, res.asarray()[res.block_inds[1]]))
+
+    @validationTest
+    def test_ParallelSparseDot(self):
+        np.random.seed(4)
+        a = SparseArray.from_data(sp.random(200, 150, density=.05, format='csr'))
+        b = SparseArray.from_data(sp.random(150, 80, density=.05, format='csr'))
+        par = ScatterRecordingParallelizer(processes=2)
+
+        self.assertTrue(np.allclose(
+            a.dot(b, parallelizer=par).asarray(),
+            np.dot(a.asarray(), b.asarray())
+        ))
+        # the row blocks were split up and only some of them were multiplied on the main process
+        nblocks, nmain = par.scattered
+        self.assertLess(nmain, nblocks)
+
+        c = np.random.rand(10, 12, 5) * (np.random.rand(10, 12, 5) > .7)
+        d = np.random.rand(5, 3)
+        self.assertTrue(np.allclose(
+            sparse_tensordot(SparseArray.from_data(c), d, axes=1, parallelizer=par),
+            np.tensordot(c, d, axes=1)
+        ))
+
+    @validationTest
+    def test_RavelCacheTiming(self):
+        from Peeves import Timer
+
+        np.random.seed(5)
+        shape = (50, 40, 30, 20)
+        flat = np.unique(np.random.randint(0, np.prod(shape), 500000))
+
+        ScipySparseArray.clear_ravel_caches()
+        for enabled in [False, True]:
+            with ScipySparseArray.cache_options(enabled=enabled):
+                with Timer(tag="unravel (cached={})".format(enabled)):
+                    for _ in range(10):
+                        ScipySparseArray._unravel_indices(flat, shape)
+        stats = ScipySparseArray.get_ravel_cache_stats()['unravel']
+        self.assertEquals(stats['hits'], 9)
+        self.assertEquals(stats['misses'], 1)
+
+    @validationTest
+    def test_SparseTakePut(self):
+
+        np.random.seed(6)
+        shape = (20, 30, 40)
+        dense = np.random.rand(*shape) * (np.random.rand(*shape) > .9)
+        array = SparseArray.from_data(dense)
+
+        inds = tuple(np.random.randint(0, s, 500) for s in shape)
+        self.assertTrue(np.allclose(array.take(inds), dense[inds]))
+        self.assertTrue(np.allclose(array.take(np.ravel_multi_index(inds, shape)), dense[inds]))
+
+        vals = np.random.rand(500)
+        vals[::7] = 0
+        array.put(inds, vals)
+        dense[inds] = vals
+        self.assertTrue(np.allclose(array.asarray(), dense))
+        self.assertTrue(np.allclose(array.block_vals, dense[array.block_inds[1]]))
+
+        array[inds] = 2 * vals
+        dense[inds] = 2 * vals
+        self.assertTrue(np.allclose(array.asarray(), dense))
+
+    @validationTest
+    def test_SparseLazyViews(self):
+
+        np.random.seed(7)
+        shape = (4, 5, 6, 7)
+        dense = np.random.rand(*shape) * (np.random.rand(*shape) > .8)
+        array = SparseArray.from_data(dense)
+
+        # chained transpositions collapse into a single one on the original array
+        view = array.transpose((2, 0, 3, 1)).transpose((1, 0, 3, 2))
+        self.assertIs(view._view[0], array)
+        self.assertTrue(np.allclose(view.asarray(), dense.transpose((2, 0, 3, 1)).transpose((1, 0, 3, 2))))
+
+        view = array.transpose((3, 1, 0, 2)).reshape((35, 24))
+        self.assertIs(view._view[0], array)
+        self.assertTrue(np.allclose(view.asarray(), dense.transpose((3, 1, 0, 2)).reshape((35, 24))))
+        self.assertTrue(np.allclose(view.block_vals, view.asarray()[view.block_inds[1]]))
+
+        self.assertTrue(np.allclose(array.expand_dims(1).asarray(), dense[:, np.newaxis]))
+        self.assertTrue(np.allclose(array.moveaxis(0, -1).asarray(), np.moveaxis(dense, 0, -1)))
+        self.assertTrue(np.allclose(
+            array.reshape((20, 42)).transpose((1, 0)).asarray(),
+            dense.reshape((20, 42)).T
+        ))
+
+        # views keep the data the base had when they were taken
+        base = SparseArray.from_data(dense)
+        views = [base.transpose((2, 0, 3, 1)), base.reshape((20, 42)), base.transpose((1, 0, 2, 3)).reshape((20, 42))]
+        base[0, 0, 0, 0] = 123.
+        base.put(([1, 2], [1, 2], [1, 2], [1, 2]), [5., 6.])
+        self.assertEquals(base[0, 0, 0, 0], 123.)
+        for v, d in zip(views, [
+            dense.transpose((2, 0, 3, 1)), dense.reshape((20, 42)), dense.transpose((1, 0, 2, 3)).reshape((20, 42))
+        ]):
+            self.assertTrue(np.allclose(v.asarray(), d))
+
+    @validationTest
+    def test_SparseBroadcastArithmetic(self):
+
+        np.random.seed(8)
+        shape = (30, 40, 50)
+        d1 = np.random.rand(*shape) * (np.random.rand(*shape) > .95)
+        d2 = np.random.rand(*shape) * (np.random.rand(*shape) > .95)
+        a = SparseArray.from_data(d1)
+
+        vec = np.random.rand(50)
+        self.assertTrue(np.allclose(a.multiply(vec).asarray(), d1 * vec))
+        mat = np.random.rand(30, 1, 50)
+        self.assertTrue(np.allclose(a.multiply(mat).asarray(), d1 * mat))
+
+        # same shape but differently laid out scipy data
+        b = SparseArray.from_data(d2.reshape(60, 1000)).reshape(shape)
+        self.assertTrue(np.allclose((a + b).asarray(), d1 + d2))
+        self.assertTrue(np.allclose(a.multiply(b).asarray(), d1 * d2))
+
+    @validationTest
+    def test_SparseAccumulator(self):
+
+        np.random.seed(9)
+        shape = (200, 300, 40)
+        for budget in [2**30, 20000]: # in memory and spilling to disk
+            dense = np.zeros(shape)
+            with SparseAccumulator(shape, memory_budget=budget, merge_chunk_size=1000) as acc:
+                for _ in range(30):
+                    inds = tuple(np.random.randint(0, s, 2000) for s in shape)
+                    vals = np.random.rand(2000)
+                    acc.append(inds, vals)
+                    np.add.at(dense, inds, vals)
+                array = acc.to_sparse()
+                self.assertEquals(array.shape, shape)
+                self.assertTrue(np.allclose(array.asarray(), dense))
+                self.assertTrue(np.allclose(array.block_vals, dense[array.block_inds[1]]))
+
+        # more than 2**32 elements, so the flat indices need 64 bits
+        shape = (2**17, 2**15, 2)
+        acc = SparseAccumulator(shape, memory_budget=20000, memmap=True)
+        inds = np.unique(np.array([np.random.randint(0, s, 5000) for s in shape]).T, axis=0).T
+        vals = np.random.rand(inds.shape[1])
+        for i in range(0, inds.shape[1], 1000):
+            acc.append(inds[:, i:i+1000], vals[i:i+1000])
+        array = acc.to_sparse()
+        acc.cleanup() # the result has to outlive the accumulator's spill directory
+        flat, unflat = array.block_inds
+        sorting = np.lexsort(inds[::-1])
+        self.assertTrue(np.all(np.array(unflat) == inds[:, sorting]))
+        self.assertTrue(np.allclose(array.block_vals, vals[sorting]))
+        self.assertTrue(np.allclose(array[inds[0, 3], inds[1, 3], inds[2, 3]], vals[3]))
+
+        # building is non-destructive, so arrays can be rebuilt after more appends
+        # without disturbing the ones that were already built
+        shape = (20, 30, 4)
+        with tmpf.TemporaryDirectory() as spill_dir:
+            for budget in [2**30, 0]:
+                acc = SparseAccumulator(shape, memory_budget=budget, spill_dir=spill_dir, memmap=True)
+                acc.append(([1, 2], [3, 4], [0, 1]), 1)
+                first = acc.to_sparse()
+                acc.append(([5, 1], [6, 3], [2, 0]), 0.5)
+                second = acc.to_sparse()
+                self.assertEquals(second.dtype, np.dtype(float))
+                self.assertEquals(first.asarray()[5, 6, 2], 0)
+                self.assertEquals(first.asarray()[1, 3, 0], 1)
+                self.assertEquals(second.asarray()[5, 6, 2], .5)
+                self.assertEquals(second.asarray()[1, 3, 0], 1.5)
+                self.assertEquals(second.asarray()[2, 4, 1], 1)
+                del first, second
+                acc.cleanup()
+
+    @validationTest
+    def test_CompactSparseIndices(self):
+
+        np.random.seed(10)
+        shape = (60, 70, 80, 90)
+        inds = np.unique(np.array([np.random.randint(0, s, 100000) for s in shape]).T, axis=0).T
+        vals = np.random.rand(inds.shape[1])
+
+        arrays = {}
+        for compact in [False, True]:
+            with ScipySparseArray.compact_index_options(compact):
+                array = SparseArray.from_data((vals, inds), shape=shape)
+                array.block_inds # make sure the index cache is populated
+                arrays[compact] = array
+
+        flat, unflat = arrays[True].block_inds
+        self.assertEquals(flat.dtype, np.dtype('int32'))
+        self.assertEquals([u.dtype for u in unflat], [np.dtype('uint8')] * 4)
+        self.assertLess(arrays[True].index_nbytes, arrays[False].index_nbytes / 2)
+        self.assertTrue(np.allclose(
+            arrays[True][2, :, 3:6].asarray(),
+            arrays[False][2, :, 3:6].asarray()
+        ))
+        with ScipySparseArray.compact_index_options():
+            cat = arrays[True].concatenate_coo(arrays[True], axis=1)
+        self.assertEquals([u.dtype for u in cat.block_inds[1]], [np.dtype('uint8')] * 4)
+        self.assertTrue(np.allclose(cat.take((inds[0], inds[1] + 70, inds[2], inds[3])), arrays[True].block_vals))
+
+        # more than 2**32 elements, so the flat indices need 64 bits
+        shape = (2**17, 2**15, 2)
+        inds = np.unique(np.array([np.random.randint(0, s, 1000) for s in shape]).T, axis=0).T
+        vals = np.random.rand(inds.shape[1])
+        with ScipySparseArray.compact_index_options():
+            array = SparseArray.from_data((vals, inds), shape=shape)
+            self.assertEquals(array.block_inds[0].dtype, np.dtype('int64'))
+            array[inds[0, 3], inds[1, 3], inds[2, 3]] = 7.
+            array.put(tuple(inds[:, :2]), [5., 6.])
+            array.put(np.array([0, np.prod(shape) - 1]), [1., 2.])
+        self.assertEquals(array[inds[0, 3], inds[1, 3], inds[2, 3]], 7.)
+        self.assertEquals(array.take(tuple(inds[:, :2])).tolist(), [5., 6.])
+        self.assertEquals(array[shape[0] - 1, shape[1] - 1, shape[2] - 1], 2.)
+        self.assertEquals(array[0, 0, 0], 1.)
+
+    @validationTest
+    def test_HashSetOps(self):
+        from Peeves import Timer
+
+        np.random.seed(3)
+        tests = [
+            (np.random.randint(0, 50, 300), np.random.randint(20, 80, 200)),
+            (np.random.randint(0, 5, (300, 4)).astype(np.int16), np.random.randint(2, 7, (200, 4)).astype(np.int16))
+        ]
+        for a, b in tests:
+            u_sort = unique(a, return_index=True, return_inverse=True, return_counts=True)
+            u_hash = unique(a, return_index=True, return_inverse=True, return_counts=True, method='hash')
+            self.assertTrue(np.all(u_sort[0] == u_hash[0]))
+            self.assertTrue(np.all(a[u_hash[2],] == u_hash[0]))
+            self.assertTrue(np.all(u_hash[0][u_hash[3]] == a))
+            self.assertTrue(np.all(u_sort[4] == u_hash[4]))
+
+            i_sort = intersection(a, b, return_indices=True)
+            i_hash = intersection(a, b, return_indices=True, method='hash')
+            self.assertTrue(np.all(i_sort[0] == i_hash[0]))
+            self.assertTrue(np.all(b[i_hash[4],] == i_hash[0]))
+
+            for invert in [False, True]:
+                self.assertTrue(np.all(
+                    contained(a, b, invert=invert)[0] == contained(a, b, invert=invert, method='hash')[0]
+                ))
+            self.assertTrue(np.all(difference(a, b)[0] == difference(a, b, method='hash')[0]))
+
+        a = np.random.randint(0, 10**6, 10**6)
+        b = np.random.randint(0, 10**6, 10**6)
+        for method in [None, 'hash']:
+            with Timer(tag="contained (method={})".format(method)):
+                contained(a, b, method=method)
+
+    @validationTest
+    def test_SortedIndex(self):
+        np.random.seed(1)
+        a = np.random.randint(0, 6, (100, 3)).astype(np.int8)
+        b = np.random.randint(0, 8, (60, 3))
+        idx = SortedIndex(a)
+
+        self.assertTrue(np.all(idx.unique == unique(a)[0]))
+        self.assertTrue(np.all(idx.contains(b) == contained(b, a)[0]))
+        self.assertTrue(np.all(idx.difference(b) == difference(a, b)[0]))
+        common, inds_a, inds_b = idx.intersection(b, return_indices=True)
+        self.assertTrue(np.all(common == intersection(a, b)[0]))
+        self.assertTrue(np.all(a[inds_a] == common))
+        self.assertTrue(np.all(b[inds_b] == common))
+        pos = idx.find(b, missing_val=-1)
+        self.assertTrue(np.all(a[pos[pos >= 0]] == b[pos >= 0]))
+
+        idx.insert(b)
+        full = np.concatenate([a, b])
+        self.assertTrue(np.all(idx.array == full))
+        self.assertTrue(np.all(idx.unique == unique(full)[0]))
+        self.assertTrue(np.all(full[idx.find(full)] == full))
+
+        # scalar queries give back scalars
+        idx = SortedIndex(np.array([3, 1, 2]))
+        self.assertEquals(idx.find(2), 2)
+        self.assertEquals(idx.find(5, missing_val=-1), -1)
+        self.assertTrue(idx.contains(1))
+        self.assertFalse(idx.contains(5))
+        with self.assertRaises(IndexError):
+            idx.find(5)
+
+    @validationTest
+    def test_PackedRowKeys(self):
+        from McUtils.Numputils.Misc import RowPacking
+
+        np.random.seed(2)
+        a = np.random.randint(-3, 5, (400, 6))
+        b = np.random.randint(-1, 9, (300, 6))
+        packing = RowPacking.from_array(a, b)
+        self.assertTrue(np.all(packing.unpack(packing.pack(a)) == a))
+        # packed keys have to sort like the rows
+        self.assertTrue(np.all(np.argsort(packing.pack(a), kind='mergesort') == np.lexsort(a.T[::-1])))
+
+        def ops():
+            u = unique(a, return_index=True, return_inverse=True, return_counts=True)
+            return [u[0], u[2], u[3], u[4],
+                    intersection(a, b)[0], contained(a, b)[0], difference(a, b)[0], find(a, a[::3])[0]]
+        packed = ops()
+        try:
+            RowPacking.enabled = False
+            unpacked = ops()
+        finally:
+            RowPacking.enabled = True
+        for x, y in zip(packed, unpacked):
+            self.assertEquals(x.shape, y.shape)
+            self.assertTrue(np.all(x == y))
+
+    @validationTest
+    def test_BitPackedRows(self):
+        from McUtils.Numputils.Misc import BitPacking
+
+        np.random.seed(4)
+        a = np.random.randint(0, 4, (500, 101))
+        packing = BitPacking(101, 2, dtype=int)
+        packed = packing.pack(a)
+        self.assertEquals(packed.shape, (500, 26))
+        self.assertTrue(np.all(packing.unpack(packed) == a))
+        # packed rows have to sort like the rows
+        self.assertTrue(np.all(np.argsort(packing.flatten(packed), kind='mergesort') == np.lexsort(a.T[::-1])))
+        self.assertTrue(np.all(find(packing.flatten(packed), packing.flatten(packed[::7]))[0] == np.arange(0, 500, 7)))
+
+    @validationTest
+    def test_ChunkedGroupBy(self):
+        np.random.seed(0)
+        n = 100000
+        spill_dir = tmpf.mkdtemp()
+        keys = np.lib.format.open_memmap(os.path.join(spill_dir, 'keys.npy'), mode='w+', dtype=np.int64, shape=(n,))
+        keys[:] = np.random.randint(0, 300, n)
+        vals = np.lib.format.open_memmap(os.path.join(spill_dir, 'vals.npy'), mode='w+', dtype=float, shape=(n,))
+        vals[:] = np.random.rand(n)
+
+        for k in [keys, np.random.randint(0, 4, (n, 3))]:
+            (ukeys, groups), _ = group_by(np.asarray(vals), np.asarray(k))
+            chunked = list(group_by_chunked(vals, k, chunk_size=7000, spill_dir=spill_dir))
+            self.assertEquals(len(chunked), len(ukeys))
+            for (key, group), ukey, g in zip(chunked, ukeys, groups):
+                self.assertTrue(np.all(key == ukey))
+                self.assertTrue(np.all(group == g))
+        self.assertEquals(sorted(os.listdir(spill_dir)), ['keys.npy', 'vals.npy'])
+
+        # key rows that fit in a single chunk are sorted in memory
+        small_keys = np.random.randint(0, 3, (50, 2))
+        (ukeys, groups), _ = group_by(np.asarray(vals[:50]), small_keys)
+        chunked = list(group_by_chunked(vals[:50], small_keys))
+        self.assertEquals(len(chunked), len(ukeys))
+        for (key, group), ukey, g in zip(chunked, ukeys, groups):
+            self.assertTrue(np.all(key == ukey))
+            self.assertTrue(np.all(group == g))
+
+        regions = np.array([.1, .5, .55, .9])
+        (uinds, groups), _ = split_by_regions(regions, np.asarray(vals))
+        chunked = list(split_by_regions_chunked(regions, vals, chunk_size=7000))
+        self.assertEquals(list(uinds), [i for i, g in chunked])
+        for (i, group), g in zip(chunked, groups):
+            self.assertTrue(np.all(group == g))
+
+    @validationTest
+    def test_InternalCoordinates(self):
+        from Peeves import Timer
+
+        np.random.seed(0)
+        coords = np.random.rand(100, 6, 3)
+        specs = [(0, 1), (1, 2), (0, 1, 2), (3, 2, 5), (0, 1, 2, 3), (5, 1, 3, 2)]
+        vals = internal_coordinates(coords, specs)
+        self.assertEquals(vals.shape, (100, len(specs)))
+        self.assertTrue(np.allclose(vals, internal_coordinates(coords, specs, method='numpy')))
+        self.assertTrue(np.allclose(vals[:, 0], pts_norms(coords[:, 0], coords[:, 1])))
+        self.assertTrue(np.allclose(vals[:, 3], pts_angles(coords[:, 3], coords[:, 2], coords[:, 5])[0]))
+        self.assertTrue(np.allclose(vals[:, 5], pts_dihedrals(coords[:, 5], coords[:, 1], coords[:, 3], coords[:, 2])))
+
+        coords = np.random.rand(10**5, 8, 3)
+        specs = np.array([(i, i + 1, i + 2, i + 3) for i in range(5)])
+        for method in ['numba', 'numpy']:
+            internal_coordinates(coords[:10], specs, method=method)
+            with Timer(tag="dihedrals (method={})".format(method)):
+                internal_coordinates(coords, specs, method=method)
+
+    @validationTest
+    def test_InternalCoordinateTensors(self):
+        np.random.seed(2)
+        coords = np.random.rand(2, 3, 6, 3)
+        specs = [(0, 1), (1, 0, 2), (0, 1, 2, 3), (5, 1, 3, 2), (2, 4), (3, 4, 5)]
+        vals, d1, d2 = internal_coordinate_tensors(coords, specs, order=2)
+        self.assertEquals(d1.shape, (2, 3, 18, len(specs)))
+        self.assertEquals(d2.shape, (2, 3, 18, 18, len(specs)))
+        self.assertTrue(np.allclose(vals, internal_coordinates(coords, specs)))
+
+        h = 1.0e-5
+        fd1 = np.zeros(d1.shape)
+        fd2 = np.zeros(d2.shape)
+        for x in range(18):
+            plus = coords.copy()
+            plus[..., x // 3, x % 3] += h
+            minus = coords.copy()
+            minus[..., x // 3, x % 3] -= h
+            fd1[..., x, :] = (internal_coordinates(plus, specs) - internal_coordinates(minus, specs)) / (2 * h)
+            fd2[..., x, :, :] = (
+                internal_coordinate_tensors(plus, specs, order=1)[1].asarray()
+                - internal_coordinate_tensors(minus, specs, order=1)[1].asarray()
+            ) / (2 * h)
+        self.assertTrue(np.allclose(d1.asarray(), fd1, atol=1.0e-6))
+        self.assertTrue(np.allclose(d2.asarray(), fd2, atol=1.0e-5))
+
+        vals, d1, d2 = internal_coordinate_tensors(coords, [], order=2)
+        self.assertEquals(vals.shape, (2, 3, 0))
+        self.assertEquals(d1.shape, (2, 3, 18, 0))
+        self.assertEquals(d2.shape, (2, 3, 18, 18, 0))
+        self.assertEquals(d2.non_zero_count, 0)
+
+    @validationTest
+    def test_PlannedContractions(self):
+        from Peeves import Timer
+
+        np.random.seed(0)
+        a = np.random.rand(5, 4, 3, 6)
+        b = np.random.rand(5, 6, 3, 2)
+        for _ in range(2): # second pass hits the cached plan
+            self.assertTrue(np.allclose(
+                vec_tensordot(a, b, axes=[[2, 3], [2, 1]], shared=1),
+                np.einsum('nijk,nkjl->nil', a, b)
+            ))
+        self.assertEquals(vec_einsum('ij,jk', a[..., 0, :], b[..., 0, :], shared=1).shape, (5, 4, 2))
+        # shared axes are batched through matmul rather than falling back to einsum
+        x, y, z = np.random.rand(3, 20, 6, 6)
+        self.assertTrue(np.allclose(vec_einsum('ij,jk,kl', x, y, z, shared=1), x @ y @ z))
+        from McUtils.Numputils.VectorOps import _einsum_plan
+        steps, _ = _einsum_plan('aij,ajk,akl->ail', (x.shape,) * 3, 'greedy')
+        self.assertEquals([s[1] for s in steps], ['matmul', 'matmul'])
+        self.assertTrue(np.allclose(
+            vec_einsum('ij,jk,kl', x[0], y[0], z[0], optimize=['einsum_path', (1, 2), (0, 1)]),
+            x[0] @ y[0] @ z[0]
+        ))
+        self.assertTrue(np.allclose(
+            vec_einsum('...jk,...kj->...', a[:, :3, :3, 0], b[:, :3, :3, 0]),
+            np.einsum('...jk,...kj->...', a[:, :3, :3, 0], b[:, :3, :3, 0])
+        ))
+
+        n = 30
+        derivs = np.random.rand(n, n, n, n)
+        disps = np.random.rand(200, n)
+        with Timer(tag="unplanned 4th order contraction"):
+            ref = np.einsum('ijkl,pi,pj,pk,pl->p', derivs, disps, disps, disps, disps)
+        with Timer(tag="planned 4th order contraction"):
+            res = vec_einsum('ijkl,pi,pj,pk,pl->p', derivs, disps, disps, disps, disps)
+        self.assertTrue(np.allclose(res, ref))
+
+    @validationTest
+    def test_VectorWorkspace(self):
+        np.random.seed(0)
+        a, b, c = np.random.rand(3, 100, 3)
+        r = np.random.rand(100, 1)
+        angs = np.random.rand(100)
+        diheds = np.random.rand(100)
+        ws = VectorWorkspace()
+        out = np.empty((100, 3))
+        for _ in range(2): # second pass reuses the same buffers
+            self.assertTrue(np.allclose(vec_normalize(a, workspace=ws), vec_normalize(a)))
+            self.assertTrue(np.allclose(vec_crosses(a, b, normalize=True, out=out, workspace=ws),
+                                        vec_crosses(a, b, normalize=True)))
+            self.assertTrue(np.allclose(vec_angles(a, b, up_vectors=c, workspace=ws)[0],
+                                        vec_angles(a, b, up_vectors=c)[0]))
+            self.assertTrue(np.allclose(cartesian_from_rad(a, b, c, r, angs, diheds, out=out, workspace=ws)[0],
+                                        cartesian_from_rad(a, b, c, r, angs, diheds)[0]))
+        nbuf = len(ws)
+        cartesian_from_rad(a, b, c, r, angs, diheds, out=out, workspace=ws)
+        self.assertEquals(len(ws), nbuf)
+
+    @validationTest
+    def test_QuaternionRotations(self):
+        np.random.seed(0)
+        axes = np.random.normal(size=(50, 3))
+        thetas = np.random.uniform(-np.pi, np.pi, 50)
+        quats = quaternion_from_axis_angle(axes, thetas)
+        mats = quaternion_matrix(quats)
+        self.assertTrue(np.allclose(mats, np.swapaxes(rotation_matrix(axes, thetas), -1, -2)))
+        self.assertTrue(np.allclose(quaternion_matrix(quaternion_from_matrix(mats)), mats))
+        self.assertTrue(np.allclose(
+            quaternion_matrix(quaternion_multiply(quats, quats[::-1])),
+            mats @ mats[::-1]
+        ))
+
+        for ordering in ["xyz", "zyz", "zyx", "yxz", "xzx"]:
+            angs = np.random.uniform(-np.pi, np.pi, (50, 3))
+            euler_quats = euler_quaternion(angs, ordering)
+            self.assertTrue(np.allclose(
+                np.moveaxis(quaternion_matrix(euler_quats), 0, -1),
+                euler_matrix(angs.T, ordering)
+            ))
+            recovered = quaternion_euler_angles(euler_quats, ordering)
+            self.assertTrue(np.allclose(
+                quaternion_matrix(euler_quaternion(recovered, ordering)),
+                quaternion_matrix(euler_quats)
+            ))
+
+        coords = np.random.normal(size=(50, 10, 3))
+        self.assertTrue(np.allclose(quaternion_rotate(quats, coords), np.einsum('nij,naj->nai', mats, coords)))
+        rot32 = quaternion_rotate(quats.astype('float32'), coords.astype('float32'))
+        self.assertEquals(rot32.dtype, np.float32)
+        self.assertTrue(np.allclose(rot32, quaternion_rotate(quats, coords), atol=1e-5))
+
+    @validationTest
+    def test_PrecisionPolicy(self):
+        from McUtils.Numputils.Options import Options
+
+        np.random.seed(0)
+        coords = np.random.normal(size=(100, 5, 3))
+        specs = [[0, 1], [0, 1, 2], [0, 1, 2, 3], [4, 2, 1]]
+        a, b, c, d = np.moveaxis(coords[:, :4], 1, 0)
+
+        def evaluate():
+            return [
+                vec_norms(a),
+                vec_dots(a, b),
+                vec_crosses(a, b, normalize=True),
+                pts_angles(a, b, c)[0],
+                pts_dihedrals(a, b, c, d),
+                internal_coordinates(coords, specs),
+                rotation_matrix(a, b[:, 0]),
+                cartesian_from_rad(a, b, c, np.abs(d[:, :1]), d[:, 1], d[:, 2])[0],
+                angle_deriv(coords, 0, 1, 2, order=1)[1]
+            ]
+
+        ref = evaluate()
+        with Options.precision('float32'):
+            self.assertEquals(Options.accumulation_dtype, np.float64)
+            single = evaluate()
+        self.assertIs(Options.dtype, None)
+
+        for r, s in zip(ref, single):
+            self.assertEquals(r.dtype, np.float64)
+            self.assertEquals(s.dtype, np.float32)
+            self.assertLess(np.max(np.abs(r - s)), 1e-5)
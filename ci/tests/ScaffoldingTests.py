@@ -604,4 +604,27 @@ class ScaffoldingTests(TestCase):
         finally:
             os.chdir(curdir)
 
-    #endregion
\ No newline at end of file
+    #endregion
+    #region Caches
+    @validationTest
+    def test_ArrayCache(self):
+        cache = ArrayCache(max_bytes=3 * 8 * 100)
+
+        keys = [np.arange(100) + i for i in range(4)]
+        for k in keys:
+            cache[(k.shape, k)] = k * 2
+        # byte budget only leaves room for the last three
+        self.assertEquals(len(cache), 3)
+        self.assertEquals(cache.stats['evictions'], 1)
+        self.assertNotIn((keys[0].shape, keys[0]), cache)
+        self.assertEquals(cache[(keys[3].shape, keys[3])].tolist(), (keys[3] * 2).tolist())
+        # equal contents but a different object don't hit
+        self.assertIsNone(cache.get((keys[3].shape, keys[3].copy())))
+        self.assertEquals(cache.stats['hits'], 1)
+        self.assertEquals(cache.stats['misses'], 1)
+
+        # collecting a key drops its entry
+        del keys[2]
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.nbytes, 2 * 8 * 100)
+    #endregion
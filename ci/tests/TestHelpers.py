@@ -0,0 +1,21 @@
+"""
+Shared fixtures for the McUtils tests
+"""
+
+from McUtils.Parallelizers import MultiprocessingParallelizer
+
+__all__ = [
+    "ScatterRecordingParallelizer"
+]
+
+class ScatterRecordingParallelizer(MultiprocessingParallelizer):
+    """
+    Records how much of the scattered data stays on the main process,
+    so tests can check that work was actually handed out to the workers
+    """
+    scattered = None
+    def scatter(self, data, **kwargs):
+        chunk = super().scatter(data, **kwargs)
+        if self.on_main:
+            self.scattered = (len(data), len(chunk))
+        return chunk